@@ -0,0 +1,112 @@
+"""
+Accuracy check and benchmark for the watershed areas (see py/metrics.py).
+
+The script used to project each watershed into an Albers equal-area projection, with shapely.ops.transform()
+and the deprecated pyproj.transform(). Now it works out the areas on the WGS84 ellipsoid with pyproj's
+geodesic routines. For each test, we compare three ways of getting the areas:
+
+    old        the old get_area() from delineate.py
+    aea        the same projection, but on arrays of coordinates (py/metrics.aea_area)
+    geodesic   the areas on the ellipsoid (py/metrics.geodesic_area_perimeter), which is what we use now
+
+and print the time, and the largest difference from the old areas in percent, and after rounding to
+the 3 significant digits in OUTPUT.csv.
+
+Without any options, we make up lumpy watersheds with a detailed outline, from 10 to 1 million km²,
+near the equator, at mid latitudes and in the Arctic. With --files, we use your own watersheds
+instead (e.g. the output of delineate.py).
+
+Usage (from the repository root):
+
+    >> python benchmarks/area.py
+    >> python benchmarks/area.py --files output/*.gpkg
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+from functools import partial
+
+import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
+import shapely.ops
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from py.metrics import aea_area, geodesic_area_perimeter, round_sigfig
+
+
+def old_area(poly) -> float:
+    """get_area() from earlier versions of delineate.py."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        projected_poly = shapely.ops.transform(
+            partial(
+                pyproj.transform,
+                pyproj.Proj(init='EPSG:4326'),
+                pyproj.Proj(proj='aea', lat_1=poly.bounds[1], lat_2=poly.bounds[3])
+            ),
+            poly)
+    return projected_poly.area / 1e6
+
+
+def make_watershed(area_km2: float, lat: float, n_vertices: int, rng) -> shapely.Polygon:
+    """A lumpy round polygon of about `area_km2`, centered at `lat`, with a jagged outline and a hole."""
+    radius = np.sqrt(area_km2 / np.pi) / 111.0
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    r = radius * (1 + 0.2 * np.sin(angles * 5) + 0.05 * rng.standard_normal(n_vertices))
+    x = 10.0 + r * np.cos(angles) / np.cos(np.radians(lat))
+    y = lat + r * np.sin(angles)
+    hole = shapely.Point(10.0, lat).buffer(radius * 0.1)
+    return shapely.Polygon(np.column_stack([x, y]), [hole.exterior.coords[::-1]])
+
+
+def made_up_tests(n_vertices: int) -> list:
+    rng = np.random.default_rng(0)
+    tests = []
+    for lat in [0.0, 45.0, 70.0]:
+        polygons = [make_watershed(area, lat, n_vertices, rng) for area in 10.0 ** np.arange(1, 7)]
+        tests.append((f"made-up watersheds at {lat:g}° latitude", polygons))
+    return tests
+
+
+def file_tests(files: list) -> list:
+    polygons = []
+    for fname in files:
+        polygons.extend(gpd.read_file(fname).to_crs('EPSG:4326').geometry.values)
+    return [(f"{len(polygons)} watersheds from {len(files)} files", polygons)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--vertices', type=int, default=20000,
+                        help="Number of vertices in each made-up watershed (default: 20000)")
+    parser.add_argument('--files', nargs='*', default=None, help="Geodata files with your own watersheds")
+    args = parser.parse_args()
+
+    tests = file_tests(args.files) if args.files else made_up_tests(args.vertices)
+    for name, polygons in tests:
+        print(f"\n{name}: {len(polygons)} polygons, {shapely.get_num_coordinates(polygons).sum():,} vertices")
+        print(f"{'method':>10} {'time (s)':>10} {'max diff %':>12} {'diff after rounding':>20}")
+
+        t0 = time.perf_counter()
+        reference = np.array([old_area(p) for p in polygons])
+        print(f"{'old':>10} {time.perf_counter() - t0:10.3f}")
+
+        for method in ['aea', 'geodesic']:
+            t0 = time.perf_counter()
+            if method == 'aea':
+                areas = aea_area(polygons)
+            else:
+                areas = geodesic_area_perimeter(polygons)[0]
+            elapsed = time.perf_counter() - t0
+
+            diff = np.max(np.abs(areas - reference) / reference) * 100
+            n_rounded = int(np.sum(round_sigfig(areas, 3) != round_sigfig(reference, 3)))
+            print(f"{method:>10} {elapsed:10.3f} {diff:12.2e} {n_rounded:>11} of {len(polygons)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark of the two raster catchment engines (see CATCHMENT_ENGINE in config.py):
+pysheds `grid.catchment()`, and the iterative engine in `py/raster_catchment.py`.
+
+We make up a flow direction grid where every pixel drains to an outlet at the bottom of the window,
+through a random tree of flow paths, and delineate the catchment of the outlet with both engines.
+The "snake" layout is a single flow path that winds back and forth across the whole window,
+which is the worst case for a recursive algorithm.
+
+Usage (from the repository root):
+
+    >> python benchmarks/catchment_engine.py --size 2000
+    >> python benchmarks/catchment_engine.py --size 200 --layout snake
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from affine import Affine
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from py.raster_catchment import MERIT_DIRMAP, catchment, _DROW, _DCOL
+
+
+def make_tree(size: int) -> np.ndarray:
+    """
+    Flow directions for a random drainage tree. We grow the tree outwards from the outlet:
+    at each step, every pixel next to the tree joins it by flowing into a random neighbor that is already in it.
+    """
+    rng = np.random.default_rng(0)
+    fdir = np.zeros((size, size), dtype=np.uint8)
+    joined = np.zeros((size, size), dtype=bool)
+    joined[size - 2, size // 2] = True
+    fdir[size - 2, size // 2] = MERIT_DIRMAP[4]
+
+    # Leave the rim empty, like a unit catchment in the middle of its window
+    interior = np.zeros((size, size), dtype=bool)
+    interior[1:-1, 1:-1] = True
+
+    while True:
+        before = joined.sum()
+        for k in rng.permutation(8):
+            # Pixels whose neighbor in direction k is already in the tree
+            neighbor_joined = np.zeros_like(joined)
+            src_r = slice(max(0, -_DROW[k]), size - max(0, _DROW[k]))
+            src_c = slice(max(0, -_DCOL[k]), size - max(0, _DCOL[k]))
+            dst_r = slice(max(0, _DROW[k]), size - max(0, -_DROW[k]))
+            dst_c = slice(max(0, _DCOL[k]), size - max(0, -_DCOL[k]))
+            neighbor_joined[src_r, src_c] = joined[dst_r, dst_c]
+
+            new = neighbor_joined & ~joined & interior & (rng.random((size, size)) < 0.5)
+            fdir[new] = MERIT_DIRMAP[k]
+            joined |= new
+        if joined.sum() == before:
+            break
+
+    return fdir
+
+
+def make_snake(size: int) -> np.ndarray:
+    """Flow directions for one long flow path that zig-zags across the window, ending at the bottom."""
+    fdir = np.zeros((size, size), dtype=np.uint8)
+    east, south, west = MERIT_DIRMAP[2], MERIT_DIRMAP[4], MERIT_DIRMAP[6]
+    for i in range(1, size - 1):
+        if i % 2 == 1:
+            fdir[i, 1:size - 2] = east
+            fdir[i, size - 2] = south
+        else:
+            fdir[i, 2:size - 1] = west
+            fdir[i, 1] = south
+    return fdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--size', type=int, default=1000,
+                        help="Width and height of the raster window, in pixels (default: 1000)")
+    parser.add_argument('--layout', choices=['tree', 'snake'], default='tree',
+                        help="Random drainage tree, or a single long zig-zag flow path")
+    args = parser.parse_args()
+
+    fdir_array = make_tree(args.size) if args.layout == 'tree' else make_snake(args.size)
+
+    # Put the array in a pysheds grid with the MERIT-Hydro resolution of 1/1200 of a degree
+    res = 1 / 1200
+    affine = Affine(res, 0, -20.0, 0, -res, 65.0)
+    fdir = Raster(fdir_array, ViewFinder(affine=affine, shape=fdir_array.shape, nodata=0))
+    grid = Grid.from_raster(fdir)
+
+    # The outlet is the last pixel of the flow path, in the bottom row of the interior
+    if args.layout == 'tree':
+        row, col = args.size - 2, args.size // 2
+    else:
+        row = args.size - 2
+        col = 1 if row % 2 == 0 else args.size - 2
+    x, y = affine * (col, row)
+
+    print(f"{args.layout} layout, window of {args.size} x {args.size} pixels")
+
+    # Run pysheds once first, so that numba's compile time is not part of the benchmark
+    grid.catchment(fdir=fdir, x=x, y=y, dirmap=MERIT_DIRMAP, xytype='coordinate')
+
+    t0 = time.perf_counter()
+    expected = grid.catchment(fdir=fdir, x=x, y=y, dirmap=MERIT_DIRMAP, xytype='coordinate')
+    t_pysheds = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    result = catchment(grid, fdir, x=x, y=y, dirmap=MERIT_DIRMAP)
+    t_iterative = time.perf_counter() - t0
+
+    print(f"{'pysheds':>10}: {t_pysheds:8.3f} s, {int(np.sum(expected)):,} pixels in the catchment")
+    print(f"{'iterative':>10}: {t_iterative:8.3f} s, {int(np.sum(result)):,} pixels in the catchment")
+
+    assert np.array_equal(np.asarray(expected), np.asarray(result))
+    print("The masks are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Benchmark of the methods for dissolving the unit catchments into a watershed (see DISSOLVE_METHOD in config.py).
+
+For each watershed size, we dissolve the same unit catchments with each method in py/fast_dissolve.py,
+and print the time, the number of vertices in the result, and how much its area differs from the first method
+(by default "clip", the method in earlier versions). The method "arcs" is the dissolve from the shared edges
+of the unit catchments (ARC_TOPOLOGY in config.py, see py/arc_topology.py). We print the time it takes to work
+out the arcs separately, since delineate.py only does that once per basin. The method "parallel" is the
+coverage union in --workers processes (DISSOLVE_PARALLEL_THRESHOLD in config.py, see py/parallel_dissolve.py).
+
+Without any options, we make up the unit catchments: random Voronoi cells on a raster, turned into polygons,
+so they fit together along shared edges just like the MERIT-Basins unit catchments (which also come from a raster).
+The default sizes are a small, a medium and a continental watershed.
+
+With --basin, we use real watersheds instead: for each size, the river reach whose upstream watershed
+has the number of unit catchments closest to it. This needs the data for the basin in config.py
+(it reads the tables the same way as delineate.py, so the GeoParquet files in PICKLE_DIR are used if they are there).
+
+Usage (from the repository root):
+
+    >> python benchmarks/dissolve.py
+    >> python benchmarks/dissolve.py --sizes 100 1000 --repeat 5
+    >> python benchmarks/dissolve.py --basin 11 --sizes 100 5000 50000
+"""
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from rasterio.features import shapes
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from py import arc_topology, parallel_dissolve
+from py.fast_dissolve import DISSOLVE_METHODS, dissolve, buffer
+from py.topology import UpstreamIndex
+
+# Average size of a made-up unit catchment, in pixels. At the MERIT-Hydro resolution (1/1200 degree),
+# that's about 40 km², like the MERIT-Basins unit catchments.
+PIXELS_PER_CATCHMENT = 400
+
+
+def make_catchments(n: int) -> gpd.GeoDataFrame:
+    """
+    About `n` made-up unit catchments that fit together without gaps or overlaps,
+    in a lumpy round watershed (so the result has a long, jagged outline, like a real one).
+    """
+    rng = np.random.default_rng(0)
+    # The watershed fills about 60% of the square
+    m = int(n / 0.6)
+    size = int(np.sqrt(m * PIXELS_PER_CATCHMENT))
+    seeds = rng.random((m, 2)) * size
+
+    # Label each pixel with its closest seed, a strip of rows at a time to save memory
+    labels = np.empty((size, size), dtype=np.int32)
+    tree = cKDTree(seeds)
+    cols = np.arange(size) + 0.5
+    for row in range(0, size, 256):
+        rows = np.arange(row, min(row + 256, size)) + 0.5
+        yy, xx = np.meshgrid(rows, cols, indexing='ij')
+        _, nearest = tree.query(np.column_stack([xx.ravel(), yy.ravel()]))
+        labels[row:row + len(rows)] = nearest.reshape(len(rows), size)
+
+    angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    radius = size * (0.42 + 0.05 * np.sin(angles * 7))
+    outline = shapely.Polygon(np.column_stack([size / 2 + radius * np.cos(angles), size / 2 + radius * np.sin(angles)]))
+    inside = shapely.contains_xy(outline, seeds[:, 0], seeds[:, 1])
+    polygons = [shapely.geometry.shape(geom) for geom, label in shapes(labels) if inside[int(label)]]
+
+    # From pixels to degrees, at the MERIT-Hydro resolution
+    res = 1 / 1200
+    polygons = shapely.transform(np.array(polygons), lambda c: c * [res, -res] + [-20.0, 65.0])
+    gdf = gpd.GeoDataFrame(geometry=polygons, crs='EPSG:4326')
+
+    # The real tables are in the order of the river network, so the unit catchments next to each other
+    # in the table are close together. This is a similar order.
+    return gdf.iloc[np.argsort(gdf.hilbert_distance().to_numpy(), kind='stable')].reset_index(drop=True)
+
+
+def made_up_watersheds(sizes: list) -> list:
+    """
+    For each size, the made-up unit catchments, with a river network where all of them are in one watershed.
+    Returns a list of (name, unit catchments, all of the unit catchments in the basin, topology index, row of the outlet).
+    """
+    watersheds = []
+    for n in sizes:
+        gdf = make_catchments(n)
+        gdf.index = np.arange(1, len(gdf) + 1)
+        # The first one is the outlet, and all of the others flow into it
+        up = np.zeros((len(gdf), 4), dtype=np.int64)
+        start = np.arange(len(gdf))
+        end = np.full(len(gdf), len(gdf))
+        end[1:] = start[1:] + 1
+        watersheds.append((f"{n:,} made-up unit catchments", gdf, gdf, UpstreamIndex(gdf.index, up, start, end), 0))
+    return watersheds
+
+
+def real_watersheds(basin: int, sizes: list) -> list:
+    """For each size, the real watershed with the closest number of unit catchments."""
+    from delineate import conf, load_gdf
+
+    rivers_gdf = load_gdf(conf, "rivers", basin, True)
+    catchments_gdf = load_gdf(conf, "catchments", basin, True, rivers_gdf=rivers_gdf)
+    topo = UpstreamIndex.from_rivers(rivers_gdf)
+    topo.euler()
+    counts = topo.end - topo.start
+
+    watersheds = []
+    for n in sizes:
+        row = int(np.argmin(np.abs(counts - n)))
+        rows = topo.upstream_rows(int(topo.comids[row]))
+        watersheds.append((f"COMID {topo.comids[row]}", topo.select(catchments_gdf, rows), catchments_gdf, topo, row))
+    return watersheds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 5000, 50000],
+                        help="Number of unit catchments in each watershed (default: 100 5000 50000)")
+    methods = DISSOLVE_METHODS + ['arcs', 'parallel']
+    parser.add_argument('--methods', nargs='*', default=methods, choices=methods,
+                        help="Methods to compare (default: all of them)")
+    parser.add_argument('--repeat', type=int, default=3, help="Take the fastest of this many runs (default: 3)")
+    parser.add_argument('--workers', type=int, default=4, help="Number of processes for 'parallel' (default: 4)")
+    parser.add_argument('--basin', type=int, default=None,
+                        help="Use real watersheds from this Level 2 basin, instead of made-up ones")
+    args = parser.parse_args()
+
+    if args.basin is None:
+        watersheds = made_up_watersheds(args.sizes)
+    else:
+        watersheds = real_watersheds(args.basin, args.sizes)
+
+    arcs = None
+    arcs_basin = None
+    for name, gdf, basin_gdf, topo, row in watersheds:
+        n_vertices = int(shapely.get_num_coordinates(gdf.geometry.values).sum())
+        print(f"\n{name}: {len(gdf):,} polygons, {n_vertices:,} vertices")
+
+        if 'arcs' in args.methods and basin_gdf is not arcs_basin:
+            # The arcs are for all of the unit catchments in the basin, so for real watersheds, we only need them once
+            t0 = time.perf_counter()
+            arcs_gdf = arc_topology.build(basin_gdf)
+            if arcs_gdf is None:
+                raise Exception("The unit catchments are not on the MERIT-Hydro grid, so we can't work out the arcs")
+            print(f"Working out the arcs took {time.perf_counter() - t0:.3f} s")
+            arcs = arc_topology.ArcTopology(arcs_gdf, topo)
+            arcs_basin = basin_gdf
+        print(f"{'method':>10} {'time (s)':>10} {'vertices':>10} {'parts':>6} {'area diff':>10}")
+
+        reference_area = None
+        for method in args.methods:
+            best = np.inf
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                if method == 'arcs':
+                    result = buffer(arcs.polygon(int(topo.start[row]), int(topo.end[row])))
+                elif method == 'parallel':
+                    rows = topo.order[topo.start[row]:topo.end[row]]
+                    result = parallel_dissolve.dissolve(gdf, 'coverage', args.workers,
+                                                        topo.end[rows] - topo.start[rows]).iloc[0]
+                else:
+                    result = dissolve(gdf, method).iloc[0]
+                best = min(best, time.perf_counter() - t0)
+
+            parts = len(result.geoms) if result.geom_type == 'MultiPolygon' else 1
+            if reference_area is None:
+                reference_area = result.area
+            diff = (result.area - reference_area) / reference_area
+            print(f"{method:>10} {best:10.3f} {shapely.get_num_coordinates(result):10,} {parts:6} {diff:10.2e}")
+
+
+if __name__ == "__main__":
+    main()
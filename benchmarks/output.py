@@ -0,0 +1,84 @@
+"""
+Benchmark of the ways of writing the watersheds (see OUTPUT_MODE in config.py).
+
+We make up some watersheds (lumpy polygons with a detailed outline) and write them the way delineate.py does:
+
+    files     one GeoPackage per watershed, OUTPUT_MODE = "files"
+    gpkg      all of them in one GeoPackage, OUTPUT_MODE = "single" (see py/output_writer.py)
+    parquet   all of them in one GeoParquet file, OUTPUT_MODE = "single", OUTPUT_EXT = "parquet"
+
+and print the total time, and the time per watershed. For "single", the time is for the whole thing, including
+waiting for the background thread at the end, so it is the time that the main thread is held up at most.
+
+Usage (from the repository root):
+
+    >> python benchmarks/output.py
+    >> python benchmarks/output.py --count 5000 --batch-size 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from py.output_writer import BatchWriter
+
+
+def make_watersheds(count: int, n_vertices: int) -> list:
+    """Made-up watersheds, as the dicts that write_watershed() hands to the writer."""
+    rng = np.random.default_rng(0)
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    features = []
+    for k in range(count):
+        x0, y0 = rng.uniform(-20, -19), rng.uniform(64, 65)
+        r = 0.05 * (1 + 0.2 * np.sin(angles * 5) + 0.05 * rng.standard_normal(n_vertices))
+        poly = shapely.Polygon(np.column_stack([x0 + r * np.cos(angles), y0 + r * np.sin(angles)]))
+        features.append({'geometry': poly, 'id': f"g{k}", 'result': "High Res", 'area_calc': float(k)})
+    return features
+
+
+def write_files(features: list, folder: str):
+    for feature in features:
+        gdf = gpd.GeoDataFrame([feature], geometry='geometry', crs="EPSG:4326")
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            gdf.to_file(f"{folder}/{feature['id']}.gpkg")
+
+
+def write_single(features: list, fname: str, batch_size: int):
+    writer = BatchWriter(fname, batch_size)
+    for feature in features:
+        writer.put(feature)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--count', type=int, default=1000, help="Number of watersheds (default: 1000)")
+    parser.add_argument('--vertices', type=int, default=500, help="Vertices in each watershed (default: 500)")
+    parser.add_argument('--batch-size', type=int, default=1000, help="OUTPUT_BATCH_SIZE (default: 1000)")
+    args = parser.parse_args()
+
+    features = make_watersheds(args.count, args.vertices)
+    print(f"{args.count} watersheds with {args.vertices} vertices each")
+    print(f"{'mode':>10} {'time (s)':>10} {'ms each':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ['files', 'gpkg', 'parquet']:
+            t0 = time.perf_counter()
+            if mode == 'files':
+                os.makedirs(f"{folder}/files")
+                write_files(features, f"{folder}/files")
+            else:
+                write_single(features, f"{folder}/WATERSHEDS.{mode}", args.batch_size)
+            elapsed = time.perf_counter() - t0
+            print(f"{mode:>10} {elapsed:10.3f} {elapsed / args.count * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
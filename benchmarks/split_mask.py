@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for the raster masking step in `py/merit_detailed.split_catchment`.
+
+Before delineating with pysheds, we set every pixel of the flow direction and accumulation
+rasters that is outside of the terminal unit catchment to zero. This used to be done with two
+pure-Python loops over every pixel; now it is one boolean mask and two in-place NumPy assignments.
+
+We don't need the MERIT-Hydro data for this: the script makes up a window the size of a big
+unit catchment, with a blobby polygon in it, and times both versions of the masking.
+
+Usage (from the repository root):
+
+    >> python benchmarks/split_mask.py --size 3000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from affine import Affine
+from rasterio.features import rasterize
+from shapely.geometry import Polygon
+
+
+def make_window(size: int):
+    """
+    Makes up the flow direction and accumulation rasters for a window of size x size pixels,
+    and the polygon of a unit catchment that fills most of it.
+    """
+    rng = np.random.default_rng(0)
+    fdir = rng.choice(np.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=np.uint8), size=(size, size))
+    acc = rng.integers(1, 100000, size=(size, size), dtype=np.int32)
+
+    # A lumpy circle, so the mask has an irregular edge like a real unit catchment
+    angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    radius = size * (0.4 + 0.05 * np.sin(angles * 7))
+    center = size / 2
+    poly = Polygon(np.column_stack([center + radius * np.cos(angles), center + radius * np.sin(angles)]))
+    return fdir, acc, poly
+
+
+def mask_loops(fdir, acc, poly):
+    # The old version: int64 mask (what pysheds gives you by default),
+    # and a Python loop over every pixel, for each raster
+    mymask = rasterize([poly], out_shape=fdir.shape, transform=Affine.identity(), dtype=np.int64)
+    m, n = fdir.shape
+    for i in range(0, m):
+        for j in range(0, n):
+            if int(mymask[i, j]) == 0:
+                fdir[i, j] = 0
+    for i in range(0, m):
+        for j in range(0, n):
+            if int(mymask[i, j]) == 0:
+                acc[i, j] = 0
+
+
+def mask_vectorized(fdir, acc, poly):
+    # The new version: uint8 mask, one boolean array, and in-place assignments
+    mymask = rasterize([poly], out_shape=fdir.shape, transform=Affine.identity(), dtype=np.uint8)
+    outside = mymask == 0
+    fdir[outside] = 0
+    acc[outside] = 0
+
+
+def measure(func, fdir, acc, poly) -> (float, float):
+    """Returns the time in seconds and the peak memory (in MB) allocated by `func`."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func(fdir, acc, poly)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--size', type=int, default=2000,
+                        help="Width and height of the raster window, in pixels (default: 2000)")
+    args = parser.parse_args()
+
+    fdir, acc, poly = make_window(args.size)
+    print(f"Window of {args.size} x {args.size} pixels ({fdir.size / 1e6:,.1f} million)")
+
+    results = {}
+    for name, func in [("loops", mask_loops), ("vectorized", mask_vectorized)]:
+        f, a = fdir.copy(), acc.copy()
+        elapsed, peak = measure(func, f, a, poly)
+        results[name] = (f, a)
+        print(f"{name:>12}: {elapsed:8.3f} s per outlet, peak memory {peak:8.1f} MB")
+
+    # Both versions have to give exactly the same rasters
+    assert np.array_equal(results["loops"][0], results["vectorized"][0])
+    assert np.array_equal(results["loops"][1], results["vectorized"][1])
+    print("Results are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,21 @@ class Config(BaseSettings):
     # Set to True if you want the script to write status messages to the console
     VERBOSE: bool = True
 
+    # Number of worker processes for delineating the outlets within each Level 2 basin.
+    # Use 1 to run everything in a single process. Each worker needs its own memory
+    # for the basin data, so don't use more workers than your RAM can support.
+    # Can also be set on the command line with: python delineate.py --jobs 8
+    WORKERS: int = 1
+
+    # Number of Level 2 basins to work on at the same time, if your outlets are in more than one.
+    # Each basin runs in its own process (with its own WORKERS), and a basin is only started
+    # if the estimated memory of all the running basins fits in MEMORY_BUDGET_GB.
+    # Can also be set on the command line with: python delineate.py --basin-jobs 4
+    BASIN_WORKERS: int = 1
+
+    # Memory budget for running several basins at once, in GB. Use 0 for 80% of this computer's RAM.
+    MEMORY_BUDGET_GB: float = 0
+
     # Set to True to make a bunch of plots of each watershed.
     # (Just for debugging. Slows down the script a lot.)
     PLOTS: bool = True
@@ -69,9 +84,25 @@ class Config(BaseSettings):
     # see: https://geopandas.org/en/stable/docs/user_guide/io.html#writing-spatial-data
     OUTPUT_EXT: str = "gpkg"
 
+    # For GeoJSON and KML output, and for the map viewer, the coordinates are rounded to this many decimal places
+    # to make the files smaller. 5 decimal places is about 1 meter. (see py/quantize.py)
+    OUTPUT_DECIMALS: int = 5
+
+    # How to write the watersheds. "files" writes each one to its own file, OUTPUT_DIR/{id}.{OUTPUT_EXT}.
+    # "single" puts all of them into one file, OUTPUT_DIR/WATERSHEDS.gpkg or WATERSHEDS.parquet,
+    # which is much faster for thousands of outlets. For "single", OUTPUT_EXT must be "gpkg" or "parquet".
+    OUTPUT_MODE: str = "files"
+
+    # With OUTPUT_MODE = "single", how many watersheds we write at a time (see py/output_writer.py)
+    OUTPUT_BATCH_SIZE: int = 1000
+
     # Set to True to ouput a summary of the delineation in OUTPUT.CSV
     OUTPUT_CSV: bool = True
 
+    # Set to True to measure the time and memory used by each stage of the delineation, for each outlet
+    # and each basin. Writes RUN_REPORT.csv and RUN_REPORT.json next to OUTPUT.csv.
+    REPORT: bool = False
+
     # Directory to store Python pickle files. Because it can be slow for Python to
     # read shapefiles and create a GeoDataFrame. Once you have done this once, you
     # can save time in the future by storing the GeoDataFrame as a .pkl file.
@@ -79,6 +110,78 @@ class Config(BaseSettings):
     # Please note that these files can be large! (Up to around 1 GB for large basins.)
     PICKLE_DIR: str = 'pkl'
 
+    # File format for the files in PICKLE_DIR: "parquet" (GeoParquet, recommended) or "pickle" (older versions).
+    # With GeoParquet, we can read only the columns and rows we need. Old pickle files are converted automatically.
+    CACHE_FORMAT: str = "parquet"
+
+    # Number of rows in each block (row group) of the GeoParquet files. With smaller row groups,
+    # we can skip more of the file when we only need a few unit catchments, but the files get a bit bigger.
+    CACHE_ROW_GROUP_SIZE: int = 20000
+
+    # Set to True to load only the river network for each basin at first, and then only the unit catchments
+    # (and river geometries) upstream of your outlets, instead of the whole basin. Saves time and memory when you
+    # have a few outlets in a big basin. Needs PICKLE_DIR and CACHE_FORMAT = "parquet", so we can read just those rows.
+    LAZY_LOAD: bool = False
+
+    # How to dissolve the unit catchments into the watershed polygon (see py/fast_dissolve.py):
+    #   "clip"      clip a big rectangle with the unit catchments (the method in earlier versions)
+    #   "unary"     shapely's union of all of the polygons at once
+    #   "coverage"  shapely's coverage union, which is the fastest, since the unit catchments fit together
+    #               without overlaps. Falls back on "unary" if they don't.
+    # They all give the same polygon. Compare them with: python benchmarks/dissolve.py
+    DISSOLVE_METHOD: str = "clip"
+
+    # Set to True to dissolve the high-resolution watersheds from the shared edges ("arcs") between the unit catchments,
+    # so the time depends on the length of the watershed's outline instead of the number of unit catchments.
+    # Much faster for big watersheds. The arcs are worked out the first time for each basin, and saved in PICKLE_DIR.
+    ARC_TOPOLOGY: bool = False
+
+    # Watersheds with more unit catchments than this are dissolved in parallel, in DISSOLVE_WORKERS processes:
+    # the unit catchments are split into groups along the river network, each group is dissolved in its own
+    # process, and the pieces are merged two at a time. Use 0 to always dissolve in one process.
+    # (Not used for the watersheds that are dissolved with ARC_TOPOLOGY or the UPSTREAM_CACHE_MB cache.)
+    DISSOLVE_PARALLEL_THRESHOLD: int = 0
+
+    # Number of processes for dissolving one big watershed, see DISSOLVE_PARALLEL_THRESHOLD.
+    # These are in addition to the WORKERS, so with WORKERS > 1, you may want to use a smaller number here.
+    DISSOLVE_WORKERS: int = 4
+
+    # Set to True to dissolve the watersheds in low-resolution mode out of polygons made ahead of time: for every
+    # confluence whose upstream area is more than PYRAMID_THRESHOLD, the polygon of everything upstream.
+    # They are made the first time they are needed (or with: python -m py.pyramid --basins 11 12), and saved in PICKLE_DIR.
+    PYRAMID: bool = False
+
+    # The smallest upstream area in km² of a confluence that gets a polygon in the pyramid. A smaller number means
+    # more polygons on disk, and fewer unit catchments to dissolve for each watershed. Delete the pyramid files if
+    # you change this.
+    PYRAMID_THRESHOLD: float = 1000
+
+    # Memory for the pyramid polygons, in MB (per process). We only keep the ones we used last, and read the
+    # others from the pyramid file in PICKLE_DIR when a watershed needs them. (Without PICKLE_DIR, all of them
+    # are kept in memory.) While building the pyramid, a smaller number means more unit catchments to dissolve.
+    PYRAMID_CACHE_MB: int = 500
+
+    # Set to True to find the unit catchment of each outlet in a raster of the unit catchments on the MERIT-Hydro
+    # grid, instead of with a spatial join against all of the polygons. The raster is made the first time it is
+    # needed (or with: python -m py.comid_grid --basins 11 12), and saved in PICKLE_DIR. It is always made from the
+    # high-res unit catchments (HIGHRES_CATCHMENTS_DIR), also with HIGH_RES = False, because they follow the pixels.
+    COMID_GRID: bool = False
+
+    # Memory for caching the dissolved polygons upstream of each river reach, in MB (per process).
+    # When several of your outlets are on the same river, the downstream watersheds are built from the
+    # polygons of the upstream ones, instead of dissolving all of the same unit catchments again.
+    # Use 0 to turn off the cache, and dissolve every watershed from scratch.
+    UPSTREAM_CACHE_MB: int = 0
+
+    # If UPSTREAM_CACHE_MB > 0, set to True to save the cached polygons in PICKLE_DIR, for the next run.
+    UPSTREAM_CACHE_PERSIST: bool = False
+
+    # Set to True if your outlets are a nested network of gages, and you want the incremental area
+    # between each gage and the next gages upstream, as well as the full watersheds.
+    # Writes INCREMENTAL.gpkg (or whatever OUTPUT_EXT is) and GAUGE_NETWORK.csv to OUTPUT_DIR.
+    # All of the watersheds are delineated at the same resolution (LOW_RES_THRESHOLD is not used).
+    NESTED: bool = False
+
     # Threshold for watershed size in km² above which the script will revert to
     # low-resolution mode 
     LOW_RES_THRESHOLD: int = 50000
@@ -108,9 +211,18 @@ class Config(BaseSettings):
     MAKE_MAP: bool = True
 
     # Folder where the script should put the map files. (MAKE sure it exists!)
-    # The mapping routine will make _viewer.html and .js files for every watershed
+    # The mapping routine will make _viewer.html and .js files for every watershed (or _tiles.bin, see MAP_MODE)
     MAP_FOLDER: str = "map"
 
+    # How to write the map files. "files" makes a .js file for each watershed and its rivers, and puts every
+    # outlet in _viewer.html. "tiles" writes all of them into one file, _tiles.bin, which the viewer reads
+    # a bit at a time, for the area on the screen. Use "tiles" for more than a few hundred outlets. (see py/map_tiles.py)
+    MAP_MODE: str = "files"
+
+    # With MAP_MODE = "tiles", the zoom levels in the tile archive. At each level, the watersheds and rivers are
+    # simplified to about one pixel on the screen. When you zoom in further, the viewer uses the last level.
+    MAP_TILE_LEVELS: list = [3, 6, 9, 12]
+
     # On the map, do you also want to include the rivers?
     MAP_RIVERS: bool = True
 
@@ -137,3 +249,29 @@ class Config(BaseSettings):
     # outlet is not getting snapped to a river centerline properly
     THRESHOLD_SINGLE: int = 500
     THRESHOLD_MULTIPLE: int = 5000
+
+    # Which code to use for the raster-based delineation inside the terminal unit catchment.
+    # "iterative" is the engine in py/raster_catchment.py, which has no limit on the size of the watershed.
+    # "pysheds" uses grid.catchment() from pysheds, which was the only option in earlier versions.
+    # Both give the same result.
+    CATCHMENT_ENGINE: str = "iterative"
+
+    # Memory for caching the decoded blocks of the flow direction and accumulation rasters, in MB (per process).
+    # Outlets that are close to each other then don't need to read the same part of the rasters again.
+    # Use 0 to turn off the cache, and read each window straight from the files with pysheds.
+    RASTER_CACHE_MB: int = 256
+
+    # Folder with uncompressed, memory-mapped copies of the flow direction and accumulation rasters.
+    # Make them once with: python -m py.raster_store
+    # If a raster is in this folder, we read from it instead of the GeoTIFF (and the cache above is not needed).
+    # Leave blank to always read the GeoTIFF files.
+    RASTER_STORE_DIR: str = ""
+
+    # For the delineation server, py/server.py, which keeps the basin data in memory between requests.
+    # Start it with: python -m py.server
+    # It only listens on this computer by default. The number of worker processes that delineate the outlets,
+    # and how many Level 2 basins each of them keeps in memory (each one can take a few GB).
+    SERVER_HOST: str = "127.0.0.1"
+    SERVER_PORT: int = 8080
+    SERVER_WORKERS: int = 1
+    SERVER_CACHE_BASINS: int = 2
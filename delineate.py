@@ -21,23 +21,33 @@ to download MERIT-Hydro raster data from U. of Tokyo.
 For comments or questions, please contact the author: Matthew Heberger, matt@mghydro.com
 or create an Issue on the GitHub repo: https://github.com/mheberger/delineator
 """
+import argparse
 import warnings
+import os
+
+# pysheds compiles some numba functions with parallel=True as soon as it is imported, which starts
+# numba's thread pool. The default TBB thread pool does not survive fork() for the worker processes
+# (WORKERS > 1): the main process hangs when it exits. numba's own "workqueue" pool is fork-safe.
+# This has to come before anything imports pysheds.
+# Set the environment variable NUMBA_THREADING_LAYER yourself if you want something else.
+os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
 
 import numpy as np
 import pickle
 import pandas as pd
-import os
 import geopandas as gpd
-import re
-from shapely.geometry import Point, Polygon, box
-import shapely.ops
-from shapely.wkt import loads
-import sigfig  # for formatting numbers to significant digits
-from py.fast_dissolve import dissolve_geopandas, fill_geopandas
-import pyproj
-from functools import partial
+import shapely
+from shapely.geometry import Point, box
+from py.fast_dissolve import dissolve, fill_geopandas, DISSOLVE_METHODS
+from py.metrics import geodesic_area, geodesic_area_perimeter, round_sigfig, add_metrics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from config import Config
 from py.mapper import make_map, create_folder_if_not_exists
+from py.topology import UpstreamIndex, euler_sort, is_euler_sorted, UP_FIELDS, EULER_FIELDS
+from py.scheduler import run_basins
+from py import raster_cache, basin_cache, instrument, upstream_cache, nested, arc_topology, parallel_dissolve, pyramid, \
+    area_match, comid_grid, output_writer, quantize, map_tiles
 
 # initialize the config
 conf = Config()
@@ -122,35 +132,19 @@ def validate_search_distance(conf: Config):
                         "than 0.25. In config.py, you entered {SEARCH_DIST}")
 
 
-def get_area(poly: Polygon) -> float:
-    """
-    Projects a Shapely polygon in raw lat, lng coordinates, and calculates its area
-    Argss:
-        poly: Shapely polygon
-    :return: area in km²
-    """
-    projected_poly = shapely.ops.transform(
-        partial(
-            pyproj.transform,
-            pyproj.Proj(init='EPSG:4326'),
-            pyproj.Proj(
-                proj='aea',
-                lat_1=poly.bounds[1],
-                lat_2=poly.bounds[3]
-            )
-        ),
-        poly)
-
-    # Get the area in m^2
-    return projected_poly.area / 1e6
+# The data for the Level 2 basin that we are working on: catchments, rivers and the topology index.
+# The worker processes for parallel delineation read it from here. With the "fork" start method
+# (Linux, Mac), they inherit it from the main process, so the big tables are only loaded once.
+_basin_data = {}
 
 
-def delineate(conf: Config):
+def delineate(conf: Config, outlets=None):
     """
     THIS is the Main watershed delineation routine
     Make sure to set the variables in `config.py` before running.
 
-    Reads a list of outlet points from a .csv file,
+    Reads a list of outlet points from a .csv file (or takes them from `outlets`, anything that
+    outlets_table() understands, in which case OUTLETS_CSV is not used),
     then finds their watersheds or drainage basins,
     using hybrid of vector- and raster-based methods.
 
@@ -158,118 +152,20 @@ def delineate(conf: Config):
     (shows the watershed id, names, and areas).
 
     Optionally creates an HTML page with a handy map viewer to review the results.
-    """
-
-    # Regular expression used to find numbers so I can round lat, lng coordinates in GeoJSON files to make them smaller
-    simpledec = re.compile(r"\d*\.\d+")
-
-    def mround(match):
-        # For rounding the coordinates in GeoJSON files to make them smaller
-        return "{:.5f}".format(float(match.group()))
-
-    def addnode(B, node):
-        """"
-        Recursive function to assemble the list of upstream unit catchments
-        B is a list of the unit catchments that make up our watershed.
-        List items are `comid`s, unique identifiers of each unit catchment.
-        """
-        # first, append the node to the basin
-        B.append(node)
-
-        # next, check whether the fields up1, up2, up3, and up4 contain a node ID
-        up1 = rivers_gdf['up1'].loc[node]
-        if up1 != 0:
-            addnode(B, up1)
-
-        up2 = rivers_gdf['up2'].loc[node]
-        if up2 != 0:
-            addnode(B, up2)
-
-        up3 = rivers_gdf['up3'].loc[node]
-        if up3 != 0:
-            addnode(B, up3)
-
-        up4 = rivers_gdf['up4'].loc[node]
-        if up4 != 0:
-            addnode(B, up4)
-
-    def find_close_catchment():
-        """
-        Part of my simple pour point relocation method. If the outlet falls in a unit catchment
-        whose area is a mismatch of our a priori estimate of the upstream area,
-        look around the neighborhood for a unit catchment whose area matches more closely
-        """
-        # Find the river segment that is within a bounding box around the point
-        dist = 0.01
-        max_dist = conf.MAX_DIST  # How far away can we look before we give up?
-
-        # Keep track of how many river segments were found with each increase in distance.
-        num_segments_found = [0]
-
-        iteration = 1
-        while True:
-            find_box = box(lng - dist, lat - dist, lng + dist, lat + dist)
-            possible_matches_index = list(rivers_gdf.sindex.intersection(find_box.bounds))
-            possible_matches = rivers_gdf.iloc[possible_matches_index]
-            precise_matches = possible_matches[possible_matches.intersects(find_box)]
-            segments_found = precise_matches
-            num_segments_found.append(len(segments_found.index))
-
-            # If any new segments were found on this iteration...
-            if num_segments_found[iteration] > num_segments_found[iteration - 1]:
-                # Calculate the percent difference in the area for the found river segments and the gage
-                segments_found['pd'] = ((segments_found['uparea'] - area_reported) / area_reported).abs()
-
-                # Get some info on the "best matching" river segment
-                min_pd = segments_found['pd'].min()
-
-                # Check whether they are "good enough"
-                if min_pd < conf.AREA_MATCHING_THRESHOLD:
-                    COMID = segments_found['pd'].idxmin()
-                    uparea = round(segments_found['uparea'][COMID], 0)
-                    if conf.VERBOSE:
-                        print("  (X) Found a river reach at a distance of {}, "
-                              "area difference: {:,.0f}%".format(dist, min_pd * 100))
-                    return COMID, uparea
-
-            if dist > max_dist:
-                # If we've gone out a certain radius around the gage, and still haven't found a river
-                # segment with a closely matching upstream area, raise some kind of error message.
-                print('  (!) Could not find a river segment with closely matching upstr.'
-                      ' area within %s degrees of gage' % round(dist, 2))
-
-                return None, None
-            else:
-                # Otherwise, expand the search radius and keep looking
-                dist += 0.01
-                iteration += 1
-
-    def plot_basins(suffix: str):
-        """
-        Makes a plot of the unit catchments that are in the watershed
-
-        It is all the upstream unit catchments, and the *split* terminal unit catchment.
-
-        """
-        # subbasins_gdf.plot(column='area', edgecolor='gray', legend=True)
-        [fig, ax] = plt.subplots(1, 1, figsize=(10, 8))
 
-        # Plot each unit catchment with a different color
-        for x in subbasins_gdf.index:
-            color = np.random.rand(3, )
-            subbasins_gdf.loc[[x]].plot(facecolor=color, edgecolor=color, alpha=0.5, ax=ax)
+    With REPORT = True, also writes RUN_REPORT.csv and RUN_REPORT.json with the time and memory
+    used by each stage, for each outlet and basin (see py/instrument.py).
+    """
+    instrument.enable(conf.REPORT)
+    with instrument.scope('run'):
+        _delineate(conf, outlets)
 
-        # Plot the gage point
-        gages_joined.iloc[[i]].plot(ax=ax, c='red', edgecolors='black')
+    if conf.REPORT:
+        instrument.write_report(conf, instrument.take())
 
-        if suffix == "post" and conf.HIGH_RES:
-            plt.scatter(x=lng_snap, y=lat_snap, c='cyan', edgecolors='black')
-            plt.title(f"Showing the {len(subbasins_gdf)-1} upstream unit catchments and split terminal unit catchment")
-        else:
-            plt.title(f"Found {len(subbasins_gdf)} unit catchments for watershed id = {wid}")
 
-        plt.savefig(f"plots/{wid}_vector_unit_catchments_{suffix}.png")
-        plt.close(fig)
+def _delineate(conf: Config, outlets=None):
+    # The main routine, see delineate() above
 
     # Check that the OUTPUT directories are there. If not, try to create them.
     folder_exists = create_folder_if_not_exists(conf)
@@ -288,28 +184,271 @@ def delineate(conf: Config):
         if not folder_exists:
             raise Exception("No folder for the map files. Stopping")
 
+    if conf.HIGH_RES and conf.CATCHMENT_ENGINE not in ("iterative", "pysheds"):
+        raise Exception(f"CATCHMENT_ENGINE in config.py must be 'iterative' or 'pysheds'. We got {conf.CATCHMENT_ENGINE}")
+
+    if conf.DISSOLVE_METHOD not in DISSOLVE_METHODS:
+        raise Exception(f"DISSOLVE_METHOD in config.py must be one of {DISSOLVE_METHODS}. We got {conf.DISSOLVE_METHOD}")
+
+    if conf.DISSOLVE_PARALLEL_THRESHOLD > 0 and conf.DISSOLVE_WORKERS < 1:
+        raise Exception(f"DISSOLVE_WORKERS in config.py must be at least 1. We got {conf.DISSOLVE_WORKERS}")
+
+    if conf.CACHE_FORMAT not in ("parquet", "pickle"):
+        raise Exception(f"CACHE_FORMAT in config.py must be 'parquet' or 'pickle'. We got {conf.CACHE_FORMAT}")
+
+    if conf.MAKE_MAP and conf.MAP_MODE not in ("files", "tiles"):
+        raise Exception(f"MAP_MODE in config.py must be 'files' or 'tiles'. We got {conf.MAP_MODE}")
+
+    if conf.OUTPUT_MODE not in ("files", "single"):
+        raise Exception(f"OUTPUT_MODE in config.py must be 'files' or 'single'. We got {conf.OUTPUT_MODE}")
+    single_output = conf.OUTPUT_MODE == "single" and conf.OUTPUT_EXT != ""
+    if single_output and conf.OUTPUT_EXT.lower() not in output_writer.FORMATS:
+        raise Exception(f"With OUTPUT_MODE = 'single', OUTPUT_EXT in config.py must be one of "
+                        f"{list(output_writer.FORMATS)}. We got {conf.OUTPUT_EXT}")
+
     # Check that the CSV file is there
-    if not os.path.isfile(conf.OUTLETS_CSV):
+    if outlets is None and not os.path.isfile(conf.OUTLETS_CSV):
         raise Exception(f"Could not find your outlets file at: {conf.OUTLETS_CSV}")
 
     # Read the outlet points CSV file and put into a Pandas DataFrame
     # (I call the outlet points gages, because I usually in delineated watersheds at streamflow gages)
-    if conf.VERBOSE: 
-        print(f"Reading your outlets data in: {conf.OUTLETS_CSV}")
-    gages_df = pd.read_csv(conf.OUTLETS_CSV, header=0, dtype={'id': 'str', 'lat': 'float', 'lng': 'float'})
+    with instrument.stage('read_outlets'):
+        if outlets is not None:
+            gages_df = outlets_table(outlets)
+        else:
+            if conf.VERBOSE:
+                print(f"Reading your outlets data in: {conf.OUTLETS_CSV}")
+            gages_df = pd.read_csv(conf.OUTLETS_CSV, header=0, dtype={'id': 'str', 'lat': 'float', 'lng': 'float'})
 
-    # Check that the CSV file includes at a minimum: id, lat, lng and that all values are appropriate
-    validate(gages_df)
+        # Check that the CSV file includes at a minimum: id, lat, lng and that all values are appropriate,
+        # and add the fields we need
+        gages_df, points_gdf = prepare_outlets(conf, gages_df)
 
     # Get the number of points, for status messages
     n_gages = len(gages_df)
 
-    # Boolean vars to track whether user's outlets file had fields `area` and/or `name`
-    bAreas = 'area' in gages_df
-    bNames = 'name' in gages_df
+    # Needed to set this option in order to avoid a warning message in Geopandas.
+    # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
+    pd.options.mode.chained_assignment = None  # default='warn'
+
+    if conf.VERBOSE: 
+        print("Finding out which Level 2 megabasin(s) your points are in")
+    # Keep a record of gages for which we could not find a matching river segment.
+    # Dict failed: key = id, value = string, explanation of failure
+    with instrument.stage('megabasin_sjoin'):
+        gages_basins_join, failed = match_basins(conf, gages_df, points_gdf, read_megabasins(conf))
+
+    # Get a list of the DISTINCT Level 2 basins, and a count of how many gages in each.
+    basins_df = gages_basins_join.groupby("BASIN").id.nunique()
+    basins = basins_df.index.tolist()
+
+    if conf.VERBOSE: 
+        print(f"Your watershed outlets are in {len(basins)} basin(s)")
+
+    # Make a list of jobs, one per basin, so that we only have
+    # to open up each Level 2 Basin shapefile once, and handle all of the gages in it
+    jobs = []
+    gages_counter = 0
+    for basin in basins:
+        # mmaelicke: I am not why this happens or where this comes from, but for some 
+        # of my inputs ie. on megabasin 11 or 12, basin in a float. Then, load_gdf does not work.
+        basin = int(basin)
+        
+        # Create a dataframe of the gages_basins_join in that basins
+        gages_in_basin = gages_basins_join[gages_basins_join["BASIN"] == basin]
+        jobs.append((basin, (conf, basin, gages_in_basin, gages_df, gages_counter, n_gages)))
+        gages_counter += len(gages_in_basin)
+
+    # With OUTPUT_MODE = "single", the watersheds go to one file, written in the background as we go
+    if single_output:
+        output_writer.start(conf)
+
+    try:
+        # Run the basins one at a time, or several at once if there is enough memory for them
+        if conf.BASIN_WORKERS > 1 and len(jobs) > 1:
+            basin_results = run_basins(conf, jobs, _run_basin)
+        else:
+            basin_results = [_run_basin(*args) for _, args in jobs]
+
+        # Copy the results for each watershed into the output table
+        network_rows = []
+        incremental = []
+        map_data = []
+        all_records = []
+        for records, basin_failed, report in basin_results:
+            # The watersheds from the basins that ran in processes of their own
+            output_writer.put_records(records)
+            for record in records:
+                if 'network' in record:
+                    network_rows.append(record.pop('network'))
+                    incremental.append(record.pop('incremental'))
+                if 'map' in record:
+                    map_data.append(record.pop('map'))
+                all_records.append(record)
+            failed.update(basin_failed)
+            instrument.extend(report)
+    finally:
+        # Close the file even if a basin failed, so the watersheds we already wrote can still be read
+        if single_output:
+            with instrument.stage('write_output'):
+                output_writer.finish(conf)
+
+    # The snap distances and the percent differences in area, for all of the watersheds at once
+    if all_records:
+        with instrument.stage('metrics'):
+            add_metrics(gages_df, pd.DataFrame(all_records).set_index('id'))
+
+    # CREATE OUTPUT.CSV, a data table of the outputs
+    # id, status (hi, low, failed), name, area_reported, area_calculated
+    if conf.OUTPUT_CSV:
+        output_csv_filename = f"{conf.OUTPUT_DIR}/OUTPUT.csv"
+        with instrument.stage('write_output_csv'):
+            gages_df.to_csv(output_csv_filename)
+
+    # For a nested network of gages, GAUGE_NETWORK.csv and the incremental areas
+    if conf.NESTED:
+        nested.write_network(conf, network_rows, incremental)
+
+    # FAILED.csv: If there were any failures, write this to a separate CSV file
+    if len(failed) > 0:
+        print(f"### FAILED to find watersheds for {len(failed)} locations. Check FAILED.csv for info.")
+
+        failfile = f"{conf.OUTPUT_DIR}/FAILED.csv"
+        with open(failfile, 'w') as f:
+            f.write("ID, EXPLANATION\n")
+            for k, v in failed.items():
+                f.write(f'{k},"{v}"\n')
+
+    # If the user wants the browser map, make it
+    if conf.MAKE_MAP:
+        if conf.VERBOSE: 
+            print("* Creating viewer.html *")
+        with instrument.stage('write_map'):
+            make_map(config=conf, df=gages_df, map_data=map_data)
+
+    # Finished, print a little status message
+    if conf.VERBOSE: 
+        print(f"It's over! See results in {output_csv_filename}")
+
+
+def outlets_table(outlets) -> pd.DataFrame:
+    """
+    Makes a table of outlets like the outlets CSV file (id, lat, lng, and maybe name and area) from:
+        - a DataFrame with those columns,
+        - a GeoDataFrame of points, in any projection. Without an 'id' column, we use its index,
+        - or a dict of lists or arrays, e.g. {'id': ids, 'lat': lats, 'lng': lngs, 'area': areas}
+    """
+    if isinstance(outlets, gpd.GeoDataFrame):
+        points = outlets.geometry if outlets.crs is None else outlets.geometry.to_crs(PROJ_WGS84)
+        gages_df = pd.DataFrame({
+            'id': outlets['id'] if 'id' in outlets else outlets.index,
+            'lat': points.y,
+            'lng': points.x,
+        })
+        for field in ['name', 'area']:
+            if field in outlets:
+                gages_df[field] = outlets[field]
+    else:
+        gages_df = pd.DataFrame(outlets)
+        for field in ['lat', 'lng']:
+            if field in gages_df:
+                gages_df[field] = pd.to_numeric(gages_df[field]).astype(float)
+
+    if 'id' in gages_df:
+        gages_df['id'] = gages_df['id'].astype(str)
+    return gages_df.reset_index(drop=True)
+
+
+def in_memory_config(conf: Config) -> Config:
+    """
+    The same settings, but without writing any files: no watershed files, no map, plots or report.
+    With OUTPUT_MODE = "single" and no writer running, write_watershed() sends back the watershed with its
+    results instead of writing it (see py/output_writer.py).
+    """
+    return conf.model_copy(update={
+        'OUTPUT_MODE': "single",
+        'OUTPUT_EXT': "gpkg",
+        'OUTPUT_CSV': False,
+        'MAKE_MAP': False,
+        'PLOTS': False,
+        'REPORT': False,
+        'NESTED': False,
+    })
+
+
+# The Level 2 basins for delineate_watersheds(), so we only read them once. Key = MERIT_BASINS_SHP
+_megabasins = {}
+
+
+def delineate_watersheds(outlets, conf: Config = None, basin_data: dict = None) -> (gpd.GeoDataFrame, pd.DataFrame):
+    """
+    Delineates the watersheds for some outlets, all in memory: no outlets CSV file, and no output files.
+    For using the delineator from your own Python code, e.g.
+
+        from delineate import delineate_watersheds
+        watersheds, status = delineate_watersheds({'id': ids, 'lat': lats, 'lng': lngs})
+
+    Args:
+        outlets: a DataFrame, a GeoDataFrame of points, or a dict of arrays with id, lat, lng, and maybe
+            name and area, see outlets_table()
+        conf: the settings, like config.py (the default). We don't write any files, whatever they say.
+        basin_data: the data for the Level 2 basins from load_basin(), key = basin code. We use the basins
+            that are in here, and add the ones that we have to load, so if you give us the same dict
+            the next time, we don't have to load them again.
+
+    Returns:
+        watersheds: a GeoDataFrame with a watershed for each outlet that worked, indexed by id, with the same
+            fields as OUTPUT.csv
+        status: the table of all of the outlets, like OUTPUT.csv, plus the column 'explanation' with the
+            reason for each one that failed (like FAILED.csv)
+    """
+    conf = in_memory_config(conf or Config())
+    if basin_data is None:
+        basin_data = {}
+    instrument.enable(False)
+
+    # Like delineate(), but only while we run: the program that called us may want the warnings
+    with pd.option_context('mode.chained_assignment', None):
+        gages_df, points_gdf = prepare_outlets(conf, outlets_table(outlets))
+        if conf.MERIT_BASINS_SHP not in _megabasins:
+            _megabasins[conf.MERIT_BASINS_SHP] = read_megabasins(conf)
+        matched, failed = match_basins(conf, gages_df, points_gdf, _megabasins[conf.MERIT_BASINS_SHP])
+
+        records = []
+        gages_counter = 0
+        for basin, gages_in_basin in matched.groupby('BASIN'):
+            basin = int(basin)
+            if basin not in basin_data:
+                basin_data[basin] = load_basin(conf, basin, lazy=conf.LAZY_LOAD)
+            basin_records, basin_failed = delineate_basin(conf, basin, gages_in_basin, gages_df, gages_counter,
+                                                          len(gages_df), data=basin_data[basin])
+            records.extend(basin_records)
+            failed.update(basin_failed)
+            gages_counter += len(gages_in_basin)
+
+        # With LAZY_LOAD, the data only has what we needed for these outlets, so we can't keep it for next time
+        for basin in [b for b, data in basin_data.items() if data['lazy']]:
+            del basin_data[basin]
+
+        geometry = [record.pop('feature')['geometry'] for record in records]
+        ids = [record['id'] for record in records]
+        if records:
+            add_metrics(gages_df, pd.DataFrame(records).set_index('id'))
+        watersheds = gpd.GeoDataFrame(gages_df.loc[ids], geometry=geometry, crs=PROJ_WGS84)
+        status = gages_df.copy()
+        status['explanation'] = pd.Series(failed, dtype=object)
+        return watersheds, status
+
+
+def prepare_outlets(conf: Config, gages_df: pd.DataFrame) -> (pd.DataFrame, gpd.GeoDataFrame):
+    """
+    Checks the table of outlets (id, lat, lng, and maybe name and area), and adds the fields we need.
+    Returns the table, and the outlets as points in a GeoDataFrame.
+    """
+    validate(gages_df)
 
     # Add some extra fields to the gages dataframe
-    if bAreas:
+    if 'area' in gages_df:
         gages_df['area_reported'] = pd.to_numeric(gages_df['area'])
         gages_df.drop(['area'], axis=1, inplace=True)
 
@@ -327,9 +466,11 @@ def delineate(conf: Config):
     # Since we don't want or need this, drop the column.
     # No longer needed with GeoPandas v 0.14
     #gages_df.drop(['geometry'], axis=1, inplace=True)
+    return gages_df, points_gdf
 
-    if conf.VERBOSE: 
-        print("Finding out which Level 2 megabasin(s) your points are in")
+
+def read_megabasins(conf: Config) -> gpd.GeoDataFrame:
+    """Reads the Level 2 basins (MERIT_BASINS_SHP)."""
     # This file has the merged "megabasins_gdf" in it
     #merit_basins_shp = 'data/shp/basins_level2/merit_hydro_vect_level2.shp'
     megabasins_gdf = gpd.read_file(conf.MERIT_BASINS_SHP)
@@ -337,84 +478,253 @@ def delineate(conf: Config):
     megabasins_gdf.to_crs(PROJ_WGS84, inplace=True)
     if not megabasins_gdf.loc[0].BASIN == 11:
         raise Exception("An error occurred loading the Level 2 basins shapefile")
+    return megabasins_gdf
 
+
+def find_basins(conf: Config, points_gdf: gpd.GeoDataFrame, megabasins_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Finds out which Level 2 basin each outlet is in. Returns the outlets with the field BASIN
+    (NaN for the outlets that are not in any of them).
+    """
     # Overlay the gage points on the Level 2 Basins polygons to find out which
     # PFAF_2 basin each point falls inside of, using a spatial join
     if conf.SEARCH_DIST == 0:
-        gages_basins_join = gpd.sjoin(points_gdf, megabasins_gdf, how="left", predicate='intersects')
+        return gpd.sjoin(points_gdf, megabasins_gdf, how="left", predicate='intersects')
 
-    else:
-        # Better results obtained with a "nearest shape"
-        # This line generates a warning about how its bad to use distances in unprojected geodata. OK
-        with warnings.catch_warnings():
-            warnings.simplefilter(action='ignore', category=UserWarning)
-            gages_basins_join = gpd.sjoin_nearest(points_gdf, megabasins_gdf, how='left', max_distance=conf.SEARCH_DIST)
+    # Better results obtained with a "nearest shape"
+    # This line generates a warning about how its bad to use distances in unprojected geodata. OK
+    with warnings.catch_warnings():
+        warnings.simplefilter(action='ignore', category=UserWarning)
+        return gpd.sjoin_nearest(points_gdf, megabasins_gdf, how='left', max_distance=conf.SEARCH_DIST)
 
-    # Needed to set this option in order to avoid a warning message in Geopandas.
-    # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
-    pd.options.mode.chained_assignment = None  # default='warn'
 
-    # Keep a record of gages for which we could not find a matching river segment.
-    # Dict failed: key = id, value = string, explanation of failure
+def match_basins(conf: Config, gages_df: pd.DataFrame, points_gdf: gpd.GeoDataFrame,
+                 megabasins_gdf: gpd.GeoDataFrame) -> (gpd.GeoDataFrame, dict):
+    """
+    Finds out which Level 2 basin each outlet is in (see find_basins()), and turns gages_df into the output table
+    (see init_output_table()). Returns the outlets that are in a basin, with the field BASIN, and a dict with the
+    ones that are not, key = id, value = the explanation of the failure.
+    """
+    gages_basins_join = find_basins(conf, points_gdf, megabasins_gdf)
+    matched = gages_basins_join.dropna(subset=['BASIN'])
+    matched_ids = set(matched['id'])
     failed = {}
-
-    # Get a list of the DISTINCT Level 2 basins, and a count of how many gages in each.
-    basins_df = gages_basins_join.groupby("BASIN").id.nunique()
-    basins = basins_df.index.tolist()
-
-    if conf.VERBOSE: 
-        print(f"Your watershed outlets are in {len(basins)} basin(s)")
-
-    # Find any outlet points that are not in any Level 2 basin, and add these to the fail list
-    # Look for any rows that are in gages_df that are not in basins_df
-    matched_ids = gages_basins_join['id'].tolist()
-    ids = gages_df['id'].tolist()
-    for wid in ids:
+    for wid in gages_df['id']:
         if wid not in matched_ids:
             failed[wid] = "Point not located in any Level 2 basin."
 
     # Now add fields to gages_df so we can reuse it to create a table to output to CSV
+    init_output_table(gages_df)
+    return matched, failed
+
+
+def init_output_table(gages_df: pd.DataFrame) -> pd.DataFrame:
+    """Turns the table of outlets into the output table (OUTPUT.csv), indexed by id, before we have any results."""
     gages_df.set_index('id', inplace=True)
     gages_df['area_calc'] = 0
     gages_df['result'] = "failed"
-    if bAreas:
+    if 'area_reported' in gages_df:
         gages_df['perc_diff'] = 0
+    return gages_df
 
-    gages_counter = 0
 
-    # Iterate over the basins so that we only have
-    # to open up each Level 2 Basin shapefile once, and handle all of the gages in it
-    for basin in basins:
-        # mmaelicke: I am not why this happens or where this comes from, but for some 
-        # of my inputs ie. on megabasin 11 or 12, basin in a float. Then, load_gdf does not work.
-        basin = int(basin)
-        
-        # Create a dataframe of the gages_basins_join in that basins
-        gages_in_basin = gages_basins_join[gages_basins_join["BASIN"] == basin]
-        num_gages_in_basin = len(gages_in_basin)
-        if conf.VERBOSE: 
-            print("\nBeginning delineation for %s outlet point(s) in Level 2 Basin #%s." % (num_gages_in_basin, basin))
+# With LAZY_LOAD, the columns of the rivers table that we load up front: the river network, and the upstream area
+RIVER_NETWORK_COLUMNS = UP_FIELDS + EULER_FIELDS + ['uparea']
 
-        if conf.HIGH_RES:
-            catchments_gdf = load_gdf(conf, "catchments", basin, True)
-            catchments_lowres_gdf = None
-        else:
-            catchments_gdf = load_gdf(conf, "catchments", basin, False)
 
-        # The network data is in the RIVERS file rather than the CATCHMENTS file
-        # (this is just how the MeritBASIS authors did it)
-        if conf.VERBOSE: 
-            print('Reading data table for rivers in basin %s' % basin)
-        rivers_gdf = load_gdf(conf, "rivers", basin, True)
+def load_basin(conf: Config, basin: int, lazy: bool = False) -> dict:
+    """
+    Loads the data we need to delineate watersheds in one Level 2 basin.
+
+    With lazy = True (LAZY_LOAD in config.py), we only load the river network here, without any geometries.
+    Once we know which unit catchments the outlets are in, load_upstream() loads the geometries that we need.
+
+    Returns a dict with the keys:
+        rivers: the MERIT-Basins rivers GeoDataFrame (has the network data)
+        catchments: the unit catchment polygons, high- or low-resolution depending on HIGH_RES
+            (None until load_upstream() with lazy = True)
+        catchments_lowres: the low-resolution unit catchments, or None until they are needed
+        topology: the UpstreamIndex for the river network
+        arcs: the ArcTopology of the unit catchments (see py/arc_topology.py), or None if ARC_TOPOLOGY is off
+        pyramid: the pyramid polygons for low-res watersheds (see py/pyramid.py), or None until they are needed
+        comid_grid: the raster of the unit catchments (see py/comid_grid.py), or None if COMID_GRID is off
+        lazy: True if we only have the unit catchments (and river geometries) upstream of the outlets
+    """
+    if lazy and (conf.PICKLE_DIR == '' or conf.CACHE_FORMAT != 'parquet'):
+        # Without the GeoParquet files, every lazy read would read the whole shapefile again
+        raise Exception("LAZY_LOAD in config.py needs the GeoParquet cache: set PICKLE_DIR, "
+                        "and CACHE_FORMAT = 'parquet'")
+
+    # The network data is in the RIVERS file rather than the CATCHMENTS file
+    # (this is just how the MeritBASIS authors did it)
+    # We load it first, because the catchments are stored in the same (Euler tour) order as the rivers
+    if conf.VERBOSE: 
+        print('Reading data table for rivers in basin %s' % basin)
+    with instrument.stage('load_gdf/rivers'):
+        rivers_gdf = load_gdf(conf, "rivers", basin, True, columns=RIVER_NETWORK_COLUMNS if lazy else None)
+
+    catchments_gdf = None
+    if not lazy:
+        with instrument.stage('load_gdf/catchments'):
+            if conf.HIGH_RES:
+                catchments_gdf = load_gdf(conf, "catchments", basin, True, rivers_gdf=rivers_gdf)
+            else:
+                catchments_gdf = load_gdf(conf, "catchments", basin, False, rivers_gdf=rivers_gdf)
+
+    # Build the upstream topology index for the river network, once per basin
+    with instrument.stage('topology_index'):
+        topo = UpstreamIndex.from_rivers(rivers_gdf)
+
+    data = {
+        'rivers': rivers_gdf,
+        'catchments': catchments_gdf,
+        'catchments_lowres': None,
+        'topology': topo,
+        'arcs': None,
+        'pyramid': None,
+        'comid_grid': None,
+        'lazy': lazy,
+    }
+
+    if conf.ARC_TOPOLOGY and conf.HIGH_RES:
+        with instrument.stage('arc_topology'):
+            data['arcs'] = arc_topology.load(conf, basin, whole_basin(conf, basin, data, True,
+                                                                      [arc_topology.get_filename(conf, basin)]), topo)
+
+    if conf.COMID_GRID:
+        with instrument.stage('comid_grid'):
+            # Always from the high-res unit catchments, which are made of whole pixels
+            data['comid_grid'] = comid_grid.load(conf, basin, whole_basin(conf, basin, data, True,
+                                                                          comid_grid.get_filenames(conf, basin)))
+
+    if not conf.HIGH_RES and not lazy:
+        load_pyramid(conf, basin, data)
+    return data
+
+
+def outlets_bbox(points_gdf: gpd.GeoDataFrame, margin: float) -> tuple:
+    """The bounding box of the outlet points, plus a margin (in degrees) on each side."""
+    xmin, ymin, xmax, ymax = points_gdf.total_bounds
+    return xmin - margin, ymin - margin, xmax + margin, ymax + margin
+
+
+def whole_basin(conf: Config, basin: int, data: dict, high_res: bool, fnames: list) -> gpd.GeoDataFrame or None:
+    """
+    All of the unit catchments in the basin, for building the files `fnames` in PICKLE_DIR that cover the whole basin
+    (the arcs, the COMID raster and the pyramid). Without LAZY_LOAD, we usually have them already. With LAZY_LOAD
+    (or at the other resolution), we load all of them, but only if the files are not there yet.
+    """
+    if not data['lazy']:
+        catchments_gdf = data['catchments'] if high_res == conf.HIGH_RES else data['catchments_lowres']
+        if catchments_gdf is not None:
+            return catchments_gdf
+    if conf.PICKLE_DIR != '' and all(os.path.isfile(fname) for fname in fnames):
+        return None
+    with instrument.stage('load_gdf/whole_basin'):
+        return load_gdf(conf, "catchments", basin, high_res, rivers_gdf=data['rivers'], columns=['geometry'])
 
-        # Perform a Spatial join on gages (points) and unit catchments (polygons)
-        # to find the corresponding unit catchment for each gage
-        # Adds the fields COMID and unitarea
-        if conf.VERBOSE: 
-            print(f"Performing spatial join on {num_gages_in_basin} outlet points in basin #{basin}")
-        gages_in_basin.drop(['index_right'], axis=1, inplace=True)
-        validate_search_distance(conf=conf)
-        if conf.SEARCH_DIST == 0:
+
+def load_upstream(conf: Config, basin: int, data: dict, outlets: list):
+    """
+    With LAZY_LOAD: loads the geometries of the unit catchments and river reaches upstream of the outlets,
+    and nothing else, from the GeoParquet files in PICKLE_DIR (see py/basin_cache.py).
+    In high-res mode, the watersheds bigger than LOW_RES_THRESHOLD get low-res unit catchments instead.
+    """
+    topo = data['topology']
+    rivers_gdf = data['rivers']
+
+    # The terminal unit catchment of each outlet, after we looked for a better one with MATCH_AREAS
+    terminal = []
+    for outlet in outlets:
+        match = outlet.get('match')
+        terminal.append(match[0] if match is not None and match[0] >= 0 else outlet['terminal_comid'])
+    terminal = pd.to_numeric(pd.Series(terminal, dtype=float)).dropna().astype(np.int64).to_numpy()
+    rows = topo._lookup(terminal)
+    rows = rows[rows >= 0]
+
+    lowres = np.zeros(len(rows), dtype=bool)
+    if conf.HIGH_RES and not conf.NESTED:
+        lowres = rivers_gdf['uparea'].to_numpy()[rows] > conf.LOW_RES_THRESHOLD
+
+    upstream = topo.comids[topo.upstream_of_any(rows)]
+    with instrument.stage('load_gdf/catchments'):
+        data['catchments'] = load_gdf(conf, "catchments", basin, conf.HIGH_RES, rivers_gdf=rivers_gdf,
+                                      comids=topo.comids[topo.upstream_of_any(rows[~lowres])])
+        if lowres.any():
+            data['catchments_lowres'] = load_gdf(conf, "catchments", basin, False, rivers_gdf=rivers_gdf,
+                                                 columns=['geometry'],
+                                                 comids=topo.comids[topo.upstream_of_any(rows[lowres])])
+
+    # The river reaches keep all of the rows, for the network, but only the ones upstream of the outlets
+    # get their geometries (for snapping the outlets in low-res mode, and for the map)
+    with instrument.stage('load_gdf/rivers'):
+        geoms = load_gdf(conf, "rivers", basin, True, columns=['lengthkm', 'order', 'geometry'], comids=upstream)
+        data['rivers'] = gpd.GeoDataFrame(rivers_gdf.join(geoms), geometry='geometry', crs=geoms.crs)
+
+    if lowres.any() or not conf.HIGH_RES:
+        load_pyramid(conf, basin, data)
+
+
+def lowres_catchments(conf: Config, data: dict) -> gpd.GeoDataFrame:
+    """The low-resolution unit catchments. (With HIGH_RES = False, those are the only ones we load.)"""
+    return data['catchments'] if not conf.HIGH_RES else data['catchments_lowres']
+
+
+def load_pyramid(conf: Config, basin: int, data: dict):
+    """With PYRAMID = True, loads (or builds) the pyramid polygons for the low-res watersheds, see py/pyramid.py"""
+    if conf.PYRAMID and data['pyramid'] is None:
+        with instrument.stage('pyramid'):
+            catchments_gdf = whole_basin(conf, basin, data, False, [pyramid.get_filename(conf, basin)])
+            data['pyramid'] = pyramid.load(conf, basin, data['topology'], data['rivers'], catchments_gdf)
+
+
+def delineate_basin(conf: Config, basin: int, gages_in_basin: gpd.GeoDataFrame, gages_df: pd.DataFrame,
+                    counter_start: int = 0, n_gages: int = None, data: dict = None) -> (list, dict):
+    """
+    Delineates the watersheds for all of the outlets in one Level 2 basin.
+
+    Args:
+        basin: the Pfafstetter Level 2 basin code
+        gages_in_basin: the outlet points in this basin (from the spatial join with the Level 2 basins)
+        gages_df: the table of all outlets, indexed by id (we read the name and reported area from it)
+        counter_start, n_gages: only for the status messages
+        data: the basin data from load_basin(), if we already have it (e.g. in py/server.py).
+            Otherwise, we load it here.
+
+    Returns:
+        records: a list of dicts, one per successful watershed, in the same order as `gages_in_basin`,
+            with the 'id' and the fields to update in the output table
+        failed: dict of the outlets we could not delineate; key = id, value = explanation
+    """
+    failed = {}
+    num_gages_in_basin = len(gages_in_basin)
+    if conf.VERBOSE: 
+        print("\nBeginning delineation for %s outlet point(s) in Level 2 Basin #%s." % (num_gages_in_basin, basin))
+
+    if data is None:
+        data = load_basin(conf, basin, lazy=conf.LAZY_LOAD)
+    catchments_gdf = data['catchments']
+    rivers_gdf = data['rivers']
+
+    # Perform a Spatial join on gages (points) and unit catchments (polygons)
+    # to find the corresponding unit catchment for each gage
+    # Adds the fields COMID and unitarea
+    if conf.VERBOSE: 
+        print(f"Performing spatial join on {num_gages_in_basin} outlet points in basin #{basin}")
+    gages_in_basin = gages_in_basin.drop(['index_right'], axis=1)
+    validate_search_distance(conf=conf)
+    with instrument.stage('catchment_sjoin'):
+        if data['comid_grid'] is None and catchments_gdf is None:
+            # With LAZY_LOAD, we only need the unit catchments around the outlets for the spatial join
+            catchments_gdf = load_gdf(conf, "catchments", basin, conf.HIGH_RES, rivers_gdf=rivers_gdf,
+                                      columns=['geometry'], bbox=outlets_bbox(gages_in_basin, conf.SEARCH_DIST))
+
+        if data['comid_grid'] is not None:
+            # Look up the pixel of each outlet in the raster of the unit catchments, instead of the polygons
+            comids = data['comid_grid'].lookup(gages_in_basin['lat'], gages_in_basin['lng'], conf.SEARCH_DIST)
+            gages_joined = gages_in_basin[comids > 0].copy()
+            gages_joined['COMID'] = comids[comids > 0]
+        elif conf.SEARCH_DIST == 0:
             gages_joined = gpd.sjoin(gages_in_basin, catchments_gdf, how="left", predicate="intersects")
         else:
             # This line generates a warning about how its bad to use distances in unprojected geodata. OK
@@ -422,236 +732,681 @@ def delineate(conf: Config):
                 warnings.simplefilter(action='ignore', category=UserWarning)
                 gages_joined = gpd.sjoin_nearest(gages_in_basin, catchments_gdf, max_distance=conf.SEARCH_DIST)
 
-        gages_joined.rename(columns={"index_right": "COMID"}, inplace=True)
+    gages_joined.rename(columns={"index_right": "COMID"}, inplace=True)
 
-        # For any gages for which we could not find a unit catchment, add them to failed
-        gages_matched = gages_joined['id'].tolist()
-        gage_basin_ids = gages_in_basin['id'].tolist()
-        for wid in gage_basin_ids:
-            if wid not in gages_matched:
-                failed[wid] = f"Could not assign to a unit catchment in Level 2 basin #{basin}"
+    # For any gages for which we could not find a unit catchment, add them to failed
+    gages_matched = gages_joined['id'].tolist()
+    gage_basin_ids = gages_in_basin['id'].tolist()
+    for wid in gage_basin_ids:
+        if wid not in gages_matched:
+            failed[wid] = f"Could not assign to a unit catchment in Level 2 basin #{basin}"
 
-        # Revise the number of gages in the basin, based on those which have a matching COMID
-        num_gages_in_basin = len(gages_joined)
+    # Put together what we need to know about each outlet in a list of little dicts.
+    # This is what gets sent to the worker processes.
+    bAreas = 'area_reported' in gages_df
+    bNames = 'name' in gages_df
+    outlets = []
+    for i in range(0, len(gages_joined)):
+        wid = gages_joined['id'].iloc[i]
+        outlet = {
+            'id': wid,
+            'lat': gages_joined['lat'].iloc[i],
+            'lng': gages_joined['lng'].iloc[i],
+            # The terminal comid is the unit catchment that contains (overlaps) the outlet point
+            'terminal_comid': gages_joined['COMID'].iloc[i],
+            'counter': counter_start + i + 1,
+            'n_gages': n_gages or num_gages_in_basin,
+        }
+        if bAreas:
+            outlet['area_reported'] = gages_df.loc[wid, 'area_reported']
+        if bNames:
+            outlet['name'] = gages_df.loc[wid, 'name']
+        outlets.append(outlet)
+
+    # With MATCH_AREAS, look for better river reaches for all of the outlets that need them at once
+    if bAreas and conf.MATCH_AREAS and len(outlets) > 0:
+        with instrument.stage('area_match'):
+            nearby_rivers = None
+            if data['lazy']:
+                # We only have the river network so far, without the geometries. Load the ones around the outlets.
+                nearby_rivers = load_gdf(conf, "rivers", basin, True, columns=['uparea', 'geometry'],
+                                         bbox=outlets_bbox(gages_joined, conf.MAX_DIST + 2 * area_match.STEP))
+            match_areas(conf, rivers_gdf, outlets, nearby_rivers)
+
+    if data['lazy'] and len(outlets) > 0:
+        # Now we know which unit catchments we need
+        load_upstream(conf, basin, data, outlets)
+    elif conf.HIGH_RES and len(outlets) > 0 and not conf.NESTED:
+        # In high-res mode, if we already know that some of the watersheds will be too big, load
+        # the low-res unit catchments now, so the worker processes don't each have to load them.
+        up_areas = rivers_gdf['uparea'].reindex([o['terminal_comid'] for o in outlets])
+        if (up_areas > conf.LOW_RES_THRESHOLD).any():
+            with instrument.stage('load_gdf/catchments_lowres'):
+                data['catchments_lowres'] = load_gdf(conf, "catchments", basin, False, rivers_gdf=rivers_gdf,
+                                                     columns=['geometry'])
+            load_pyramid(conf, basin, data)
+
+    _basin_data.clear()
+    _basin_data[basin] = data
+
+    # With the upstream polygon cache, do the outlets that are furthest upstream first,
+    # so the ones downstream of them can reuse their polygons
+    use_cache = conf.UPSTREAM_CACHE_MB > 0 and not conf.NESTED
+    if use_cache:
+        order = upstream_cache.outlet_order(data['topology'], outlets)
+        outlets = [outlets[k] for k in order]
+        # Start with the polygons we saved last time (if any). The worker processes get a copy.
+        upstream_cache.get_cache(conf, basin, data['topology'])
+
+    # Iterate over the gages and assemble the watersheds, either here or in a pool of worker processes
+    with instrument.stage('outlets'):
+        if conf.NESTED:
+            results, cache_counts, report, polygons = delineate_network(conf, basin, outlets, data)
+        elif conf.WORKERS > 1 and len(outlets) > 1:
+            results, cache_counts, report, polygons = _delineate_parallel(conf, basin, outlets)
+        else:
+            results, cache_counts, report, polygons = _delineate_chunk(conf, basin, outlets, data)
+    instrument.extend(report)
+    instrument.annotate(**cache_counts)
+
+    if use_cache:
+        # Back to the original order of the outlets
+        results = [results[k] for k in np.argsort(order)]
+        if conf.UPSTREAM_CACHE_PERSIST and conf.PICKLE_DIR != '':
+            upstream_cache.save(conf, basin, polygons)
+
+    if conf.VERBOSE and conf.HIGH_RES and conf.RASTER_CACHE_MB > 0:
+        print(f"Raster block cache for basin {basin}: {cache_counts['hits']:,} hits, "
+              f"{cache_counts['misses']:,} misses, {cache_counts['evictions']:,} evictions")
+
+    records = []
+    for result in results:
+        if 'failed' in result:
+            failed[result['id']] = result['failed']
+        else:
+            records.append(result)
 
-        # Iterate over the gages and assemble the watershed
-        for i in range(0, num_gages_in_basin):
-            gages_counter += 1
-            if conf.VERBOSE: 
-                print(f"\n* Delineating watershed {gages_counter} of {n_gages}, with outlet id = {wid}")
+    return records, failed
 
-            # Reset the local boolean flag for high-res mode. If the watershed is too big, script will switch to low.
-            bool_high_res = conf.HIGH_RES
 
-            # Let wid be the watershed ID. Get the lat, lng coords of the gage.
-            wid = gages_joined['id'].iloc[i]
-            lat = gages_joined['lat'].iloc[i]
-            lng = gages_joined['lng'].iloc[i]
+def _run_basin(conf: Config, basin: int, *args) -> (list, dict, list):
+    # Runs delineate_basin(), maybe in a process of its own, and also sends back the timing records
+    instrument.enable(conf.REPORT)
+    mark = instrument.mark()
+    with instrument.scope('basin', basin=basin):
+        records, failed = delineate_basin(conf, basin, *args)
+    return records, failed, instrument.take(mark)
 
-            # The terminal comid is the unit catchment that contains (overlaps) the outlet point
-            terminal_comid = gages_joined['COMID'].iloc[i]
-
-            # Get the upstream area of the unit catchment we found, according to MERIT-Basins
-            up_area = rivers_gdf.loc[terminal_comid].uparea
-
-            # If MATCH_AREAS is True and the user provided the area in the outlets CSV file,
-            # the script will check whether the upstream area of the unit catchment is a good match.
-            # If the areas do not match well, look around the neighborhood for another unit catchment
-            # whose area is a closer match to what we think it is.
-            if bAreas and conf.MATCH_AREAS:
-                area_reported = gages_df.loc[wid].area_reported
-                PD_area = abs((area_reported - up_area) / area_reported)
-                if PD_area > conf.AREA_MATCHING_THRESHOLD:
-                    if conf.VERBOSE:
-                        print("Outlet point is in a unit catchment whose area is not a close match.")
-                        print("Searching neighborhood for a river reach with a more closely matching upstream area")
-                    candidate_comid, up_area = find_close_catchment()
-                    if candidate_comid is None:
-                        failed[wid] = "Could not find a nearby river reach whose upstream area is " \
-                                      "within {}% of reported area of {:,.0f} km²" \
-                            .format(conf.AREA_MATCHING_THRESHOLD * 100, area_reported)
-                        continue
-                    else:
-                        terminal_comid = candidate_comid
-
-            # Let B be the list of unit catchments (and river reaches) that are in the basin
-            B = []
-
-            # Add the first node, and the rest will be added recursively
-            addnode(B, terminal_comid)
-            if conf.VERBOSE: 
-                print(f"  found {len(B)} unit catchments in the watershed")
-
-            # If the watershed is too big, revert to low-precision mode.
-            if conf.HIGH_RES and up_area > conf.LOW_RES_THRESHOLD:
-                if conf.VERBOSE: 
-                    print(f"Watershed for id = {wid} is larger than LOW_RES_THRESHOLD = {conf.LOW_RES_THRESHOLD}. "
-                        "SWITCHING TO LOW-RESOLUTION MODE.")
-                bool_high_res = False
-                # If we just flipped to low-res mode, check if the low-res unit catchment polygons are loaded.
-                if catchments_lowres_gdf is None:
-                    catchments_lowres_gdf = load_gdf(conf, "catchments", basin, False)
-
-                subbasins_gdf = catchments_lowres_gdf.loc[B]
-            else:
-                # Create a new geodataframe containing only the unit catchments_gdf that are in the list B
-                # In high precision mode, we will update the geometry of the terminal unit catchment.
-                subbasins_gdf = catchments_gdf.loc[B]
-
-            # Make a plot of the selected unit catchments
-            if conf.PLOTS:
-                plot_basins("pre")
-
-            # In detailed mode,
-            if bool_high_res:
-                if conf.VERBOSE: 
-                    print("Performing detailed raster-based delineation for the downstream portion of the watershed")
-                
-                # Let split_catchment_poly be the polygon of the terminal unit catchment
-                assert terminal_comid == B[0]
-                catchment_poly = subbasins_gdf.loc[terminal_comid].geometry
-                bSingleCatchment = len(B) == 1
-                split_catchment_poly, lat_snap, lng_snap = py.merit_detailed.split_catchment(conf, wid, basin, lat, lng, catchment_poly, bSingleCatchment)
-                if split_catchment_poly is None:
-                    failed[wid] = "An error occured in pysheds detailed delineation."
-                    continue
-                else:
-                    # Create a temporary GeoDataFrame to create the geometry of the split catchment polygon
-                    # This is just a shortcut method to transfer it to our watershed's subbasins GDF
-                    split_gdf = gpd.GeoDataFrame(index=[0], crs='epsg:4326', geometry=[split_catchment_poly])
-                    split_geom = split_gdf.loc[0, 'geometry']
-                    subbasins_gdf.loc[terminal_comid, 'geometry'] = split_geom
-
-            if conf.PLOTS:
-                plot_basins("post")
 
-            if conf.VERBOSE: 
-                print("Dissolving...")
-            # mybasin_gs is a GeoPandas GeoSeries
-            mybasin_gs = dissolve_geopandas(subbasins_gdf)
-
-            if conf.FILL:
-                # Fill donut holes in the watershed polygon
-                # Recall we asked the user for the fill threshold in terms of number of pixels
-                PIXEL_AREA = 0.000000695  # Constant for the area of a single pixel in MERIT-Hydro, in decimal degrees
-                area_max = conf.FILL_THRESHOLD * PIXEL_AREA
-                mybasin_gs = fill_geopandas(mybasin_gs, area_max=area_max)
-
-            if conf.SIMPLIFY:
-                # Simplify the geometry. GeoPandas uses the simple Douglas-Peuker algorithm
-                mybasin_gs = mybasin_gs.simplify(tolerance=conf.SIMPLIFY_TOLERANCE)
-
-            # Let mybasin_gdf be a GeoPandas DataFrame with the geometry, and the id and area of our watershed
-            mybasin_gdf = gpd.GeoDataFrame(geometry=mybasin_gs)
-            mybasin_gdf['id'] = wid
-            basin_poly = mybasin_gdf.geometry.values[0]
-            up_area = get_area(basin_poly)
-            # If the user gave a name and an a priori area to the watershed, include it in the output
-            if bNames:
-                mybasin_gdf['name'] = gages_df.loc[wid, 'name']
-            if bool_high_res:
-                mybasin_gdf['result'] = "High Res"
-                gages_df.at[wid, 'result'] = "high res"
+def delineate_network(conf: Config, basin: int, outlets: list, data: dict) -> (list, dict, list, list):
+    """
+    Delineates a nested network of gages (NESTED = True), see py/nested.py.
+    First we find the terminal unit catchment of each gage (and split it in high-res mode),
+    in the worker processes if we have them. Then we build the incremental area between each gage and the
+    gages upstream of it, and compose the full watersheds from those, upstream gages first.
+
+    Returns the same as _delineate_parallel(). The records of the gages also have the keys
+    'network' (a row for GAUGE_NETWORK.csv) and 'incremental' (the incremental polygon).
+    """
+    if conf.WORKERS > 1 and len(outlets) > 1:
+        located, cache_counts, report, _ = _delineate_parallel(conf, basin, outlets, _locate_outlet)
+    else:
+        located, cache_counts, report, _ = _delineate_chunk(conf, basin, outlets, data, _locate_outlet)
+
+    topo = data['topology']
+    catchments_gdf = data['catchments']
+    results = [None] * len(outlets)
+    gages = []
+    for k, loc in enumerate(located):
+        if 'failed' in loc:
+            results[k] = loc
+        else:
+            gages.append({'outlet': k, 'row': topo.row(loc['terminal_comid']),
+                          'terminal_poly': loc['terminal_poly'], 'split': loc['high_res']})
+
+    if conf.VERBOSE:
+        print(f"Building the network of {len(gages)} gages in basin {basin}")
+    with instrument.stage('nested_network'):
+        downstream = nested.build_network(topo, catchments_gdf, gages)
+    with instrument.stage('nested_compose'):
+        incremental, full = nested.compose(topo, catchments_gdf, gages, downstream,
+                                           conf.DISSOLVE_METHOD)
+
+    # The areas of all of the incremental polygons at once
+    with instrument.stage('area'):
+        areas_incr = round_sigfig(geodesic_area_perimeter(incremental)[0], 3)
+
+    upstream = [[] for _ in gages]
+    for j, d in enumerate(downstream):
+        if d >= 0:
+            upstream[d].append(outlets[gages[j]['outlet']]['id'])
+
+    for j, gage in enumerate(gages):
+        k = gage['outlet']
+        outlet = outlets[k]
+        with instrument.scope('outlet', basin=basin, wid=outlet['id']):
+            record = write_watershed(conf, outlet, located[k], gpd.GeoSeries([full[j]], crs=PROJ_WGS84), data)
+
+        area_incr = float(areas_incr[j])
+        record['network'] = {
+            'id': outlet['id'],
+            'basin': basin,
+            'terminal_comid': located[k]['terminal_comid'],
+            'downstream_id': outlets[gages[downstream[j]]['outlet']]['id'] if downstream[j] >= 0 else '',
+            'upstream_ids': ';'.join(upstream[j]),
+            'upstream_inflow': gage['owner'],
+            'area_calc': record['area_calc'],
+            'area_incr': area_incr,
+        }
+        record['incremental'] = incremental[j]
+        results[k] = record
+
+    return results, cache_counts, report, []
+
+
+def _locate_outlet(conf: Config, basin: int, outlet: dict, data: dict) -> dict:
+    # The first part of delineate_outlet(), for delineate_network(). We leave out the table of unit catchments,
+    # which can be big, and which we don't need.
+    located = locate_outlet(conf, basin, outlet, data)
+    located.pop('subbasins', None)
+    return located
+
+
+def _delineate_parallel(conf: Config, basin: int, outlets: list, func=None) -> (list, dict, list, list):
+    """
+    Sends the outlets to a pool of conf.WORKERS processes, in chunks.
+    Returns the results in the same order as `outlets`, so the output is the same as a serial run,
+    the raster cache hit and miss counts added up over all the workers, the timing records,
+    and the new upstream polygons to save.
+    `func` is what we do with each outlet, delineate_outlet() by default.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    fork = 'fork' in methods
+    ctx = multiprocessing.get_context('fork' if fork else 'spawn')
+    n_workers = min(conf.WORKERS, len(outlets))
+
+    # A few chunks per worker, to balance the load, as big watersheds take much longer than small ones
+    chunk_size = max(1, int(np.ceil(len(outlets) / (n_workers * 4))))
+    chunks = [outlets[i:i + chunk_size] for i in range(0, len(outlets), chunk_size)]
+
+    if conf.VERBOSE:
+        print(f"Delineating {len(outlets)} watersheds with {n_workers} worker processes")
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                             initializer=_init_worker, initargs=(conf, basin, fork)) as executor:
+        results = []
+        cache_counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+        report = []
+        polygons = []
+        for chunk_results, chunk_counts, chunk_report, chunk_polygons in executor.map(
+                _delineate_chunk, [conf] * len(chunks), [basin] * len(chunks), chunks,
+                [None] * len(chunks), [func] * len(chunks)):
+            # With OUTPUT_MODE = "single", hand the watersheds to the writer as soon as they get here
+            output_writer.put_records(chunk_results)
+            results.extend(chunk_results)
+            for key in cache_counts:
+                cache_counts[key] += chunk_counts[key]
+            report.extend(chunk_report)
+            polygons.extend(chunk_polygons)
+
+    return results, cache_counts, report, polygons
+
+
+def _init_worker(conf: Config, basin: int, inherited: bool):
+    instrument.enable(conf.REPORT)
+    # Without fork, each worker process has to load the basin data for itself (once)
+    if not inherited or basin not in _basin_data:
+        _basin_data.clear()
+        _basin_data[basin] = load_basin(conf, basin)
+
+
+def _delineate_chunk(conf: Config, basin: int, outlets: list, data: dict = None,
+                     func=None) -> (list, dict, list, list):
+    # Runs in the worker process (or in the main process, without workers)
+    if data is None:
+        data = _basin_data[basin]
+    if func is None:
+        func = delineate_outlet
+    before = raster_cache.stats()
+    mark = instrument.mark()
+    results = []
+    for outlet in outlets:
+        outlet_before = raster_cache.stats()
+        with instrument.scope('outlet', basin=basin, wid=outlet['id']):
+            result = func(conf, basin, outlet, data)
+            instrument.annotate(result=result.get('result', 'failed'), **raster_cache.counts_since(outlet_before))
+        results.append(result)
+
+    # The new upstream polygons, to save for the next run
+    polygons = []
+    if conf.UPSTREAM_CACHE_MB > 0 and conf.UPSTREAM_CACHE_PERSIST:
+        polygons = upstream_cache.get_cache(conf, basin, data['topology']).take_new()
+
+    return results, raster_cache.counts_since(before), instrument.take(mark), polygons
+
+
+def delineate_outlet(conf: Config, basin: int, outlet: dict, data: dict) -> dict:
+    """
+    Delineates the watershed for a single outlet point, and writes it to disk.
 
+    Args:
+        basin: the Pfafstetter Level 2 basin code
+        outlet: dict with the id, lat, lng and terminal_comid of the outlet (plus area_reported and name,
+            if the user provided them)
+        data: the basin data, from load_basin()
+
+    Returns:
+        a dict with the 'id' and the fields to update in the output table (result, snap_dist, area_calc...)
+        or, if delineation failed, a dict with the 'id' and an explanation under 'failed'
+    """
+    located = locate_outlet(conf, basin, outlet, data)
+    if 'failed' in located:
+        return located
+
+    topo = data['topology']
+    B = located['rows']
+    bool_high_res = located['high_res']
+    subbasins_gdf = located['subbasins']
+
+    if conf.VERBOSE: 
+        print("Dissolving...")
+    # mybasin_gs is a GeoPandas GeoSeries
+    with instrument.stage('dissolve'):
+        if bool_high_res and data.get('arcs') is not None:
+            # Only the outline of the watershed, from the shared edges of the unit catchments
+            mybasin_gs = arc_topology.dissolve_watershed(data['arcs'], topo, B[0], subbasins_gdf.geometry.iloc[0],
+                                                         split=True)
+        elif not bool_high_res and data['pyramid'] is not None:
+            # The biggest sub-networks of the watershed were dissolved ahead of time
+            mybasin_gs = pyramid.dissolve_watershed(data['pyramid'], topo, lowres_catchments(conf, data), B[0],
+                                                    conf.DISSOLVE_METHOD)
+        elif conf.UPSTREAM_CACHE_MB > 0:
+            # Reuse the dissolved polygons of the branches upstream, from other outlets on the same river
+            catchments_gdf = data['catchments'] if bool_high_res else lowres_catchments(conf, data)
+            mybasin_gs = upstream_cache.dissolve_watershed(
+                upstream_cache.get_cache(conf, basin, topo), topo, catchments_gdf, bool_high_res,
+                B[0], subbasins_gdf.geometry.iloc[0], split=bool_high_res,
+                method=conf.DISSOLVE_METHOD)
+        elif 0 < conf.DISSOLVE_PARALLEL_THRESHOLD < len(subbasins_gdf):
+            # A huge watershed: dissolve pieces of it in several processes, and merge them
+            topo.euler()
+            mybasin_gs = parallel_dissolve.dissolve(subbasins_gdf, conf.DISSOLVE_METHOD, conf.DISSOLVE_WORKERS,
+                                                    topo.end[B] - topo.start[B])
+        else:
+            mybasin_gs = dissolve(subbasins_gdf, conf.DISSOLVE_METHOD)
+
+    return write_watershed(conf, outlet, located, mybasin_gs, data)
+
+
+def locate_outlet(conf: Config, basin: int, outlet: dict, data: dict) -> dict:
+    """
+    The first part of delineating a watershed: finds the unit catchments in the watershed,
+    and in high-res mode, splits the terminal unit catchment at the outlet.
+
+    Returns:
+        a dict with the 'id' of the outlet and:
+            terminal_comid: the COMID of the terminal unit catchment
+            rows: the rows (in the topology index) of the unit catchments in the watershed, terminal first
+            high_res: whether we did the raster-based delineation
+            subbasins: the unit catchments in the watershed, with the terminal one split in high-res mode
+            terminal_poly: the (split) polygon of the terminal unit catchment
+            lat_snap, lng_snap: the outlet, snapped to the river
+        or, if it failed, a dict with the 'id' and an explanation under 'failed'
+    """
+    rivers_gdf = data['rivers']
+    topo = data['topology']
+
+    # Let wid be the watershed ID. Get the lat, lng coords of the gage.
+    wid = outlet['id']
+    lat = outlet['lat']
+    lng = outlet['lng']
+    terminal_comid = outlet['terminal_comid']
+    area_reported = outlet.get('area_reported')
+    bAreas = area_reported is not None
+
+    if conf.VERBOSE: 
+        print(f"\n* Delineating watershed {outlet['counter']} of {outlet['n_gages']}, with outlet id = {wid}")
+
+    # Reset the local boolean flag for high-res mode. If the watershed is too big, script will switch to low.
+    bool_high_res = conf.HIGH_RES
+
+    # Get the upstream area of the unit catchment we found, according to MERIT-Basins
+    up_area = rivers_gdf.loc[terminal_comid].uparea
+
+    # If MATCH_AREAS is True and the user provided the area in the outlets CSV file,
+    # the script will check whether the upstream area of the unit catchment is a good match.
+    # If the areas do not match well, look around the neighborhood for another unit catchment
+    # whose area is a closer match to what we think it is.
+    if bAreas and conf.MATCH_AREAS:
+        PD_area = abs((area_reported - up_area) / area_reported)
+        if PD_area > conf.AREA_MATCHING_THRESHOLD:
+            if conf.VERBOSE:
+                print("Outlet point is in a unit catchment whose area is not a close match.")
+                print("Searching neighborhood for a river reach with a more closely matching upstream area")
+            with instrument.stage('area_match'):
+                candidate_comid, up_area = find_close_catchment(conf, rivers_gdf, lat, lng, area_reported,
+                                                                outlet.get('match'))
+            if candidate_comid is None:
+                return {'id': wid, 'failed': "Could not find a nearby river reach whose upstream area is "
+                                             "within {}% of reported area of {:,.0f} km²"
+                                             .format(conf.AREA_MATCHING_THRESHOLD * 100, area_reported)}
             else:
-                mybasin_gdf['result'] = "Low Res"
-                gages_df.at[wid, 'result'] = "low res"
-
-                snapped_outlet = rivers_gdf.loc[terminal_comid].geometry.coords[0]
-                lat_snap = snapped_outlet[1]
-                lng_snap = snapped_outlet[0]
-
-            # Get the (approx.) snap distance
-            geod = pyproj.Geod(ellps='WGS84')
-            snap_dist = geod.inv(lng, lat, lng_snap, lat_snap)[2]
-            gages_df.at[wid, 'snap_dist'] = sigfig.round(snap_dist, 2)
-            gages_df.at[wid, 'lat_snap'] = round(lat_snap, 3)
-            gages_df.at[wid, 'lng_snap'] = round(lng_snap, 3)
-
-            # Add the upstream area of the delineated watershed to the DataFrame
-            up_area = sigfig.round(up_area, 3)
-            mybasin_gdf['area_calc'] = up_area
-            gages_df.at[wid, 'area_calc'] = up_area
-
-            if bAreas:
-                area_reported = gages_df.loc[wid].area_reported
-                mybasin_gdf['area_reported'] = area_reported
-                perc_diff = sigfig.round((up_area - area_reported) / area_reported * 100, 2)
-                gages_df.at[wid, 'perc_diff'] = perc_diff
-
-            # SAVE the Watershed to disk as a GeoJSON file or a shapefile
-            if conf.VERBOSE: 
-                print(f' Writing output for watershed {wid}')
-            outfile = f"{conf.OUTPUT_DIR}/{wid}.{conf.OUTPUT_EXT}"
+                terminal_comid = candidate_comid
 
+    # Let B be the rows (in the topology index) of the unit catchments and river reaches
+    # that are in the watershed. The terminal unit catchment is the first one.
+    with instrument.stage('topology'):
+        B = topo.upstream_rows(terminal_comid)
+    instrument.annotate(unit_catchments=len(B))
+    if conf.VERBOSE: 
+        print(f"  found {len(B)} unit catchments in the watershed")
+
+    # If the watershed is too big, revert to low-precision mode.
+    # (Not for a nested network of gages, where all of the pieces have to be at the same resolution.)
+    if conf.HIGH_RES and up_area > conf.LOW_RES_THRESHOLD and not conf.NESTED:
+        if conf.VERBOSE: 
+            print(f"Watershed for id = {wid} is larger than LOW_RES_THRESHOLD = {conf.LOW_RES_THRESHOLD}. "
+                "SWITCHING TO LOW-RESOLUTION MODE.")
+        bool_high_res = False
+        # If we just flipped to low-res mode, check if the low-res unit catchment polygons are loaded.
+        if data['catchments_lowres'] is None:
+            with instrument.stage('load_gdf/catchments_lowres'):
+                data['catchments_lowres'] = load_gdf(conf, "catchments", basin, False, rivers_gdf=rivers_gdf,
+                                                     columns=['geometry'])
+        load_pyramid(conf, basin, data)
+
+        with instrument.stage('select'):
+            subbasins_gdf = topo.select(data['catchments_lowres'], B)
+    else:
+        # Create a new geodataframe containing only the unit catchments_gdf that are in the list B
+        # In high precision mode, we will update the geometry of the terminal unit catchment.
+        with instrument.stage('select'):
+            subbasins_gdf = topo.select(data['catchments'], B)
+
+    # Make a plot of the selected unit catchments
+    if conf.PLOTS:
+        plot_basins(conf, subbasins_gdf, wid, lat, lng, None, None, "pre")
+
+    # In detailed mode,
+    if bool_high_res:
+        if conf.VERBOSE: 
+            print("Performing detailed raster-based delineation for the downstream portion of the watershed")
+        
+        # Let split_catchment_poly be the polygon of the terminal unit catchment
+        assert terminal_comid == topo.comids[B[0]]
+        catchment_poly = subbasins_gdf.loc[terminal_comid].geometry
+        bSingleCatchment = len(B) == 1
+        with instrument.stage('split'):
+            split_catchment_poly, lat_snap, lng_snap = py.merit_detailed.split_catchment(conf, wid, basin, lat, lng, catchment_poly, bSingleCatchment)
+        if split_catchment_poly is None:
+            return {'id': wid, 'failed': "An error occured in pysheds detailed delineation."}
+        else:
+            # Create a temporary GeoDataFrame to create the geometry of the split catchment polygon
+            # This is just a shortcut method to transfer it to our watershed's subbasins GDF
+            split_gdf = gpd.GeoDataFrame(index=[0], crs='epsg:4326', geometry=[split_catchment_poly])
+            split_geom = split_gdf.loc[0, 'geometry']
+            # (copy first, so that we never write into the shared basin table)
+            subbasins_gdf = subbasins_gdf.copy()
+            subbasins_gdf.loc[terminal_comid, 'geometry'] = split_geom
+
+        if conf.PLOTS:
+            plot_basins(conf, subbasins_gdf, wid, lat, lng, lat_snap, lng_snap, "post")
+    else:
+        snapped_outlet = rivers_gdf.loc[terminal_comid].geometry.coords[0]
+        lat_snap = snapped_outlet[1]
+        lng_snap = snapped_outlet[0]
+        if conf.PLOTS:
+            plot_basins(conf, subbasins_gdf, wid, lat, lng, None, None, "post")
+
+    return {
+        'id': wid,
+        'result': "high res" if bool_high_res else "low res",
+        'terminal_comid': terminal_comid,
+        'rows': B,
+        'high_res': bool_high_res,
+        'subbasins': subbasins_gdf,
+        'terminal_poly': subbasins_gdf.geometry.iloc[0],
+        'lat_snap': lat_snap,
+        'lng_snap': lng_snap,
+    }
+
+
+def write_watershed(conf: Config, outlet: dict, located: dict, mybasin_gs: gpd.GeoSeries, data: dict) -> dict:
+    """
+    The last part of delineating a watershed: fills and simplifies the dissolved watershed polygon,
+    calculates its area, and writes it to disk (and the map files).
+
+    Args:
+        outlet: the outlet, as for delineate_outlet()
+        located: what we found out about the outlet in locate_outlet()
+        mybasin_gs: the watershed polygon, a GeoSeries with one row
+
+    Returns:
+        a dict with the 'id' and the fields to update in the output table
+    """
+    rivers_gdf = data['rivers']
+    topo = data['topology']
+    wid = outlet['id']
+    lat = outlet['lat']
+    lng = outlet['lng']
+    area_reported = outlet.get('area_reported')
+    bAreas = area_reported is not None
+    terminal_comid = located['terminal_comid']
+    B = located['rows']
+    bool_high_res = located['high_res']
+    lat_snap = located['lat_snap']
+    lng_snap = located['lng_snap']
+
+    with instrument.stage('fill_simplify'):
+        if conf.FILL:
+            # Fill donut holes in the watershed polygon
+            # Recall we asked the user for the fill threshold in terms of number of pixels
+            PIXEL_AREA = 0.000000695  # Constant for the area of a single pixel in MERIT-Hydro, in decimal degrees
+            area_max = conf.FILL_THRESHOLD * PIXEL_AREA
+            mybasin_gs = fill_geopandas(mybasin_gs, area_max=area_max)
+
+        if conf.SIMPLIFY:
+            # Simplify the geometry. GeoPandas uses the simple Douglas-Peuker algorithm
+            mybasin_gs = mybasin_gs.simplify(tolerance=conf.SIMPLIFY_TOLERANCE)
+
+    # The fields to update in the output table for this watershed
+    record = {'id': wid}
+
+    # Let mybasin_gdf be a GeoPandas DataFrame with the geometry, and the id and area of our watershed
+    mybasin_gdf = gpd.GeoDataFrame(geometry=mybasin_gs)
+    mybasin_gdf['id'] = wid
+    basin_poly = mybasin_gdf.geometry.values[0]
+    with instrument.stage('area'):
+        up_area = geodesic_area(basin_poly)
+    # If the user gave a name and an a priori area to the watershed, include it in the output
+    if 'name' in outlet:
+        mybasin_gdf['name'] = outlet['name']
+    if bool_high_res:
+        mybasin_gdf['result'] = "High Res"
+        record['result'] = "high res"
+
+    else:
+        mybasin_gdf['result'] = "Low Res"
+        record['result'] = "low res"
+
+    # The snapped outlet. We work out the snap distance (and perc_diff) for all of the outlets at the end,
+    # see add_metrics() in py/metrics.py, so we keep the coordinates before rounding too.
+    record['lat_snap'] = round(lat_snap, 3)
+    record['lng_snap'] = round(lng_snap, 3)
+    record['snap_lat'] = lat_snap
+    record['snap_lng'] = lng_snap
+
+    # Add the upstream area of the delineated watershed to the DataFrame
+    up_area = float(round_sigfig(up_area, 3))
+    mybasin_gdf['area_calc'] = up_area
+    record['area_calc'] = up_area
+
+    if bAreas:
+        mybasin_gdf['area_reported'] = area_reported
+
+    # SAVE the Watershed to disk as a GeoJSON file or a shapefile
+    if conf.OUTPUT_MODE == "single" and conf.OUTPUT_EXT != "":
+        # All of the watersheds go into one file, see py/output_writer.py. In a worker process,
+        # we send the watershed back to the main process with the results.
+        with instrument.stage('write_output'):
+            feature = output_writer.feature(mybasin_gdf)
+            if not output_writer.put(feature):
+                record['feature'] = feature
+    else:
+        if conf.VERBOSE:
+            print(f' Writing output for watershed {wid}')
+        outfile = f"{conf.OUTPUT_DIR}/{wid}.{conf.OUTPUT_EXT}"
+
+        with instrument.stage('write_output'):
             # This line rounds all the vertices to fewer digits. For text-like formats GeoJSON or KML, makes smaller
             # files with minimal loss of precision. For other formats (shp, gpkg), doesn't make a difference in file size
-            if conf.OUTPUT_EXT.lower() in ['geojson', 'kml']:
-                mybasin_gdf.geometry = mybasin_gdf.geometry.apply(lambda x: loads(re.sub(simpledec, mround, x.wkt)))
+            if quantize.for_output(conf):
+                mybasin_gdf = quantize.quantize_gdf(mybasin_gdf, conf.OUTPUT_DECIMALS)
 
             if conf.OUTPUT_EXT != "":
                 with warnings.catch_warnings():
                     warnings.simplefilter(action='ignore', category=UserWarning)
                     mybasin_gdf.to_file(outfile)
 
-            # Create the HTML Viewer Map?
-            # We have to write a second, slightly different version of the GeoJSON files,
-            # because we need it in a .js file assigned to a variable, to avoid cross-origin restrictions
-            # of modern web browsers.
-            if conf.MAKE_MAP:
-                watershed_js = f"{conf.MAP_FOLDER}/{wid}.js"
-                with open(watershed_js, 'w') as f:
-                    s = f"gage_coords = [{lat}, {lng}];\n"
-                    f.write(s)
-                    s = f"snapped_coords = [{lat_snap}, {lng_snap}];\n"
-                    f.write(s)
-
-                    f.write("basin = ")
-                    f.write(mybasin_gdf.to_json())
-
-                if conf.MAP_RIVERS:
-                    myrivers_gdf = rivers_gdf.loc[B]
-
-                    # Keep only the fields lengthkm and order
-                    myrivers_gdf = myrivers_gdf[['lengthkm', 'order', 'geometry']]
-
-                    # Filter out the little headwater streams in large watersheds.
-                    max_order = myrivers_gdf.order.max()
-                    min_order = max_order - conf.NUM_STREAM_ORDERS
-                    # Drop rows where order < min_order
-                    myrivers_gdf = myrivers_gdf[myrivers_gdf.order >= min_order]
-                    myrivers_gdf = myrivers_gdf.round(1)
-                    myrivers_gdf.geometry = myrivers_gdf.geometry.apply(lambda x: loads(re.sub(simpledec, mround, x.wkt)))
-                    rivers_js = f"{conf.MAP_FOLDER}/{wid}_rivers.js"
-                    with open(rivers_js, 'w') as f:
-                        f.write("rivers = ")
-                        f.write(myrivers_gdf.to_json())
+    # Create the HTML Viewer Map?
+    # We have to write a second, slightly different version of the GeoJSON files,
+    # because we need it in a .js file assigned to a variable, to avoid cross-origin restrictions
+    # of modern web browsers.
+    if conf.MAKE_MAP and conf.MAP_MODE == "tiles":
+        # All of the watersheds and rivers go into one tile archive at the end, see py/map_tiles.py.
+        # We send them back to the main process with the results, already simplified for the map.
+        with instrument.stage('write_map'):
+            myrivers_gdf = None
+            if conf.MAP_RIVERS:
+                myrivers_gdf = map_rivers(conf, topo, rivers_gdf, B)[['order', 'geometry']]
+                # The reaches that are shorter than a pixel at the most detailed level are never shown
+                lengths = shapely.length(myrivers_gdf.geometry.values)
+                myrivers_gdf = myrivers_gdf[lengths >= map_tiles.pixel_size(max(conf.MAP_TILE_LEVELS))]
+                myrivers_gdf = myrivers_gdf.set_geometry(
+                    map_tiles.simplify(myrivers_gdf.geometry.values, conf.MAP_TILE_LEVELS, conf.OUTPUT_DECIMALS))
+                myrivers_gdf = myrivers_gdf[~myrivers_gdf.geometry.is_empty]
+            feature = output_writer.feature(mybasin_gdf)
+            feature['geometry'] = map_tiles.simplify(np.array([feature['geometry']]), conf.MAP_TILE_LEVELS,
+                                                     conf.OUTPUT_DECIMALS)[0]
+            record['map'] = {'watershed': feature, 'rivers': myrivers_gdf}
+
+    elif conf.MAKE_MAP:
+        with instrument.stage('write_map'):
+            watershed_js = f"{conf.MAP_FOLDER}/{wid}.js"
+            with open(watershed_js, 'w') as f:
+                s = f"gage_coords = [{lat}, {lng}];\n"
+                f.write(s)
+                s = f"snapped_coords = [{lat_snap}, {lng_snap}];\n"
+                f.write(s)
+
+                f.write("basin = ")
+                f.write(quantize.quantize_gdf(mybasin_gdf, conf.OUTPUT_DECIMALS).to_json())
+
+            if conf.MAP_RIVERS:
+                myrivers_gdf = map_rivers(conf, topo, rivers_gdf, B)
+                myrivers_gdf = myrivers_gdf.round(1)
+                myrivers_gdf = quantize.quantize_gdf(myrivers_gdf, conf.OUTPUT_DECIMALS)
+                # Drop the little bits of river that are shorter than the precision
+                myrivers_gdf = myrivers_gdf[~myrivers_gdf.geometry.is_empty]
+                rivers_js = f"{conf.MAP_FOLDER}/{wid}_rivers.js"
+                with open(rivers_js, 'w') as f:
+                    f.write("rivers = ")
+                    f.write(myrivers_gdf.to_json())
+
+    return record
+
+
+def map_rivers(conf: Config, topo: UpstreamIndex, rivers_gdf: gpd.GeoDataFrame, rows) -> gpd.GeoDataFrame:
+    """The river reaches in a watershed to show on the map, without the little headwater streams."""
+    myrivers_gdf = topo.select(rivers_gdf, rows)
+
+    # Keep only the fields lengthkm and order
+    myrivers_gdf = myrivers_gdf[['lengthkm', 'order', 'geometry']]
+
+    # Filter out the little headwater streams in large watersheds.
+    max_order = myrivers_gdf.order.max()
+    min_order = max_order - conf.NUM_STREAM_ORDERS
+    # Drop rows where order < min_order
+    return myrivers_gdf[myrivers_gdf.order >= min_order]
+
+
+def match_areas(conf: Config, rivers_gdf: gpd.GeoDataFrame, outlets: list, nearby_rivers: gpd.GeoDataFrame = None):
+    """
+    For MATCH_AREAS: finds the outlets whose unit catchment's upstream area is not a close match
+    for the area the user gave us, and looks for a better river reach for all of them at once
+    (see py/area_match.py). Adds the result to each of these outlets under 'match', for find_close_catchment().
+    With LAZY_LOAD, rivers_gdf has no geometries, and we search the river reaches in nearby_rivers instead.
+    """
+    area_reported = np.array([o['area_reported'] for o in outlets], dtype=float)
+    up_area = rivers_gdf['uparea'].reindex([o['terminal_comid'] for o in outlets]).to_numpy(dtype=float)
+    mismatch = np.flatnonzero(np.abs((area_reported - up_area) / area_reported) > conf.AREA_MATCHING_THRESHOLD)
+    if len(mismatch) == 0:
+        return
+
+    matches = area_match.find_matches(rivers_gdf if nearby_rivers is None else nearby_rivers,
+                                      [outlets[k]['lat'] for k in mismatch],
+                                      [outlets[k]['lng'] for k in mismatch], area_reported[mismatch],
+                                      conf.AREA_MATCHING_THRESHOLD, conf.MAX_DIST)
+    for j, k in enumerate(mismatch.tolist()):
+        outlets[k]['match'] = tuple(m[j].item() for m in matches)
+
+
+def find_close_catchment(conf: Config, rivers_gdf: gpd.GeoDataFrame, lat: float, lng: float,
+                         area_reported: float, match: tuple = None) -> (int or None, float or None):
+    """
+    Part of my simple pour point relocation method. If the outlet falls in a unit catchment
+    whose area is a mismatch of our a priori estimate of the upstream area,
+    look around the neighborhood for a unit catchment whose area matches more closely
 
-    # CREATE OUTPUT.CSV, a data table of the outputs
-    # id, status (hi, low, failed), name, area_reported, area_calculated
-    if conf.OUTPUT_CSV:
-        output_csv_filename = f"{conf.OUTPUT_DIR}/OUTPUT.csv"
-        gages_df.to_csv(output_csv_filename)
+    Args:
+        match: the result for this outlet from match_areas(), if we have it already
+    """
+    if match is None:
+        matches = area_match.find_matches(rivers_gdf, [lat], [lng], [area_reported],
+                                          conf.AREA_MATCHING_THRESHOLD, conf.MAX_DIST)
+        match = tuple(m[0].item() for m in matches)
+    comid, uparea, dist, min_pd = match
+
+    if comid < 0:
+        # If we've gone out a certain radius around the gage, and still haven't found a river
+        # segment with a closely matching upstream area, raise some kind of error message.
+        print('  (!) Could not find a river segment with closely matching upstr.'
+              ' area within %s degrees of gage' % round(dist, 2))
+        return None, None
+
+    if conf.VERBOSE:
+        print("  (X) Found a river reach at a distance of {}, "
+              "area difference: {:,.0f}%".format(dist, min_pd * 100))
+    return comid, uparea
+
+
+def plot_basins(conf: Config, subbasins_gdf: gpd.GeoDataFrame, wid: str, lat: float, lng: float,
+                lat_snap: float or None, lng_snap: float or None, suffix: str):
+    """
+    Makes a plot of the unit catchments that are in the watershed
 
-    # FAILED.csv: If there were any failures, write this to a separate CSV file
-    if len(failed) > 0:
-        print(f"### FAILED to find watersheds for {len(failed)} locations. Check FAILED.csv for info.")
+    It is all the upstream unit catchments, and the *split* terminal unit catchment.
 
-        failfile = f"{conf.OUTPUT_DIR}/FAILED.csv"
-        with open(failfile, 'w') as f:
-            f.write("ID, EXPLANATION\n")
-            for k, v in failed.items():
-                f.write(f'{k},"{v}"\n')
+    """
+    # subbasins_gdf.plot(column='area', edgecolor='gray', legend=True)
+    [fig, ax] = plt.subplots(1, 1, figsize=(10, 8))
 
-    # If the user wants the browser map, make it
-    if conf.MAKE_MAP:
-        if conf.VERBOSE: 
-            print("* Creating viewer.html *")
-        make_map(config=conf, df=gages_df)
+    # Plot each unit catchment with a different color
+    for x in subbasins_gdf.index:
+        color = np.random.rand(3, )
+        subbasins_gdf.loc[[x]].plot(facecolor=color, edgecolor=color, alpha=0.5, ax=ax)
 
-    # Finished, print a little status message
-    if conf.VERBOSE: 
-        print(f"It's over! See results in {output_csv_filename}")
+    # Plot the gage point
+    plt.scatter(x=lng, y=lat, c='red', edgecolors='black')
+
+    if suffix == "post" and lat_snap is not None:
+        plt.scatter(x=lng_snap, y=lat_snap, c='cyan', edgecolors='black')
+        plt.title(f"Showing the {len(subbasins_gdf)-1} upstream unit catchments and split terminal unit catchment")
+    else:
+        plt.title(f"Found {len(subbasins_gdf)} unit catchments for watershed id = {wid}")
+
+    plt.savefig(f"plots/{wid}_vector_unit_catchments_{suffix}.png")
+    plt.close(fig)
 
 
 def get_pickle_filename(conf: Config,geotype: str, basin: int, high_resolution: bool) -> str:
@@ -675,30 +1430,64 @@ def get_pickle_filename(conf: Config,geotype: str, basin: int, high_resolution:
     return fname
 
 
-def load_gdf(conf: Config, geotype: str, basin: int, high_resolution: bool) -> gpd.GeoDataFrame:
+def load_gdf(conf: Config, geotype: str, basin: int, high_resolution: bool,
+             rivers_gdf: gpd.GeoDataFrame = None, columns: list = None, comids: list = None,
+             bbox: tuple = None) -> gpd.GeoDataFrame:
     """
     Returns the unit catchments vector polygon dataset as a GeoDataFrame
     Gets the data from the MERIT-Basins shapefile the first time,
-    and after that from a saved .pkl file on disk.
+    and after that from a saved GeoParquet (or .pkl) file on disk, see py/basin_cache.py
     Uses some global parameters from config.py
 
+    The tables are sorted in the depth-first (Euler tour) order of the river network, so that
+    all of the unit catchments upstream of any COMID are a contiguous block of rows. See py/topology.py
+
     :param geotype: either "catchments" or "rivers" depending on which one we want to open.
     :param basin: the Pfafstetter level 2 megabasin, an integer from 11 to 91
     :param high_resolution: True to load the standard (high-resolution) file,
       False to load the low-resolution version (for faster processing, slightly less accurate results)
+    :param rivers_gdf: for catchments, the rivers table for the same basin. The catchments will be
+      put in the same order as the rivers.
+    :param columns: optional, only return these columns. Without 'geometry', you get a pandas DataFrame.
+    :param comids: optional, only return the rows for these COMIDs
+    :param bbox: optional, only return the rows that intersect this bounding box (xmin, ymin, xmax, ymax)
+      With the GeoParquet cache, only the parts of the file that we need are read.
 
     :return: a GeoPandas GeoDataFrame
 
     """
 
-    # First, check for the presence of a pickle file
+    # First, check for the presence of a cached GeoParquet file
+    if conf.PICKLE_DIR != '' and conf.CACHE_FORMAT == 'parquet':
+        gdf = basin_cache.load(conf, geotype, basin, high_resolution, columns=columns, comids=comids, bbox=bbox)
+        if gdf is not None:
+            if conf.VERBOSE:
+                print(f"Fetching BASIN # {basin} {geotype} data from GeoParquet file.")
+            return gdf
+
+    # Then for a pickle file (if you upgraded from an older version, we convert it)
     if conf.PICKLE_DIR != '':
         pickle_fname = get_pickle_filename(conf, geotype, basin, high_resolution)
         if os.path.isfile(pickle_fname):
             if conf.VERBOSE: 
                 print(f"Fetching BASIN # {basin} catchment data from pickle file.")
             gdf = pickle.load(open(pickle_fname, "rb"))
-            return gdf
+
+            # Pickle files from older versions of the script are not sorted yet. Sort them once and save again.
+            # (We can only sort the catchments if we have the rivers.)
+            sortable = geotype == "rivers" or rivers_gdf is not None
+            if not sortable:
+                return select_rows(gdf, columns, comids, bbox)
+            if not is_euler_sorted(gdf, rivers_gdf):
+                if conf.VERBOSE:
+                    print(f"Sorting {geotype} in river network order.")
+                gdf = euler_sort(gdf, rivers_gdf)
+                if conf.CACHE_FORMAT == 'pickle':
+                    save_pickle(conf, geotype, gdf, basin, high_resolution, overwrite=True)
+
+            if conf.CACHE_FORMAT == 'parquet':
+                basin_cache.save(conf, geotype, gdf, basin, high_resolution)
+            return select_rows(gdf, columns, comids, bbox)
 
     # Open the shapefile for the basin
     if geotype == "catchments":
@@ -721,12 +1510,44 @@ def load_gdf(conf: Config, geotype: str, basin: int, high_resolution: bool) -> g
     # This line is necessary because some of the shapefiles provided by reachhydro.com do not include .prj files
     gdf.set_crs(PROJ_WGS84, inplace=True, allow_override=True)
 
-    # Before we exit, save the GeoDataFrame as a pickle file, for future speedups!
-    save_pickle(conf, geotype, gdf, basin, high_resolution)
+    # Sort the rows in the river network's Euler tour order (the rivers define the order for the catchments)
+    if geotype == "rivers" or rivers_gdf is not None:
+        gdf = euler_sort(gdf, rivers_gdf)
+    else:
+        # Without the rivers, we can't sort the catchments, so we don't save them either.
+        # Everything that reads the cache expects the sorted order.
+        return select_rows(gdf, columns, comids, bbox)
+
+    # Before we exit, save the GeoDataFrame in the cache, for future speedups!
+    if conf.CACHE_FORMAT == 'parquet':
+        if conf.PICKLE_DIR != '':
+            basin_cache.save(conf, geotype, gdf, basin, high_resolution)
+    else:
+        save_pickle(conf, geotype, gdf, basin, high_resolution)
+    return select_rows(gdf, columns, comids, bbox)
+
+
+def select_rows(gdf: gpd.GeoDataFrame, columns: list = None, comids: list = None,
+                bbox: tuple = None) -> gpd.GeoDataFrame:
+    """
+    Same selection as `basin_cache.load()`, for a table that we already have in memory.
+    """
+    if comids is not None:
+        gdf = gdf[gdf.index.isin(comids)]
+    if bbox is not None:
+        # Like the GeoParquet file, this compares bounding boxes, not the exact geometries
+        in_bbox = np.zeros(len(gdf), dtype=bool)
+        in_bbox[gdf.sindex.query(box(*bbox))] = True
+        gdf = gdf[in_bbox]
+    if columns is not None:
+        gdf = gdf[[c for c in gdf.columns if c in columns]]
+        if 'geometry' not in columns:
+            gdf = pd.DataFrame(gdf)
     return gdf
 
 
-def save_pickle(conf: Config,geotype: str, gdf: gpd.GeoDataFrame, basin: int, high_resolution: bool):
+def save_pickle(conf: Config,geotype: str, gdf: gpd.GeoDataFrame, basin: int, high_resolution: bool,
+                overwrite: bool = False):
     # If we loaded the catchments from a shapefile, save the gdf to a pickle file for future speedup
     if conf.PICKLE_DIR != '':
 
@@ -739,7 +1560,7 @@ def save_pickle(conf: Config,geotype: str, gdf: gpd.GeoDataFrame, basin: int, hi
 
         # Get the standard project filename for the pickle files.
         pickle_fname = get_pickle_filename(conf, geotype, basin, high_resolution)
-        if not os.path.isfile(pickle_fname):
+        if overwrite or not os.path.isfile(pickle_fname):
             if conf.VERBOSE: 
                 print(f"Saving GeoDataFrame to pickle file: {pickle_fname}")
             try:
@@ -749,4 +1570,14 @@ def save_pickle(conf: Config,geotype: str, gdf: gpd.GeoDataFrame, basin: int, hi
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delineate watersheds for the outlets in OUTLETS_CSV (see config.py)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of worker processes to use (overrides WORKERS in config.py)")
+    parser.add_argument('--basin-jobs', type=int, default=None,
+                        help="Number of Level 2 basins to run at the same time (overrides BASIN_WORKERS in config.py)")
+    args = parser.parse_args()
+    if args.jobs is not None:
+        conf.WORKERS = args.jobs
+    if args.basin_jobs is not None:
+        conf.BASIN_WORKERS = args.basin_jobs
     delineate(conf=conf)
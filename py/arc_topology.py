@@ -0,0 +1,212 @@
+"""
+Shared-edge (arc) topology of the unit catchments, for dissolving very large watersheds.
+
+When we dissolve a big watershed, almost all of the work is on the edges *between* the unit catchments,
+which all disappear in the result. With ARC_TOPOLOGY = True in config.py, we split the boundaries of
+all of the unit catchments in a basin into arcs, once: an arc is a piece of boundary between the same two
+unit catchments (or between a unit catchment and the outside of the basin), from one junction to the next.
+Each arc is stored once, with the COMIDs of the unit catchments on its two sides.
+
+Then, the outline of a watershed is just the arcs that have one side inside of the watershed and
+the other side outside of it. We pick them out with a couple of NumPy comparisons (the unit catchments
+upstream of an outlet are one interval of the Euler tour, see py/topology.py), and stitch them together into
+rings with shapely's polygonize(). The time this takes depends on the length of the outline of the watershed,
+not on the number of vertices in all of its unit catchments.
+
+To find the shared edges, we need the unit catchments to be on the MERIT-Hydro grid (see `to_pixels()`
+in py/fast_dissolve.py), so this is only for the high-resolution unit catchments. We cut every edge into
+one-pixel steps, and match the steps that two unit catchments have in common.
+
+The arcs are saved in PICKLE_DIR, so we only have to do this once per basin:
+   PICKLE_DIR/arcs_##_hires.parquet
+"""
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from config import Config
+from py.fast_dissolve import PIXEL_SIZE, buffer, to_pixels
+from py.topology import UpstreamIndex
+
+# The COMID we use for the outside of the basin
+OUTSIDE = 0
+
+
+def build(catchments_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame or None:
+    """
+    Splits the boundaries of the unit catchments (indexed by COMID) into arcs.
+
+    Returns:
+        a GeoDataFrame with one row per arc: the COMIDs on its two sides, COMID_1 and COMID_2
+        (COMID_2 is 0 for the outside of the basin), and the arc as a LineString.
+        Returns None if the unit catchments are not on the MERIT-Hydro grid.
+    """
+    comids = catchments_gdf.index.to_numpy().astype(np.int64)
+    pixels = to_pixels(np.asarray(catchments_gdf.geometry.values))
+    if pixels is None:
+        return None
+
+    # All of the rings, and the coordinates along them, with the COMID they belong to
+    parts, part_index = shapely.get_parts(pixels, return_index=True)
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    coords, coord_index = shapely.get_coordinates(rings, return_index=True)
+    coords = coords.astype(np.int64)
+
+    # The one-pixel steps between consecutive coordinates of the same ring
+    step = np.flatnonzero(coord_index[1:] == coord_index[:-1])
+    p0 = coords[step]
+    p1 = coords[step + 1]
+    ring = coord_index[step]
+    owner = comids[part_index[ring_index[ring]]]
+    if not np.all(np.abs(p1 - p0).sum(axis=1) == 1):
+        return None
+
+    # A key for each step that is the same in both directions: its lower left end, and which way it goes
+    low = np.minimum(p0, p1) - coords.min(axis=0)
+    height = int(low[:, 1].max()) + 1
+    key = (low[:, 0] * height + low[:, 1]) * 2 + (p0[:, 0] == p1[:, 0])
+
+    # The unit catchment on the other side of each step: the other step with the same key
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    other = np.full(len(key), OUTSIDE, dtype=np.int64)
+    pair = np.flatnonzero(sorted_key[1:] == sorted_key[:-1])
+    other[order[pair]] = owner[order[pair + 1]]
+    other[order[pair + 1]] = owner[order[pair]]
+
+    # Each shared step is in two rings. We keep it in the ring of the unit catchment with the bigger COMID.
+    # (If a ring goes over the same step twice, it has the same unit catchment on both sides, and is not a boundary.)
+    keep = owner > other
+
+    # Join the steps we keep into runs: consecutive steps along a ring with the same unit catchment on the other side
+    kept = np.flatnonzero(keep)
+    new_run = np.ones(len(kept), dtype=bool)
+    new_run[1:] = (kept[1:] != kept[:-1] + 1) | (ring[kept[1:]] != ring[kept[:-1]]) | \
+                  (other[kept[1:]] != other[kept[:-1]])
+    run = np.cumsum(new_run) - 1
+    last = np.flatnonzero(np.append(new_run[1:], True))
+
+    # The points of each run: the start of each step, plus the end of the last one
+    points = np.concatenate([p0[kept], p1[kept[last]]])
+    point_run = np.concatenate([run, run[last]])
+    point_order = np.lexsort((np.concatenate([np.arange(len(kept)), last + 0.5]), point_run))
+    lines = shapely.linestrings(points[point_order], indices=point_run[point_order])
+
+    # A run can be cut in two where its ring starts, so we merge the runs with the same two sides
+    run_owner = owner[kept[last]]
+    run_other = other[kept[last]]
+    sides, side_index = np.unique(np.column_stack([run_owner, run_other]), axis=0, return_inverse=True)
+    side_index = side_index.ravel()
+    by_sides = np.argsort(side_index, kind='stable')
+    merged = shapely.line_merge(shapely.multilinestrings(lines[by_sides], indices=side_index[by_sides]))
+    arcs, arc_index = shapely.get_parts(merged, return_index=True)
+
+    # Without the vertices in the middle of the straight edges, and back to degrees
+    arcs = shapely.simplify(arcs, 0)
+    arcs = shapely.transform(arcs, lambda c: c * PIXEL_SIZE)
+    return gpd.GeoDataFrame({'COMID_1': sides[arc_index, 0], 'COMID_2': sides[arc_index, 1]},
+                            geometry=arcs, crs=catchments_gdf.crs)
+
+
+class ArcTopology:
+    """The arcs of one basin, with the Euler tour positions of the unit catchments on their two sides."""
+
+    def __init__(self, arcs_gdf: gpd.GeoDataFrame, topo: UpstreamIndex):
+        topo.euler()
+        self.crs = arcs_gdf.crs
+        self.arcs = np.asarray(arcs_gdf.geometry.values)
+        self.pos_1 = self._positions(topo, arcs_gdf['COMID_1'].to_numpy())
+        self.pos_2 = self._positions(topo, arcs_gdf['COMID_2'].to_numpy())
+
+    @staticmethod
+    def _positions(topo: UpstreamIndex, comids: np.ndarray) -> np.ndarray:
+        # The outside of the basin (and any COMID that is not in the river network) is never in a watershed
+        rows = topo._lookup(comids.astype(np.int64))
+        return np.where(rows >= 0, topo.start[np.maximum(rows, 0)], -1)
+
+    def __len__(self) -> int:
+        return len(self.arcs)
+
+    def outline(self, start: int, end: int) -> np.ndarray:
+        """The arcs between the unit catchments in the interval [start, end) of the Euler tour and the rest."""
+        inside_1 = (self.pos_1 >= start) & (self.pos_1 < end)
+        inside_2 = (self.pos_2 >= start) & (self.pos_2 < end)
+        return self.arcs[inside_1 != inside_2]
+
+    def polygon(self, start: int, end: int):
+        """The dissolved polygon of the unit catchments in the interval [start, end) of the Euler tour."""
+        if end <= start:
+            return shapely.Polygon()
+        faces = shapely.get_parts(shapely.polygonize(self.outline(start, end)))
+        if len(faces) > 1:
+            # polygonize() also gives us the holes as faces. Going inwards from the outside of the watershed,
+            # every arc we cross takes us in or out of it, so the faces inside of an even number of others are in.
+            filled = shapely.polygons(shapely.get_exterior_ring(faces))
+            inside, containing = shapely.STRtree(filled).query(shapely.point_on_surface(faces), predicate='within')
+            depth = np.bincount(inside[inside != containing], minlength=len(faces))
+            faces = faces[depth % 2 == 0]
+        return shapely.union_all(faces)
+
+
+def get_filename(conf: Config, basin: int) -> str:
+    return f'{conf.PICKLE_DIR}/arcs_{basin}_hires.parquet'
+
+
+def load(conf: Config, basin: int, catchments_gdf: gpd.GeoDataFrame, topo: UpstreamIndex) -> ArcTopology or None:
+    """
+    Returns the arc topology for a basin, from PICKLE_DIR if it is there, or else builds it (and saves it).
+    Returns None if the unit catchments are not on the MERIT-Hydro grid.
+    """
+    fname = get_filename(conf, basin)
+    if conf.PICKLE_DIR != '' and os.path.isfile(fname):
+        if conf.VERBOSE:
+            print(f"Reading the arc topology from {fname}")
+        return ArcTopology(gpd.read_parquet(fname), topo)
+
+    if conf.VERBOSE:
+        print(f"Building the arc topology for the {len(catchments_gdf)} unit catchments in basin {basin}")
+    arcs_gdf = build(catchments_gdf)
+    if arcs_gdf is None:
+        print(f"WARNING: the unit catchments in basin {basin} are not on the MERIT-Hydro grid. "
+              f"Dissolving without the arc topology.")
+        return None
+
+    if conf.PICKLE_DIR != '':
+        if conf.VERBOSE:
+            print(f"Saving {len(arcs_gdf)} arcs to {fname}")
+        tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        try:
+            arcs_gdf.to_parquet(tmp_fname, index=False)
+            os.replace(tmp_fname, fname)
+        except Exception as e:
+            if os.path.isfile(tmp_fname):
+                os.remove(tmp_fname)
+            raise Warning(f"Could not save the arc topology to: {fname}. Message: {str(e)}")
+
+    return ArcTopology(arcs_gdf, topo)
+
+
+def dissolve_watershed(arc_topo: ArcTopology, topo: UpstreamIndex, terminal_row: int, terminal_poly,
+                       split: bool) -> gpd.GeoSeries:
+    """
+    Same as `dissolve()` in py/fast_dissolve.py on all of the unit catchments in the watershed, but from the arcs.
+
+    Args:
+        terminal_row: the row of the terminal unit catchment in the topology index
+        terminal_poly: the polygon of the terminal unit catchment (after split_catchment)
+        split: True if terminal_poly is only part of the unit catchment. Then we build the polygon of everything
+            upstream of it from the arcs, and add terminal_poly to it.
+
+    Returns:
+        a GeoSeries with the watershed polygon
+    """
+    topo.euler()
+    start, end = int(topo.start[terminal_row]), int(topo.end[terminal_row])
+    if split:
+        polygon = arc_topo.polygon(start + 1, end)
+        polygon = shapely.union_all([polygon, terminal_poly])
+    else:
+        polygon = arc_topo.polygon(start, end)
+    return gpd.GeoSeries([buffer(polygon)], crs=arc_topo.crs)
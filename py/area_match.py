@@ -0,0 +1,100 @@
+"""
+Pour point relocation for MATCH_AREAS, for all of the outlets in a basin at once.
+
+When an outlet is in a unit catchment whose upstream area is not a good match for the area the user gave us,
+we look around it for a river reach that is a better match. We draw a box around the outlet, 0.01° on each side,
+and look at the river reaches that touch it. If the best match among them is within AREA_MATCHING_THRESHOLD,
+we take it, otherwise we make the box 0.01° bigger, up to MAX_DIST.
+
+This used to be a loop for each outlet, with a new spatial query for every box. Now we do one spatial query
+for all of the outlets, with the biggest box, and work out for every river reach we found the smallest box that
+it touches (its "ring"). Then, for each outlet, the answer is the best match among the river reaches in the first
+ring that has a good enough match, or in the rings inside of it. This gives the same answer as the loop.
+"""
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# How much bigger the box gets on each side, at every step (degrees)
+STEP = 0.01
+
+
+def ring_distances(max_dist: float) -> np.ndarray:
+    """
+    The sizes of the boxes (half of the width, in degrees). We add up the steps the same way the loop did,
+    so the boxes are exactly the same. The last box is the first one that is bigger than max_dist.
+    """
+    dists = [STEP]
+    while dists[-1] <= max_dist:
+        dists.append(dists[-1] + STEP)
+    return np.array(dists)
+
+
+def find_matches(rivers_gdf: gpd.GeoDataFrame, lat, lng, area_reported, threshold: float,
+                 max_dist: float) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    For each outlet, finds the nearby river reach whose upstream area is the best match for area_reported.
+
+    Args:
+        rivers_gdf: the rivers, indexed by COMID, with the upstream area in 'uparea'
+        lat, lng, area_reported: arrays, one value per outlet
+        threshold: AREA_MATCHING_THRESHOLD, e.g. 0.25 for 25%
+        max_dist: MAX_DIST, in degrees
+
+    Returns:
+        comids: the COMID of the river reach for each outlet, or -1 if there is no good match
+        up_areas: the upstream area of the river reach (km², rounded), or NaN
+        dists: the size of the box where we found it, or the biggest box if there is no good match
+        perc_diffs: how far off the upstream area of the river reach is, as a fraction of area_reported, or NaN
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    area_reported = np.asarray(area_reported, dtype=float)
+    n = len(lat)
+    dists = ring_distances(max_dist)
+    comids = np.full(n, -1, dtype=np.int64)
+    up_areas = np.full(n, np.nan)
+    found_dist = np.full(n, dists[-1])
+    found_diff = np.full(n, np.nan)
+    if n == 0 or len(rivers_gdf) == 0:
+        return comids, up_areas, found_dist, found_diff
+
+    # All of the river reaches that touch the biggest box around each outlet
+    d = dists[-1]
+    outlet, river = rivers_gdf.sindex.query(shapely.box(lng - d, lat - d, lng + d, lat + d), predicate='intersects')
+    geoms = np.asarray(rivers_gdf.geometry.values)[river]
+    uparea = rivers_gdf['uparea'].to_numpy(dtype=float)[river]
+    perc_diff = np.abs((uparea - area_reported[outlet]) / area_reported[outlet])
+
+    # The smallest box that each river reach touches, by bisection. The boxes are inside of each other,
+    # so once a river reach touches one of them, it touches all of the bigger ones.
+    lo = np.zeros(len(river), dtype=np.int64)
+    hi = np.full(len(river), len(dists) - 1, dtype=np.int64)
+    while np.any(lo < hi):
+        active = np.flatnonzero(lo < hi)
+        mid = (lo[active] + hi[active]) // 2
+        o = outlet[active]
+        hit = shapely.intersects(geoms[active], shapely.box(lng[o] - dists[mid], lat[o] - dists[mid],
+                                                            lng[o] + dists[mid], lat[o] + dists[mid]))
+        hi[active] = np.where(hit, mid, hi[active])
+        lo[active] = np.where(hit, lo[active], mid + 1)
+    ring = lo
+
+    # For each outlet, the first ring with a good match
+    good = perc_diff < threshold
+    first_good = np.full(n, len(dists), dtype=np.int64)
+    np.minimum.at(first_good, outlet[good], ring[good])
+
+    # The best match in that ring, or the ones inside of it. For ties, the first one that the spatial index
+    # gave us, like the loop did (the index always lists the river reaches in the same order).
+    eligible = np.flatnonzero(ring <= first_good[outlet])
+    order = eligible[np.lexsort((eligible, perc_diff[eligible], outlet[eligible]))]
+    best = order[np.r_[True, outlet[order][1:] != outlet[order][:-1]]] if len(order) else order
+    best = best[good[best]]
+
+    o = outlet[best]
+    comids[o] = rivers_gdf.index.to_numpy()[river[best]]
+    up_areas[o] = np.round(uparea[best], 0)
+    found_dist[o] = dists[ring[best]]
+    found_diff[o] = perc_diff[best]
+    return comids, up_areas, found_dist, found_diff
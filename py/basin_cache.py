@@ -0,0 +1,92 @@
+"""
+A cache of the MERIT-Basins unit catchments and rivers tables, as GeoParquet files.
+
+Reading the shapefiles for a big Level 2 basin takes minutes, so after the first time, we save each table
+in PICKLE_DIR. We used to save them as Python pickle files, but those are slow to load, they always
+contain every column and every geometry, and they often can't be read with a newer version of geopandas.
+
+GeoParquet is a columnar format, so we can read only the columns we need (e.g. the river network
+fields up1..up4 and uparea, without the geometries). The file is split into row groups, and since the tables
+are stored in the river network (Euler tour) order, the unit catchments that are upstream of an outlet are
+usually in just a few row groups. Each row group records the range of COMIDs and the bounding box
+of the geometries in it, so we can skip the row groups we don't need when we ask for a list of COMIDs
+or a bounding box.
+
+The filenames look like this:
+   PICKLE_DIR/catchments_##_hires.parquet
+   PICKLE_DIR/rivers_##_lores.parquet
+where ## is the megabasin number (11-91)
+
+Set CACHE_FORMAT = "pickle" in config.py to keep using the old pickle files.
+"""
+import os
+
+import geopandas as gpd
+import pandas as pd
+
+from config import Config
+
+# Name of the column we store the index (COMID) in
+INDEX_NAME = 'COMID'
+
+
+def get_parquet_filename(conf: Config, geotype: str, basin: int, high_resolution: bool) -> str:
+    resolution_str = 'hires' if high_resolution else 'lores'
+    return f'{conf.PICKLE_DIR}/{geotype}_{basin}_{resolution_str}.parquet'
+
+
+def save(conf: Config, geotype: str, gdf: gpd.GeoDataFrame, basin: int, high_resolution: bool,
+         overwrite: bool = False):
+    """Saves a catchments or rivers table (indexed by COMID) to the cache."""
+    fname = get_parquet_filename(conf, geotype, basin, high_resolution)
+    if os.path.isfile(fname) and not overwrite:
+        return
+
+    if conf.VERBOSE:
+        print(f"Saving GeoDataFrame to GeoParquet file: {fname}")
+
+    # Write to a temporary file first, so another process never finds a half-written file
+    tmp_fname = f"{fname}.{os.getpid()}.tmp"
+    try:
+        gdf.to_parquet(tmp_fname, index=True, write_covering_bbox=True,
+                       row_group_size=conf.CACHE_ROW_GROUP_SIZE)
+        os.replace(tmp_fname, fname)
+    except Exception as e:
+        if os.path.isfile(tmp_fname):
+            os.remove(tmp_fname)
+        raise Warning(f"Could not save GeoParquet file to: {fname}. Message: {str(e)}")
+
+
+def load(conf: Config, geotype: str, basin: int, high_resolution: bool, columns: list = None,
+         comids: list = None, bbox: tuple = None) -> gpd.GeoDataFrame or pd.DataFrame:
+    """
+    Reads a catchments or rivers table from the cache. Returns None if it is not there.
+
+    Args:
+        columns: only read these columns (the COMID index is always included). If 'geometry' is
+            not one of them, you get a plain pandas DataFrame instead of a GeoDataFrame.
+        comids: only read the rows for these COMIDs
+        bbox: only read the rows whose bounding boxes intersect this one, (xmin, ymin, xmax, ymax)
+    """
+    fname = get_parquet_filename(conf, geotype, basin, high_resolution)
+    if not os.path.isfile(fname):
+        return None
+
+    kwargs = {}
+    if comids is not None:
+        kwargs['filters'] = [(INDEX_NAME, 'in', [int(comid) for comid in comids])]
+
+    if columns is not None:
+        columns = [INDEX_NAME] + [c for c in columns if c != INDEX_NAME]
+
+    if columns is not None and 'geometry' not in columns:
+        if bbox is not None:
+            raise Exception("Can't select a bounding box without reading the geometry column")
+        df = pd.read_parquet(fname, columns=columns, **kwargs)
+    else:
+        df = gpd.read_parquet(fname, columns=columns, bbox=bbox, **kwargs)
+
+    # The index is saved as a column, but depending on the columns we ask for, it may or may not come back as one
+    if INDEX_NAME in df.columns:
+        df.set_index(INDEX_NAME, inplace=True)
+    return df
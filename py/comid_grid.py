@@ -0,0 +1,227 @@
+"""
+A raster of the unit catchments, for finding the unit catchment that each outlet is in.
+
+To find the terminal unit catchment of each outlet, the script used to do a spatial join of the outlet points
+with all of the unit catchment polygons in the basin. With COMID_GRID = True in config.py, we instead burn the
+unit catchments into a raster on the MERIT-Hydro grid (3 arcseconds, the same pixels as the flow direction
+rasters), once per basin. Each pixel has the number of its unit catchment (1, 2, 3...; 0 is outside of all
+of them), and a small list turns those numbers back into COMIDs. Then, finding the unit catchment of an outlet
+is just looking up its pixel in the array.
+
+We always burn in the high-resolution unit catchments, also with HIGH_RES = False. They come from the
+MERIT-Hydro rasters, so their edges are on the pixel edges, they have no gaps or overlaps, and the raster gives
+exactly the same answer as the polygons. (The low-resolution ones are simplified, so they are not made of whole
+pixels.) They have the same COMIDs as the low-resolution ones. With SEARCH_DIST, an outlet that is not in
+any unit catchment goes to the closest pixel that is, within SEARCH_DIST degrees.
+
+The rasters are saved in PICKLE_DIR as NumPy arrays, which we memory-map, so we only read the pixels we need:
+   PICKLE_DIR/comid_grid_##.npy, plus a small .json file with the georeferencing and COMIDs
+They are made the first time they are needed, or ahead of time with this command (from the main folder of the repo):
+
+    >> python -m py.comid_grid --basins 11 12
+"""
+import argparse
+import json
+import math
+import os
+
+import geopandas as gpd
+import numpy as np
+from affine import Affine
+from numpy.lib.format import open_memmap
+from rasterio.features import rasterize
+from shapely.geometry import box
+
+from config import Config
+from py.fast_dissolve import PIXEL_SIZE
+
+# Number of rows of pixels that we burn in at a time, to save memory
+STRIP_HEIGHT = 1024
+
+
+class ComidGrid:
+    """
+    The raster of unit catchment numbers for a basin.
+    `left` and `top` are the edges of the raster, in pixels from 0° (so the pixel edges are at whole numbers).
+    `comids` has the COMID for each number in the raster, with a 0 first for the pixels outside of the basin.
+    """
+
+    def __init__(self, grid: np.ndarray, left: int, top: int, comids: np.ndarray):
+        self.grid = grid
+        self.left = left
+        self.top = top
+        self.comids = comids
+
+    def pixels(self, lat, lng) -> (np.ndarray, np.ndarray):
+        """The row and column of the pixel that each point is in (which may be outside of the raster)."""
+        rows = self.top - np.floor(np.asarray(lat, dtype=float) / PIXEL_SIZE).astype(np.int64) - 1
+        cols = np.floor(np.asarray(lng, dtype=float) / PIXEL_SIZE).astype(np.int64) - self.left
+        return rows, cols
+
+    def lookup(self, lat, lng, search_dist: float = 0) -> np.ndarray:
+        """
+        The COMIDs of the unit catchments that the points are in, or 0 if there is none.
+        With search_dist > 0 (in degrees), the points that are not in a unit catchment get the closest one.
+        """
+        lat = np.asarray(lat, dtype=float)
+        lng = np.asarray(lng, dtype=float)
+        rows, cols = self.pixels(lat, lng)
+        height, width = self.grid.shape
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        codes = np.zeros(len(rows), dtype=np.int64)
+        codes[inside] = self.grid[rows[inside], cols[inside]]
+
+        if search_dist > 0:
+            for k in np.flatnonzero(codes == 0).tolist():
+                codes[k] = self._nearest(lat[k], lng[k], rows[k], cols[k], search_dist)
+        return self.comids[codes]
+
+    def _nearest(self, lat: float, lng: float, row: int, col: int, search_dist: float) -> int:
+        # The closest pixel in a unit catchment, within search_dist. The high-res unit catchments are made of
+        # whole pixels, so this is the same as the distance to the closest polygon.
+        radius = math.ceil(search_dist / PIXEL_SIZE) + 1
+        height, width = self.grid.shape
+        r0, r1 = max(row - radius, 0), min(row + radius + 1, height)
+        c0, c1 = max(col - radius, 0), min(col + radius + 1, width)
+        if r0 >= r1 or c0 >= c1:
+            return 0
+        window = np.asarray(self.grid[r0:r1, c0:c1])
+        r, c = np.nonzero(window)
+        if len(r) == 0:
+            return 0
+
+        # Distance from the point to each pixel (a square), in degrees
+        west = (self.left + c0 + c) * PIXEL_SIZE
+        north = (self.top - r0 - r) * PIXEL_SIZE
+        dx = np.maximum(np.maximum(west - lng, lng - (west + PIXEL_SIZE)), 0)
+        dy = np.maximum(np.maximum((north - PIXEL_SIZE) - lat, lat - north), 0)
+        dist = np.hypot(dx, dy)
+        closest = int(np.argmin(dist))
+        return int(window[r[closest], c[closest]]) if dist[closest] <= search_dist else 0
+
+
+def get_filenames(conf: Config, basin: int) -> (str, str):
+    stem = f"{conf.PICKLE_DIR}/comid_grid_{basin}"
+    return f"{stem}.npy", f"{stem}.json"
+
+
+def build(catchments_gdf: gpd.GeoDataFrame, npy_fname: str = None) -> ComidGrid:
+    """
+    Burns the high-res unit catchments (indexed by COMID) into a raster, one strip at a time.
+    A pixel is in a unit catchment if its center is. With npy_fname, the raster is written to that file
+    (and memory-mapped), otherwise it is kept in memory.
+    """
+    minx, miny, maxx, maxy = catchments_gdf.total_bounds
+    left = math.floor(minx / PIXEL_SIZE)
+    right = math.ceil(maxx / PIXEL_SIZE)
+    bottom = math.floor(miny / PIXEL_SIZE)
+    top = math.ceil(maxy / PIXEL_SIZE)
+    shape = (top - bottom, right - left)
+
+    # Numbers instead of COMIDs, so that the raster is small: 2 bytes per pixel for most basins
+    n = len(catchments_gdf)
+    dtype = np.uint16 if n < np.iinfo(np.uint16).max else np.uint32
+    comids = np.concatenate([[0], catchments_gdf.index.to_numpy().astype(np.int64)])
+    codes = np.arange(1, n + 1)
+    geoms = np.asarray(catchments_gdf.geometry.values)
+
+    if npy_fname is None:
+        grid = np.zeros(shape, dtype=dtype)
+    else:
+        grid = open_memmap(npy_fname, mode='w+', dtype=dtype, shape=shape)
+    for row in range(0, shape[0], STRIP_HEIGHT):
+        height = min(STRIP_HEIGHT, shape[0] - row)
+        north = (top - row) * PIXEL_SIZE
+        south = (top - row - height) * PIXEL_SIZE
+        idx = catchments_gdf.sindex.query(box(left * PIXEL_SIZE, south, right * PIXEL_SIZE, north),
+                                          predicate='intersects')
+        if len(idx) > 0:
+            grid[row:row + height] = rasterize(zip(geoms[idx], codes[idx]), out_shape=(height, shape[1]),
+                                               transform=Affine(PIXEL_SIZE, 0, left * PIXEL_SIZE,
+                                                                0, -PIXEL_SIZE, north),
+                                               fill=0, dtype=dtype)
+        else:
+            grid[row:row + height] = 0
+    if npy_fname is not None:
+        grid.flush()
+    return ComidGrid(grid, left, top, comids)
+
+
+def save(conf: Config, basin: int, catchments_gdf: gpd.GeoDataFrame) -> ComidGrid:
+    """Builds the raster for a basin from its high-res unit catchments, and saves it in PICKLE_DIR."""
+    npy_fname, json_fname = get_filenames(conf, basin)
+    if conf.VERBOSE:
+        print(f"Saving the COMID raster for basin {basin} to {npy_fname}")
+    # Write to temporary files first, so we never leave a half-finished file behind
+    tmp_npy = f"{npy_fname}.{os.getpid()}.tmp"
+    tmp_json = f"{json_fname}.{os.getpid()}.tmp"
+    try:
+        grid = build(catchments_gdf, tmp_npy)
+        with open(tmp_json, 'w') as f:
+            json.dump({'left': grid.left, 'top': grid.top, 'comids': grid.comids.tolist()}, f)
+        del grid
+        os.replace(tmp_npy, npy_fname)
+        os.replace(tmp_json, json_fname)
+    except Exception as e:
+        for fname in [tmp_npy, tmp_json]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        raise Warning(f"Could not save the COMID raster to: {npy_fname}. Message: {str(e)}")
+    return read(conf, basin)
+
+
+def read(conf: Config, basin: int) -> ComidGrid or None:
+    """The raster for a basin from PICKLE_DIR, memory-mapped, or None if it is not there."""
+    npy_fname, json_fname = get_filenames(conf, basin)
+    if not os.path.isfile(npy_fname) or not os.path.isfile(json_fname):
+        return None
+    with open(json_fname) as f:
+        meta = json.load(f)
+    # Read-only, so the pages can be shared by all the processes
+    grid = np.load(npy_fname, mmap_mode='r')
+    return ComidGrid(grid, meta['left'], meta['top'], np.array(meta['comids'], dtype=np.int64))
+
+
+def load(conf: Config, basin: int, catchments_gdf: gpd.GeoDataFrame) -> ComidGrid:
+    """
+    Returns the raster for a basin, from PICKLE_DIR if it is there, or else builds it (and saves it)
+    from `catchments_gdf`, the high-res unit catchments.
+    """
+    if conf.PICKLE_DIR != '':
+        grid = read(conf, basin)
+        if grid is not None:
+            return grid
+    if conf.VERBOSE:
+        print(f"Building the COMID raster for the {len(catchments_gdf)} unit catchments in basin {basin}")
+    if conf.PICKLE_DIR != '':
+        return save(conf, basin, catchments_gdf)
+    return build(catchments_gdf)
+
+
+def main():
+    from delineate import load_gdf
+
+    conf = Config()
+    parser = argparse.ArgumentParser(description="Builds the rasters of the unit catchments for COMID_GRID = True "
+                                                 "(see config.py)")
+    parser.add_argument('--basins', type=int, nargs='+', required=True,
+                        help="Level 2 basin codes, e.g. 11 12")
+    parser.add_argument('--overwrite', action='store_true', help="Build the raster again, even if it is already there")
+    args = parser.parse_args()
+
+    if conf.PICKLE_DIR == '':
+        raise Exception("Please set PICKLE_DIR in config.py, or as an environment variable")
+    os.makedirs(conf.PICKLE_DIR, exist_ok=True)
+
+    for basin in args.basins:
+        if read(conf, basin) is not None and not args.overwrite:
+            print(f"The COMID raster for basin {basin} is already there, skipping (use --overwrite to build it again)")
+            continue
+        print(f"Building the COMID raster for basin {basin}")
+        rivers_gdf = load_gdf(conf, "rivers", basin, True)
+        catchments_gdf = load_gdf(conf, "catchments", basin, True, rivers_gdf=rivers_gdf, columns=['geometry'])
+        save(conf, basin, catchments_gdf)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,39 @@ output: a geopandas dataseries with a single polygon
 with no internal rings or "donut holes," which is what I was looking for
 with my watershed boundaries. 
 
+Since then, shapely 2 has made two other ways practical, so the method is now a setting (DISSOLVE_METHOD
+in config.py), and `dissolve()` picks one of them:
+
+  "clip"      the bounding box trick above
+  "unary"     shapely's union_all() on the array of polygons, without building any GeoDataFrames
+  "coverage"  shapely's coverage_union_all(). The MERIT-Basins unit catchments come from a raster, so they
+              fit together without overlaps (a "coverage"). Then a union only has to throw away the edges
+              that appear twice, with no intersections to compute, which is a lot faster for big watersheds.
+
+The coverage union needs the neighbors to have exactly the same vertices along their shared edges, and
+the unit catchments don't always: a long straight edge of one polygon can skip the corner where two of its
+neighbors meet. So first, we move the coordinates to whole pixels of the MERIT-Hydro grid, and add
+a vertex at every pixel corner along the edges. That only works if the polygons are on the grid,
+which is the case for the high-resolution unit catchments and the split terminal unit catchment,
+but not for the simplified ones. If they're not, or if GEOS still gives up, we use "unary" for that watershed.
+
+All of them give the same polygon (apart from the last few digits), and all finish with the same
+double buffer, see `buffer()`. To compare them on your computer, see benchmarks/dissolve.py.
 """
 
 import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.errors import GEOSException
 from shapely.geometry import Polygon, MultiPolygon
 gpd.options.use_pygeos = True
 
+# The choices for DISSOLVE_METHOD
+DISSOLVE_METHODS = ['clip', 'unary', 'coverage']
+
+# The MERIT-Hydro pixels are 3 arc-seconds, and the grid lines up with whole degrees
+PIXEL_SIZE = 1 / 1200
+
 
 def buffer(poly: Polygon) -> Polygon:
     """
@@ -68,7 +95,7 @@ def close_holes(poly: Polygon or MultiPolygon, area_max: float) -> Polygon or Mu
     elif isinstance(poly, MultiPolygon):
         # Handle MultiPolygon case
         result_polygons = []
-        for sub_poly in poly:
+        for sub_poly in poly.geoms:
             new_sub_poly = close_holes(sub_poly, area_max)
             result_polygons.append(new_sub_poly)
         return MultiPolygon(result_polygons)
@@ -125,4 +152,71 @@ def dissolve_geopandas(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     clipped = clipped.geometry.apply(lambda p: buffer(p))
 
     return clipped
-    
\ No newline at end of file
+    
+
+
+def dissolve_unary(df: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    """Same as `dissolve_geopandas()`, with shapely's union of all of the polygons at once."""
+    polygon = shapely.union_all(df.geometry.values)
+    return gpd.GeoSeries([buffer(polygon)], crs=df.crs)
+
+
+def to_pixels(geoms: np.ndarray) -> np.ndarray or None:
+    """
+    Moves the polygons to pixel coordinates (whole numbers) and adds a vertex at every pixel corner
+    along their edges, so that neighbors have exactly the same vertices on their shared edges.
+    Returns None if the polygons are not on the MERIT-Hydro grid.
+    """
+    coords = shapely.get_coordinates(geoms) / PIXEL_SIZE
+    if len(coords) == 0 or np.abs(coords - np.round(coords)).max() > 1e-4:
+        return None
+    pixels = shapely.transform(geoms, lambda c: np.round(c / PIXEL_SIZE))
+    # segmentize() puts the new vertices at fractions of each edge, which are not always whole numbers
+    return shapely.transform(shapely.segmentize(pixels, 1.0), np.round)
+
+
+def coverage_union(geoms: np.ndarray) -> Polygon or MultiPolygon or None:
+    """
+    The union of polygons that form a coverage (no overlaps), like the MERIT-Basins unit catchments,
+    without the buffer. Returns None if they are not on the MERIT-Hydro grid, or don't form a coverage after all.
+    """
+    pixels = to_pixels(geoms)
+    if pixels is None:
+        return None
+    try:
+        polygon = shapely.coverage_union_all(pixels)
+    except GEOSException:
+        return None
+    if not polygon.is_valid:
+        return None
+
+    # Back to degrees, without all of the extra vertices along the straight edges
+    return shapely.simplify(shapely.transform(polygon, lambda c: c * PIXEL_SIZE), 0)
+
+
+def dissolve_coverage(df: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    """
+    Same as `dissolve_geopandas()`, for polygons that form a coverage (no overlaps),
+    like the MERIT-Basins unit catchments. Falls back on `dissolve_unary()` if they don't.
+    """
+    polygon = coverage_union(np.asarray(df.geometry.values))
+    if polygon is None:
+        return dissolve_unary(df)
+    return gpd.GeoSeries([buffer(polygon)], crs=df.crs)
+
+
+def dissolve(df: gpd.GeoDataFrame, method: str = 'clip') -> gpd.GeoSeries:
+    """
+    Dissolves all of the polygons in `df` into one, with one of the DISSOLVE_METHODS.
+
+    Returns:
+        a GeoSeries with a single polygon
+    """
+    if method == 'clip':
+        return dissolve_geopandas(df)
+    elif method == 'unary':
+        return dissolve_unary(df)
+    elif method == 'coverage':
+        return dissolve_coverage(df)
+    else:
+        raise Exception(f"Unknown DISSOLVE_METHOD: {method}. Please use one of {DISSOLVE_METHODS}")
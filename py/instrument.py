@@ -0,0 +1,208 @@
+"""
+Timing and resource use for each stage of the delineation, so we can find out where the time goes.
+
+With REPORT = True in config.py, we measure the wall-clock time, the CPU time and the peak memory use (RSS)
+of each stage: reading the outlets, the spatial joins, loading the basin data, and for every outlet,
+the topology walk, the raster-based delineation (read / mask / snap / catchment / polygonize),
+dissolving, filling and simplifying, the area, and writing the outputs.
+
+At the end of the run, we write two files next to OUTPUT.csv:
+    RUN_REPORT.csv   one row per stage, per outlet and per basin
+    RUN_REPORT.json  the same rows, plus totals per stage and a list of the slowest outlets
+
+Each process keeps its own list of records. The worker processes send theirs back to
+the main process along with their results, see `mark()` and `take()`.
+
+About the memory: the operating system only tells us the highest RSS that a process has had so far.
+So `peak_rss_mb` is the peak for the process up to the end of the stage, and `rss_growth_mb` is how much
+that peak went up during the stage. The stage that pushed the peak up is the one with the growth.
+"""
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. We still report the times, just not the memory.
+    resource = None
+
+from config import Config
+
+# The columns of RUN_REPORT.csv
+FIELDS = ['level', 'basin', 'id', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rss_growth_mb', 'pid',
+          'result', 'unit_catchments', 'hits', 'misses', 'evictions']
+
+_enabled = False
+_records = []
+# The basins and outlets we are in at the moment, innermost last: dicts with 'basin', 'id' and any annotations
+_scopes = []
+
+
+def enable(on: bool = True):
+    """Turns the measurements on or off in this process (and in any processes we fork after this)."""
+    global _enabled
+    _enabled = on
+
+
+def peak_rss_mb() -> float or None:
+    """The highest resident memory (RSS) this process has used so far, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / 1e6
+    return peak * 1024 / 1e6
+
+
+def _record(stage: str, wall: float, cpu: float, rss_before: float or None, extra: dict = None):
+    # The basin and outlet id come from the innermost scope that has them
+    basin = next((s['basin'] for s in reversed(_scopes) if s['basin'] is not None), None)
+    wid = next((s['id'] for s in reversed(_scopes) if s['id'] is not None), None)
+    if wid is not None:
+        level = 'outlet'
+    elif basin is not None:
+        level = 'basin'
+    else:
+        level = 'run'
+
+    rss = peak_rss_mb()
+    record = {
+        'level': level,
+        'basin': basin,
+        'id': wid,
+        'stage': stage,
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'peak_rss_mb': None if rss is None else round(rss, 1),
+        'rss_growth_mb': None if rss is None else round(rss - rss_before, 1),
+        'pid': os.getpid(),
+    }
+    if extra:
+        record.update(extra)
+    _records.append(record)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Measures the code in a `with stage("name"):` block. Does nothing if the measurements are off.
+    The block is recorded even if it returns early or raises an exception.
+    """
+    if not _enabled:
+        yield
+        return
+
+    rss_before = peak_rss_mb()
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - t0, time.process_time() - c0, rss_before)
+
+
+@contextmanager
+def scope(name: str, basin: int = None, wid: str = None):
+    """
+    Like `stage()`, for all of the work on one basin or one outlet. The stages inside of the block
+    are recorded with this basin and/or outlet id, and the block itself as stage `name`, along with
+    anything we `annotate()` in the meantime (e.g. the result, or the raster cache counts).
+    """
+    if not _enabled:
+        yield
+        return
+
+    info = {'basin': basin, 'id': wid}
+    _scopes.append(info)
+    rss_before = peak_rss_mb()
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    try:
+        yield
+    finally:
+        extra = {k: v for k, v in info.items() if k not in ('basin', 'id')}
+        _record(name, time.perf_counter() - t0, time.process_time() - c0, rss_before, extra)
+        _scopes.pop()
+
+
+def annotate(**kwargs):
+    """Adds some information to the innermost basin or outlet that we are measuring."""
+    if _enabled and _scopes:
+        _scopes[-1].update(kwargs)
+
+
+def mark() -> int:
+    """
+    Remember where we are in the list of records. A forked worker process inherits the records of its parent,
+    so it uses `take(mark())` to send back only the records that it made itself.
+    """
+    return len(_records)
+
+
+def take(since: int = 0) -> list:
+    """Removes and returns the records made since `since` = mark()."""
+    taken = _records[since:]
+    del _records[since:]
+    return taken
+
+
+def extend(records: list):
+    """Adds the records that we got back from a worker process."""
+    _records.extend(records)
+
+
+def summarize(records: list) -> dict:
+    """Totals per stage (and level): number of times, total and maximum wall time, total CPU time."""
+    totals = {}
+    for r in records:
+        key = f"{r['level']}:{r['stage']}"
+        t = totals.setdefault(key, {'level': r['level'], 'stage': r['stage'], 'count': 0,
+                                    'wall_s': 0.0, 'cpu_s': 0.0, 'max_wall_s': 0.0})
+        t['count'] += 1
+        t['wall_s'] += r['wall_s']
+        t['cpu_s'] += r['cpu_s']
+        t['max_wall_s'] = max(t['max_wall_s'], r['wall_s'])
+
+    for t in totals.values():
+        t['wall_s'] = round(t['wall_s'], 4)
+        t['cpu_s'] = round(t['cpu_s'], 4)
+    # Biggest first
+    return dict(sorted(totals.items(), key=lambda item: -item[1]['wall_s']))
+
+
+def write_report(conf: Config, records: list, n_slowest: int = 20):
+    """Writes RUN_REPORT.csv and RUN_REPORT.json in OUTPUT_DIR."""
+    csv_fname = f"{conf.OUTPUT_DIR}/RUN_REPORT.csv"
+    with open(csv_fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, restval='', extrasaction='ignore')
+        writer.writeheader()
+        for r in records:
+            writer.writerow({k: ('' if v is None else v) for k, v in r.items()})
+
+    outlets = [r for r in records if r['level'] == 'outlet' and r['stage'] == 'outlet']
+    slowest = sorted(outlets, key=lambda r: -r['wall_s'])[:n_slowest]
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'outlets_csv': conf.OUTLETS_CSV,
+        'high_res': conf.HIGH_RES,
+        'workers': conf.WORKERS,
+        'basin_workers': conf.BASIN_WORKERS,
+        'run': next((r for r in records if r['level'] == 'run' and r['stage'] == 'run'), None),
+        'basins': [r for r in records if r['level'] == 'basin' and r['stage'] == 'basin'],
+        'stages': list(summarize(records).values()),
+        'slowest_outlets': slowest,
+        'records': records,
+    }
+
+    json_fname = f"{conf.OUTPUT_DIR}/RUN_REPORT.json"
+    with open(json_fname, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+
+    if conf.VERBOSE:
+        print(f"Wrote the timing report to {csv_fname} and {json_fname}")
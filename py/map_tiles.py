@@ -0,0 +1,272 @@
+"""
+One tile archive for the map viewer, instead of two .js files for every watershed (MAP_MODE = "tiles" in config.py).
+
+With MAP_MODE = "files", the script writes MAP_FOLDER/{id}.js and {id}_rivers.js for every watershed, and puts every
+row of the output table into _viewer.html. For a big run, that is tens of thousands of files and a web page that
+the browser can barely open. With MAP_MODE = "tiles", we write everything into one file, MAP_FOLDER/_tiles.bin,
+and the viewer only reads the parts of it that it needs for the area you are looking at.
+
+The archive has a few zoom levels (MAP_TILE_LEVELS). For each level, we simplify the watersheds and the rivers to
+about one screen pixel at that zoom, and cut the world into the usual web map tiles (Web Mercator, 256 pixels).
+Each tile lists:
+    w   the watersheds that touch it: [id, offset, length] of the watershed in the archive. A watershed is only
+        stored once per level, however many tiles it touches, so big watersheds are not cut into thousands of pieces.
+        At the levels where a watershed would touch more than MAX_WATERSHED_TILES tiles, it is not in the tiles at
+        all, but in the list of big watersheds for that level in the root directory, with its bounding box
+    r   the river reaches that touch it, as a GeoJSON FeatureCollection. Each reach is only stored once, even if
+        it is upstream of several outlets. The reaches that are shorter than a pixel are left out.
+    o   the rows of the output table for the outlets in the tile, so the table only has the outlets on the map
+
+The layout of the file, all text is JSON in UTF-8:
+    bytes 0-7     "DLTILES1"
+    bytes 8-23    offset and length of the root directory (two unsigned 64-bit integers, little endian)
+    ...           the watersheds and the tiles, one level after the other
+    ...           for each level, its directory: {"x/y": [offset, length]} of each tile
+    ...           the root directory: the levels, the offsets of their directories, the big watersheds,
+                  the columns of the table
+
+The viewer reads it with HTTP range requests, or, if you open _viewer.html from your disk (where the browser is not
+allowed to read other files), it asks you to pick _tiles.bin, and reads the parts it needs from that.
+"""
+import json
+import math
+import struct
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from py.quantize import quantize
+
+MAGIC = b"DLTILES1"
+HEADER_SIZE = 24
+TILE_SIZE = 256
+
+# Web Mercator does not reach the poles
+MAX_LAT = 85.0511287798
+
+# A watershed that touches more tiles than this at a level goes in the root directory instead of the tiles.
+# Otherwise, at level 12, one continental watershed would be listed in about 100,000 tiles.
+MAX_WATERSHED_TILES = 64
+
+
+def pixel_size(level: int) -> float:
+    """The size of one screen pixel at a zoom level, in degrees (at the equator)."""
+    return 360.0 / (TILE_SIZE * 2 ** level)
+
+
+def tile_xy(lng, lat, level: int) -> (np.ndarray, np.ndarray):
+    """The web map tile that each point is in, at a zoom level."""
+    n = 2 ** level
+    lng = np.asarray(lng, dtype=float)
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LAT, MAX_LAT))
+    x = np.floor((lng + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def tile_bounds(x: np.ndarray, y: np.ndarray, level: int) -> np.ndarray:
+    """The bounding boxes (minx, miny, maxx, maxy) of web map tiles, in degrees."""
+    n = 2 ** level
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # The latitudes of the top and bottom edges of the tiles
+    top = np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * y / n))))
+    bottom = np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * (y + 1) / n))))
+    return np.column_stack([x / n * 360.0 - 180.0, bottom, (x + 1) / n * 360.0 - 180.0, top])
+
+
+def _simplify(geoms: np.ndarray, tolerance: float) -> np.ndarray:
+    # preserve_topology only works within each part of a MultiPolygon, so the parts can end up overlapping
+    simple = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    invalid = ~shapely.is_valid(simple) & ~shapely.is_missing(simple)
+    if np.any(invalid):
+        simple[invalid] = shapely.make_valid(simple[invalid])
+    return simple
+
+
+def simplify(geoms: np.ndarray, levels: list, decimals: int) -> np.ndarray:
+    """
+    Simplifies shapes to the most detailed level of the archive, and rounds their coordinates.
+    We do this in the worker processes, so we don't keep the full-resolution shapes for every outlet until the end.
+    """
+    return quantize(_simplify(np.asarray(geoms, dtype=object), pixel_size(max(levels))), decimals)
+
+
+def tile_ranges(bounds: np.ndarray, level: int) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """The first and last tile (x and y) that each bounding box (minx, miny, maxx, maxy) touches."""
+    x0, y1 = tile_xy(bounds[:, 0], bounds[:, 1], level)
+    x1, y0 = tile_xy(bounds[:, 2], bounds[:, 3], level)
+    return x0, x1, y0, y1
+
+
+def _tiles(x0: int, x1: int, y0: int, y1: int) -> list:
+    return [f"{x}/{y}" for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def _footprint(geom, x0: int, x1: int, y0: int, y1: int, level: int) -> list:
+    # The tiles in the bounding box that the shape really touches
+    x, y = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1), indexing='ij')
+    x, y = x.ravel(), y.ravel()
+    touches = shapely.intersects(geom, shapely.box(*tile_bounds(x, y, level).T))
+    return [f"{i}/{j}" for i, j in zip(x[touches], y[touches])]
+
+
+def _tile(tiles: dict, key: str) -> dict:
+    # The content of a tile, a new one if it is not there yet
+    if key not in tiles:
+        tiles[key] = {'w': [], 'r': [], 'o': []}
+    return tiles[key]
+
+
+class _Archive:
+    # Writes the pieces of the archive one after the other, and keeps track of where they are
+    def __init__(self, fname: str):
+        self.f = open(fname, 'wb')
+        self.f.write(MAGIC + struct.pack('<QQ', 0, 0))
+        self.offset = HEADER_SIZE
+
+    def write(self, text: str) -> list:
+        data = text.encode('utf-8')
+        self.f.write(data)
+        where = [self.offset, len(data)]
+        self.offset += len(data)
+        return where
+
+    def close(self, root: dict):
+        offset, length = self.write(json.dumps(root))
+        self.f.seek(len(MAGIC))
+        self.f.write(struct.pack('<QQ', offset, length))
+        self.f.close()
+
+
+def _to_json(value):
+    # For the NumPy numbers in the tables, which json can't write
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Can't write {type(value)} to JSON")
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, default=_to_json)
+
+
+def _watershed_features(watersheds: pd.DataFrame, geojson: np.ndarray) -> list:
+    # The GeoJSON text of each watershed, with its fields
+    properties = watersheds.drop(columns='geometry').astype(object)
+    properties = properties.where(properties.notna(), None)
+    return [f'{{"type":"Feature","properties":{_dumps(props)},"geometry":{geom}}}'
+            for props, geom in zip(properties.to_dict(orient='records'), geojson)]
+
+
+def write_archive(fname: str, watersheds: pd.DataFrame, rivers: pd.DataFrame, outlets: list,
+                  columns: list, names: list, levels: list, decimals: int) -> int:
+    """
+    Writes the tile archive for the map viewer.
+
+    Args:
+        fname: where to write it, e.g. MAP_FOLDER/_tiles.bin
+        watersheds: one row per watershed, with the 'id', the 'geometry' and the fields to show
+        rivers: the river reaches, one row per COMID, with the stream 'order' and the 'geometry'
+        outlets: for each row of the table, a dict with 'row' (the values in the table), 'lat' and 'lng'
+            of the outlet and 'snap' (the snapped outlet or None). The bounding box of the watershed is added here.
+        columns, names: the columns of the table, and the names to show for them
+        levels: the zoom levels, e.g. [3, 6, 9, 12]
+        decimals: the coordinates are rounded to this many decimal places
+
+    Returns:
+        the number of tiles
+    """
+    archive = _Archive(fname)
+    levels = sorted(set(int(z) for z in levels))
+    ids = watersheds['id'].to_numpy()
+    geoms = np.asarray(watersheds.geometry.values, dtype=object)
+    bounds = shapely.bounds(geoms).reshape(-1, 4)
+    river_geoms = np.asarray(rivers.geometry.values, dtype=object)
+    river_orders = rivers['order'].to_numpy()
+    river_bounds = shapely.bounds(river_geoms).reshape(-1, 4)
+
+    # The outlets, with the bounding box of their watershed, so the viewer can zoom to it
+    bbox = {wid: [round(float(v), decimals) for v in b] for wid, b in zip(ids, bounds)}
+    for outlet in outlets:
+        outlet['bbox'] = bbox.get(outlet['row'][0])
+    outlet_lng = np.array([o['lng'] for o in outlets], dtype=float)
+    outlet_lat = np.array([o['lat'] for o in outlets], dtype=float)
+
+    directories = {}
+    big = {}
+    n_tiles = 0
+    for level in levels:
+        tolerance = pixel_size(level)
+        tiles = {}
+
+        # The watersheds, simplified for this level, each one stored once
+        simple = quantize(_simplify(geoms, tolerance), decimals)
+        features = _watershed_features(watersheds, shapely.to_geojson(simple))
+        x0, x1, y0, y1 = tile_ranges(bounds, level)
+        n_touched = (x1 - x0 + 1) * (y1 - y0 + 1)
+        big[level] = []
+        for k, feature in enumerate(features):
+            where = archive.write(feature)
+            if n_touched[k] > MAX_WATERSHED_TILES:
+                big[level].append([str(ids[k])] + where + [round(float(v), decimals) for v in bounds[k]])
+                continue
+            keys = _tiles(x0[k], x1[k], y0[k], y1[k])
+            if len(keys) > 1:
+                keys = _footprint(simple[k], x0[k], x1[k], y0[k], y1[k], level) or keys
+            for key in keys:
+                _tile(tiles, key)['w'].append([str(ids[k])] + where)
+
+        # The rivers, without the ones that are too short to see at this level
+        simple = quantize(_simplify(river_geoms, tolerance), decimals)
+        keep = np.flatnonzero(~shapely.is_empty(simple) & (shapely.length(river_geoms) >= tolerance))
+        geojson = shapely.to_geojson(simple[keep])
+        x0, x1, y0, y1 = tile_ranges(river_bounds[keep], level)
+        for j, k in enumerate(keep):
+            feature = f'{{"type":"Feature","properties":{{"order":{int(river_orders[k])}}},"geometry":{geojson[j]}}}'
+            for key in _tiles(x0[j], x1[j], y0[j], y1[j]):
+                _tile(tiles, key)['r'].append(feature)
+
+        # The rows of the table
+        x, y = tile_xy(outlet_lng, outlet_lat, level)
+        for k, outlet in enumerate(outlets):
+            _tile(tiles, f"{x[k]}/{y[k]}")['o'].append(outlet)
+
+        directory = {}
+        for key, content in tiles.items():
+            text = (f'{{"w":{_dumps(content["w"])},'
+                    f'"r":{{"type":"FeatureCollection","features":[{",".join(content["r"])}]}},'
+                    f'"o":{_dumps(content["o"])}}}')
+            directory[key] = archive.write(text)
+        directories[level] = archive.write(json.dumps(directory))
+        n_tiles += len(tiles)
+
+    all_bounds = [float(np.min(bounds[:, 0])), float(np.min(bounds[:, 1])),
+                  float(np.max(bounds[:, 2])), float(np.max(bounds[:, 3]))] if len(bounds) else None
+    archive.close({'version': 1, 'levels': levels, 'directories': {str(z): d for z, d in directories.items()},
+                   'big': {str(z): b for z, b in big.items()}, 'columns': columns, 'names': names, 'bounds': all_bounds, 'count': len(outlets)})
+    return n_tiles
+
+
+def read_archive(fname: str, level: int = None, key: str = None) -> dict:
+    """
+    Reads the root directory of an archive, or one tile (e.g. level 9, key "490/277"). For checking the archive
+    from Python; the viewer does the same thing in JavaScript.
+    """
+    with open(fname, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise Exception(f"{fname} is not a map tile archive")
+        offset, length = struct.unpack('<QQ', header[len(MAGIC):])
+        f.seek(offset)
+        root = json.loads(f.read(length))
+        if level is None:
+            return root
+        offset, length = root['directories'][str(level)]
+        f.seek(offset)
+        directory = json.loads(f.read(length))
+        if key not in directory:
+            return {'w': [], 'r': {'type': 'FeatureCollection', 'features': []}, 'o': []}
+        offset, length = directory[key]
+        f.seek(offset)
+        return json.loads(f.read(length))
@@ -1,11 +1,16 @@
 """
 Makes a nice little map in an .html file for viewing in a web browser
 using a bit of javascript and Leaflet.
+
+With MAP_MODE = "tiles", the watersheds and rivers go into one tile archive instead of
+a .js file for each of them, see py/map_tiles.py.
 """
 import pandas as pd
 from jinja2 import Template
 import os
 
+from py import map_tiles
+
 def create_folder_if_not_exists(config) -> bool:
     """
     Check if a folder exists at the specified path. If not, create it.
@@ -27,17 +32,22 @@ def create_folder_if_not_exists(config) -> bool:
         print(f"Error creating folder: {e}")
         return False
 
-def make_map(config, df: pd.DataFrame) -> bool:
+def make_map(config, df: pd.DataFrame, map_data: list = None) -> bool:
     """
 
     input:
         df: a Pandas dataframe with the cols [id, lat, lng, name, area_reported, area_calc, result]
+        map_data: with MAP_MODE = "tiles", the watersheds and rivers from write_watershed(),
+            a dict for each watershed with 'watershed' and 'rivers'
 
     returns:
         True if it successfully wrote the file viewer.html.
         Otherwise, the function will raise some kind of error message
 
     """
+    # The numbers before we format them, for the tile archive
+    values = df.copy()
+
     # Reorganize the columns a bit so it looks good.
     # Here is the full set of columns, and the order I like
     cols_sorted = ['id', 'name', 'result', 'lat', 'lng', 'lat_snap', 'lng_snap', 'snap_dist', 'area_reported',
@@ -72,13 +82,6 @@ def make_map(config, df: pd.DataFrame) -> bool:
     # Drop rows where result == 'failed'; these won't display correctly
     df = df[df.result != 'failed']
 
-    # Use a jinja template to create the html file
-    template_file = "py/viewer_template.html"
-    with open(template_file, 'r') as f:
-        template_str = f.read()
-
-    template = Template(template_str)
-
     # Give the columns nicer names
     columns = df.columns.to_list()
     col_names = {
@@ -97,6 +100,16 @@ def make_map(config, df: pd.DataFrame) -> bool:
 
     pretty_columns = [col_names[c] for c in columns]
 
+    if config.MAP_MODE == "tiles":
+        return make_tile_map(config, values, df, columns, pretty_columns, map_data or [])
+
+    # Use a jinja template to create the html file
+    template_file = "py/viewer_template.html"
+    with open(template_file, 'r') as f:
+        template_str = f.read()
+
+    template = Template(template_str)
+
     html = template.render(
         rows=df.to_dict(orient='records'),
         columns=pretty_columns,
@@ -112,3 +125,46 @@ def make_map(config, df: pd.DataFrame) -> bool:
     f.close()
 
     return True
+
+
+def make_tile_map(config, values: pd.DataFrame, df: pd.DataFrame, columns: list, pretty_columns: list,
+                  map_data: list) -> bool:
+    """
+    For MAP_MODE = "tiles": writes all of the watersheds, rivers and rows of the table into MAP_FOLDER/_tiles.bin,
+    and a viewer that only reads the tiles for the part of the map that you are looking at.
+
+    input:
+        values: the table before formatting the numbers, for the coordinates of the outlets
+        df: the table, formatted for the viewer, with the columns `columns`
+    """
+    watersheds = pd.DataFrame([m['watershed'] for m in map_data], columns=None if map_data else ['id', 'geometry'])
+    rivers = [m['rivers'] for m in map_data if m['rivers'] is not None]
+    if rivers:
+        rivers = pd.concat(rivers)
+        # The same river reach is upstream of all of the outlets below it; we only need it once
+        rivers = rivers[~rivers.index.duplicated()]
+    else:
+        rivers = pd.DataFrame(columns=['order', 'geometry'])
+
+    outlets = []
+    for wid, row in zip(df['id'], df.itertuples(index=False)):
+        outlet = {'row': list(row), 'lat': float(values.at[wid, 'lat']), 'lng': float(values.at[wid, 'lng']),
+                  'snap': None}
+        if 'lat_snap' in values and pd.notna(values.at[wid, 'lat_snap']):
+            outlet['snap'] = [float(values.at[wid, 'lat_snap']), float(values.at[wid, 'lng_snap'])]
+        outlets.append(outlet)
+
+    archive_fname = f"{config.MAP_FOLDER}/_tiles.bin"
+    n_tiles = map_tiles.write_archive(archive_fname, watersheds, rivers, outlets, columns, pretty_columns,
+                                      config.MAP_TILE_LEVELS, config.OUTPUT_DECIMALS)
+    if config.VERBOSE:
+        print(f"Wrote {len(watersheds)} watersheds and {len(rivers)} river reaches in {n_tiles} tiles to {archive_fname}")
+
+    with open("py/viewer_tiles_template.html", 'r') as f:
+        template = Template(f.read())
+    html = template.render(columns=pretty_columns, archive="_tiles.bin")
+
+    with open(f"{config.MAP_FOLDER}/_viewer.html", 'w') as f:
+        f.write(html)
+
+    return True
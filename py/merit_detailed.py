@@ -7,12 +7,14 @@ Raster-based delineation is slow and requires a lot of memory. So we only do the
 and use vector data for the rest of the upstream watershed.
 """
 import os
+import numpy as np
 from numpy import floor, ceil
 from pysheds.grid import Grid
 from shapely.geometry import Polygon, MultiPolygon
 from shapely import wkb, ops
 
 from py.raster_plots import *
+from py import raster_catchment, raster_cache, raster_store, instrument
 from config import Config
 
 
@@ -102,7 +104,7 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     if conf.VERBOSE: 
         print(" using windowed reading mode with bounding_box = {}".format(repr(bounding_box)))
 
-    if not os.path.isfile(fdir_fname):
+    if not os.path.isfile(fdir_fname) and not raster_store.has_raster(conf, fdir_fname):
         raise Exception("Could not find flow flow direction raster: {}".format(fdir_fname))
 
     # The pysheds documentation was not up-to-date. Seems there were some changes in the API
@@ -112,8 +114,9 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     # You can still use it without numba, but the code is older and has not evolved with the new stuff (?)
     # Anyhow, the old version worked better for me in my testing.
     # grid = Grid.from_raster(path=fdir_fname, data=fdir_fname, data_name="myflowdir", window=bounding_box,nodata=0)
-    grid = Grid.from_raster(fdir_fname, window=bounding_box, nodata=0)
-    fdir = grid.read_raster(fdir_fname, window=bounding_box, nodata=0)
+    with instrument.stage('split/read'):
+        fdir = read_window(conf, basin, fdir_fname, bounding_box)
+        grid = Grid.from_raster(fdir)
     # Now "clip" the rectangular flow direction grid even further so that it ONLY contains data
     # inside the bounaries of the terminal unit catchment.
     # This prevents us from accidentally snapping the pour point to a neighboring watershed.
@@ -133,16 +136,25 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     multi_poly = MultiPolygon([filled_poly])
     polygon_list = list(multi_poly.geoms)
 
-    # Convert the polygon into a pixelized raster "mask".
-    mymask = grid.rasterize(polygon_list)
+    # Convert the polygon into a pixelized raster "mask". One byte per pixel is plenty (the default is int64).
+    with instrument.stage('split/mask'):
+        mymask = grid.rasterize(polygon_list, dtype=np.uint8)
     # grid.add_gridded_data(mymask, data_name="mymask", affine=grid.affine, crs=grid.crs, shape=grid.shape)
 
+    # The pixels outside of the unit catchment. We use the same boolean array for
+    # the flow direction and the accumulation rasters below.
+    outside = np.asarray(mymask) == 0
+
+    # MERIT-Hydro flow directions fit in one byte. Make sure we don't carry a bigger data type around.
+    if fdir.dtype != np.uint8:
+        fdir = fdir.astype(np.uint8)
+    elif not fdir.flags.writeable:
+        # A window of the memory-mapped raster store. This is the only copy we make.
+        fdir = fdir.copy()
+
     # I believe this step was unnecessary, but it makes the plots look a little nicer
-    m, n = grid.shape
-    for i in range(0, m):
-        for j in range(0, n):
-            if int(mymask[i, j]) == 0:
-                fdir[i, j] = 0
+    # (Set all the pixels outside the mask to zero, in place, as a single NumPy operation.)
+    fdir[outside] = 0
 
     # Plot the mask that I created from rasterized vector polygon
     if conf.PLOTS:
@@ -160,10 +172,11 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
 
     # Open the accumulation raster, again using windowed reading mode.
     accum_fname = '{}/accum{}.tif'.format(conf.MERIT_ACCUM_DIR, basin)
-    if not os.path.isfile(accum_fname):
+    if not os.path.isfile(accum_fname) and not raster_store.has_raster(conf, accum_fname):
         raise Exception("Could not find accumulation raster: {}".format(accum_fname))
 
-    acc = grid.read_raster(accum_fname, data_name="acc", window=bounding_box, window_crs=grid.crs, nodata=0)
+    with instrument.stage('split/read'):
+        acc = read_window(conf, basin, accum_fname, bounding_box)
 
     # Clips the flow direction grid to a new rectangular bounding box.
     # that corresponds to the mask of the unit catchment.
@@ -175,13 +188,13 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     # to a neighboring watershed. It took me a bunch of experimenting to realize
     # that this is the key to getting good results in small watersheds, especially
     # when there are other streams nearby.
-    # The approach I used (looping over every pixel in the grid) is simple but a little hackish.
-    # Would be better implemented as a method in pysheds.
-    m, n = grid.shape
-    for i in range(0, m):
-        for j in range(0, n):
-            if int(mymask[i, j]) == 0:
-                acc[i, j] = 0
+    # I used to do this by looping over every pixel in Python, which was very slow for big unit catchments.
+    # Note that the mask and the accumulation raster cover the whole window, so we use the mask
+    # from before the clip_to() above.
+    with instrument.stage('split/mask'):
+        if not acc.flags.writeable:
+            acc = acc.copy()
+        acc[outside] = 0
 
     # Snap the outlet to the nearest stream. This function depends entirely on the threshold
     # that you set for how minimum number of upstream pixels to define a waterway.
@@ -205,7 +218,8 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     streams = acc > numpixels
     xy = (lng, lat)
     try:
-        [lng_snap, lat_snap] = grid.snap_to_mask(streams, xy)  # New version does not give you the snap distance.
+        with instrument.stage('split/snap'):
+            [lng_snap, lat_snap] = grid.snap_to_mask(streams, xy)  # New version does not give you the snap distance.
     except Exception as e:
         if conf.VERBOSE: 
             print(f"Could not snap the pour point. Error: {e}")
@@ -223,17 +237,22 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     if conf.VERBOSE: 
         print("Delineating catchment")
     try:
-        catch = grid.catchment(fdir=fdir,
-                               x=lng_snap,
-                               y=lat_snap,
-                               dirmap=dirmap,
-                               xytype='coordinate',
-                               recursionlimit=15000)
-
-        # Clip the bounding box to the catchment
-        # Seems optional, but turns out this line is essential.
-        grid.clip_to(catch)
-        clipped_catch = grid.view(catch, dtype=np.uint8)
+        with instrument.stage('split/catchment'):
+            if conf.CATCHMENT_ENGINE == "iterative":
+                # Our own engine in py/raster_catchment.py. Same result, but no recursion limit to worry about.
+                catch = raster_catchment.catchment(grid, fdir, x=lng_snap, y=lat_snap, dirmap=dirmap)
+            else:
+                catch = grid.catchment(fdir=fdir,
+                                       x=lng_snap,
+                                       y=lat_snap,
+                                       dirmap=dirmap,
+                                       xytype='coordinate',
+                                       recursionlimit=15000)
+
+            # Clip the bounding box to the catchment
+            # Seems optional, but turns out this line is essential.
+            grid.clip_to(catch)
+            clipped_catch = grid.view(catch, dtype=np.uint8)
     except Exception as e:
         if conf.VERBOSE: 
             print(f"ERROR: something went wrong during pysheds grid.catchment(). Error: {e}")
@@ -242,7 +261,9 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     # Convert high-precision raster subcatchment to a polygon using pysheds method .polygonize()
     if conf.VERBOSE: 
         print("Converting to polygon")
-    shapes = grid.polygonize(clipped_catch)
+    with instrument.stage('split/polygonize'):
+        # (It returns a generator. Make it a list, so the work is done, and timed, here.)
+        shapes = list(grid.polygonize(clipped_catch))
 
 
     # The output from pysheds is creating MANY shapes.
@@ -299,6 +320,25 @@ def split_catchment(conf: Config, wid: str, basin: int, lat: float, lng: float,
     return result_polygon, lat_snap, lng_snap
 
 
+def read_window(conf: Config, basin: int, fname: str, bounding_box: tuple):
+    """
+    Reads the part of a raster file inside `bounding_box` as a pysheds Raster, with nodata = 0.
+    If RASTER_CACHE_MB > 0, the window is put together from decoded blocks that we keep in memory
+    (see py/raster_cache.py), so neighboring outlets don't have to read and decompress the same pixels again.
+    If the raster was converted with `python -m py.raster_store`, and RASTER_STORE_DIR is set, the window is
+    sliced from the memory-mapped copy instead. In that case, it is read-only.
+    """
+    if raster_store.has_raster(conf, fname):
+        window = raster_store.read_window(conf, fname, bounding_box, nodata=0)
+        if window is not None:
+            return window
+
+    if conf.RASTER_CACHE_MB > 0:
+        return raster_cache.get_cache(conf, basin).read_window(fname, bounding_box, nodata=0)
+
+    return Grid().read_raster(fname, window=bounding_box, nodata=0)
+
+
 def get_largest(input_poly: MultiPolygon or Polygon) -> Polygon:
     """
     Converts a Shapely MultiPolygon to a Shapely Polygon
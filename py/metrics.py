@@ -0,0 +1,143 @@
+"""
+Areas, perimeters and distances on the WGS84 ellipsoid, for many watersheds at once.
+
+The script used to project each watershed into its own Albers equal-area projection to get its area,
+with shapely.ops.transform() and the deprecated pyproj.transform(), which sets up two new projections
+for every watershed (and every part of it). Now we work out the areas and perimeters on the ellipsoid directly,
+with pyproj's geodesic routines, which run on whole arrays of coordinates. `aea_area()`
+is the old method, with the projection done on arrays, so we can check that the two agree
+(see benchmarks/area.py: the differences are far smaller than the 3 significant digits in the output).
+
+The snap distances and the percent differences from the reported areas are also worked out for all
+of the outlets at once, at the end of the run (see `add_metrics()`).
+"""
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+
+GEOD = pyproj.Geod(ellps='WGS84')
+
+
+def _rings(polygons) -> (np.ndarray, list, np.ndarray, np.ndarray):
+    """
+    The rings of the polygons, as arrays of coordinates.
+    Returns the coordinates, where each ring starts and ends in them, which polygon each ring is in,
+    and whether each ring is an exterior ring (and not a hole).
+    """
+    geoms = np.asarray(polygons, dtype=object)
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    coords, coord_index = shapely.get_coordinates(rings, return_index=True)
+    bounds = np.searchsorted(coord_index, np.arange(len(rings) + 1))
+    # The first ring of each part is its exterior ring
+    exterior = np.ones(len(rings), dtype=bool)
+    exterior[1:] = ring_index[1:] != ring_index[:-1]
+    return coords, bounds, part_index[ring_index], exterior
+
+
+def geodesic_area_perimeter(polygons) -> (np.ndarray, np.ndarray):
+    """
+    The areas and perimeters of (multi)polygons in lat, lng coordinates, on the WGS84 ellipsoid.
+
+    Args:
+        polygons: a list or array of shapely polygons
+
+    Returns:
+        the areas in km² and the perimeters in km, as arrays
+    """
+    coords, bounds, polygon, exterior = _rings(polygons)
+    ring_area = np.zeros(len(exterior))
+    ring_perimeter = np.zeros(len(exterior))
+    for k in range(len(exterior)):
+        ring = coords[bounds[k]:bounds[k + 1]]
+        area, perimeter = GEOD.polygon_area_perimeter(ring[:, 0], ring[:, 1])
+        ring_area[k] = abs(area)
+        ring_perimeter[k] = perimeter
+
+    n = len(polygons)
+    area = np.bincount(polygon, weights=np.where(exterior, ring_area, -ring_area), minlength=n)
+    perimeter = np.bincount(polygon, weights=ring_perimeter, minlength=n)
+    return area / 1e6, perimeter / 1e3
+
+
+def geodesic_area(polygon) -> float:
+    """The area of one polygon in lat, lng coordinates, in km²."""
+    return float(geodesic_area_perimeter([polygon])[0][0])
+
+
+def aea_area(polygons) -> np.ndarray:
+    """
+    The areas in km² the way the script used to work them out: each polygon projected into an Albers equal-area
+    projection with standard parallels at its southern and northern edges. For checking `geodesic_area_perimeter()`.
+    """
+    areas = np.zeros(len(polygons))
+    for k, poly in enumerate(polygons):
+        if poly.is_empty:
+            continue
+        _, south, _, north = poly.bounds
+        transformer = pyproj.Transformer.from_crs('EPSG:4326', pyproj.CRS(proj='aea', lat_1=south, lat_2=north),
+                                                  always_xy=True)
+        projected = shapely.transform(poly, lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])))
+        areas[k] = projected.area / 1e6
+    return areas
+
+
+def snap_distances(lat, lng, lat_snap, lng_snap) -> np.ndarray:
+    """The distances in meters from the outlets to the snapped outlets, on the WGS84 ellipsoid."""
+    return GEOD.inv(np.asarray(lng, dtype=float), np.asarray(lat, dtype=float),
+                    np.asarray(lng_snap, dtype=float), np.asarray(lat_snap, dtype=float))[2]
+
+
+def round_sigfig(values, digits: int) -> np.ndarray:
+    """
+    Rounds an array of numbers to significant digits, like sigfig.round() does for one number.
+    Zeros, infinities and NaNs are left as they are.
+    """
+    x = np.asarray(values, dtype=float)
+    finite = np.isfinite(x) & (x != 0)
+    magnitude = np.floor(np.log10(np.abs(np.where(finite, x, 1.0))))
+    decimals = digits - 1 - magnitude
+    # Multiply or divide by exact powers of 10, so that e.g. 0.0012 and 2800.0 come out exactly.
+    # Halves are rounded away from zero, like sigfig does (np.round() rounds them to even).
+    up = 10.0 ** np.maximum(decimals, 0)
+    down = 10.0 ** np.maximum(-decimals, 0)
+    scaled = x * up / down
+    rounded = np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)
+    return np.where(finite, rounded * down / up, x)
+
+
+def add_metrics(gages_df: pd.DataFrame, records_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the snap distance (m) and the percent difference from the reported area to the results
+    of all of the watersheds, and writes them into the output table.
+
+    Args:
+        gages_df: the output table, indexed by id, with lat, lng and maybe area_reported
+        records_df: the results of the watersheds, indexed by id, with 'lat_snap' and 'lng_snap' rounded
+            for the output table, and 'snap_lat' and 'snap_lng' that are not rounded, which we drop
+
+    Returns:
+        gages_df
+    """
+    if len(records_df) == 0:
+        return gages_df
+    records_df = records_df.copy()
+    outlets = gages_df.loc[records_df.index]
+    snap_dist = snap_distances(outlets['lat'], outlets['lng'], records_df.pop('snap_lat'), records_df.pop('snap_lng'))
+    records_df.insert(records_df.columns.get_loc('lat_snap'), 'snap_dist', round_sigfig(snap_dist, 2))
+
+    if 'area_reported' in gages_df:
+        area_reported = outlets['area_reported'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perc_diff = (records_df['area_calc'].to_numpy(dtype=float) - area_reported) / area_reported * 100
+        records_df['perc_diff'] = round_sigfig(perc_diff, 2)
+
+    for column in records_df.columns:
+        values = records_df[column]
+        if column in gages_df and pd.api.types.is_integer_dtype(gages_df[column]) and \
+                not np.all(np.mod(values.to_numpy(dtype=float), 1) == 0):
+            # The column started out as zeros, but the values have decimals
+            gages_df[column] = gages_df[column].astype(float)
+        gages_df.loc[records_df.index, column] = values
+    return gages_df
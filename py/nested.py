@@ -0,0 +1,227 @@
+"""
+Nested gage networks: the incremental (inter-gage) areas between gages on the same river.
+
+For model calibration, we often want not only the full watershed of every gage, but also the area
+between a gage and the next gages upstream of it. Instead of delineating all of the full watersheds
+and subtracting them from each other afterwards, with NESTED = True in config.py we:
+
+  1. Find the gages that are upstream of each gage, using the river network (up1..up4).
+     With the Euler tour intervals (see py/topology.py), gage A is upstream of gage B if the interval
+     of A's terminal unit catchment is inside the interval of B's. The next gage downstream of a gage
+     is the one with the smallest interval around it.
+  2. Build the incremental area of each gage once, from the unit catchments between it and the gages
+     just upstream of it: the (split) terminal unit catchment, plus the unit catchments in its interval
+     that are not in the interval of an upstream gage. In high-res mode, the unit catchment of an
+     upstream gage is split at the gage, so we add the whole unit catchment and take away the
+     split part, which belongs to the upstream gage.
+  3. Compose the full watersheds from the pieces, in topological order (upstream gages first):
+     the full watershed of a gage is its incremental area plus the full watersheds of the gages
+     just upstream of it.
+
+Two gages can be in the same unit catchment. Then the river network can't tell us which one is
+upstream, so we look at their split polygons: the gage whose polygon is (mostly) inside of
+the other one is upstream. They can also be on different tributaries in the same unit catchment, so that
+neither one is upstream of the other. The unit catchments upstream flow in at one place, so exactly one
+gage in each unit catchment gets them (see inflow_owners()): the smallest one whose polygon touches the
+unit catchments just upstream. The others only get their own (split) polygon. GAUGE_NETWORK.csv tells you
+which gages got the unit catchments upstream (upstream_inflow).
+
+At the end, we write the incremental areas to INCREMENTAL.gpkg (or whatever OUTPUT_EXT is),
+and the connectivity of the gages to GAUGE_NETWORK.csv.
+"""
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+from config import Config
+from py.fast_dissolve import dissolve, buffer
+from py.quantize import quantize_gdf, for_output
+from py.topology import UpstreamIndex
+
+# How close (in degrees) a gage's split polygon has to be to the unit catchments just upstream to get them.
+# About one pixel of MERIT-Hydro (3 arc seconds = 0.00083°), as the split polygons are made of pixels.
+INFLOW_TOLERANCE = 0.001
+
+
+def _contains(outer: dict, inner: dict) -> bool:
+    """For two gages in the same unit catchment, is `inner` upstream of `outer`?"""
+    if outer['area'] < inner['area'] or (outer['area'] == inner['area'] and outer['index'] > inner['index']):
+        return False
+    overlap = outer['terminal_poly'].intersection(inner['terminal_poly']).area
+    return overlap > 0.5 * inner['area']
+
+
+def inflow_owners(topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame, gages: list):
+    """
+    For each unit catchment with gages in it, picks the one gage that gets the unit catchments upstream of it:
+    the smallest one whose (split) polygon touches the unit catchments just upstream, or the smallest one
+    if none of them do. Sets 'owner' to True for that gage, and False for the others in the same unit catchment.
+    """
+    by_row = {}
+    for g in gages:
+        by_row.setdefault(g['row'], []).append(g)
+    for row, group in by_row.items():
+        for g in group:
+            g['owner'] = False
+        touching = group
+        children = topo.children[topo.indptr[row]:topo.indptr[row + 1]]
+        if len(group) > 1 and len(children) > 0:
+            inflow = unary_union(topo.select(catchments_gdf, children).geometry.values)
+            touching = [g for g in group if shapely.dwithin(g['terminal_poly'], inflow, INFLOW_TOLERANCE)] or group
+        min(touching, key=lambda g: (g['area'], g['index']))['owner'] = True
+
+
+def build_network(topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame, gages: list) -> list:
+    """
+    Finds the next gage downstream of each gage.
+
+    Args:
+        gages: list of dicts, with the 'row' (in the topology index) of the terminal unit catchment
+            and its (split) polygon 'terminal_poly'. We add the 'index' and the 'area' of the polygon,
+            and 'owner', see inflow_owners().
+
+    Returns:
+        a list with, for each gage, the index of the next gage downstream, or -1 if there is none
+    """
+    topo.euler()
+    rows = np.array([g['row'] for g in gages], dtype=np.int64)
+    starts = topo.start[rows]
+    ends = topo.end[rows]
+    for k, g in enumerate(gages):
+        g['index'] = k
+        g['area'] = g['terminal_poly'].area
+    inflow_owners(topo, catchments_gdf, gages)
+
+    downstream = []
+    for k, g in enumerate(gages):
+        # All of the gages whose watersheds contain this gage's terminal unit catchment
+        candidates = np.flatnonzero((starts <= starts[k]) & (starts[k] < ends))
+        candidates = [c for c in candidates.tolist() if c != k and
+                      (rows[c] != rows[k] or _contains(gages[c], g))]
+        if not candidates:
+            downstream.append(-1)
+            continue
+
+        # The closest ones are in the unit catchment furthest upstream. If there are several gages in it,
+        # take the smallest one, or if this gage is further upstream, the one that gets the unit catchments
+        # upstream (we are in them)
+        deepest = max(starts[c] for c in candidates)
+        closest = [c for c in candidates if starts[c] == deepest]
+        if rows[closest[0]] != rows[k]:
+            closest = [c for c in closest if gages[c]['owner']] or closest
+        downstream.append(min(closest, key=lambda c: gages[c]['area']))
+
+    return downstream
+
+
+def upstream_first(gages: list, downstream: list) -> list:
+    """The order to compose the watersheds in: every gage after all of the gages upstream of it."""
+    n = len(gages)
+    n_upstream = [0] * n
+    for d in downstream:
+        if d >= 0:
+            n_upstream[d] += 1
+    order = [k for k in range(n) if n_upstream[k] == 0]
+    for k in order:
+        d = downstream[k]
+        if d >= 0:
+            n_upstream[d] -= 1
+            if n_upstream[d] == 0:
+                order.append(d)
+    return order
+
+
+def _dissolve(polygons: list, crs, method: str = 'clip') -> Polygon:
+    polygons = [p for p in polygons if not p.is_empty]
+    if len(polygons) == 0:
+        return Polygon()
+    if len(polygons) == 1:
+        return polygons[0]
+    return dissolve(gpd.GeoDataFrame(geometry=polygons, crs=crs), method).iloc[0]
+
+
+def incremental_polygon(topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame, gage: dict,
+                        upstream: list, method: str = 'clip') -> Polygon:
+    """
+    The area between a gage and the gages just upstream of it.
+
+    Args:
+        gage: the gage, with its 'row', 'terminal_poly', 'split' (True if the polygon was split at the gage)
+            and 'owner' (True if it gets the unit catchments upstream, see inflow_owners())
+        upstream: the gages just upstream of it
+        method: one of the DISSOLVE_METHODS, see py/fast_dissolve.py
+    """
+    row = gage['row']
+    start, end = int(topo.start[row]), int(topo.end[row])
+
+    # The intervals of the upstream gages, which we skip (the unit catchment of the gage itself is the first row).
+    # If another gage in the same unit catchment gets the unit catchments upstream, we skip all of them.
+    if not gage.get('owner', True):
+        skip = [(start + 1, end)]
+    else:
+        skip = sorted({(int(topo.start[u['row']]), int(topo.end[u['row']])) for u in upstream if u['row'] != row})
+    pieces = [gage['terminal_poly']]
+    pos = start + 1
+    for a, b in skip + [(end, end)]:
+        if a > pos:
+            pieces.extend(topo.select(catchments_gdf, topo.order[pos:a]).geometry.values)
+        pos = max(pos, b)
+
+    # The split parts of the upstream gages' unit catchments belong to them
+    remove = []
+    for u in upstream:
+        if u['row'] == row:
+            remove.append(u['terminal_poly'])
+        elif u['split']:
+            pieces.append(topo.select(catchments_gdf, [u['row']]).geometry.iloc[0])
+            remove.append(u['terminal_poly'])
+
+    polygon = _dissolve(pieces, catchments_gdf.crs, method)
+    if remove and not polygon.is_empty:
+        polygon = buffer(polygon.difference(unary_union(remove)))
+    return polygon
+
+
+def compose(topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame, gages: list, downstream: list,
+            method: str = 'clip') -> (list, list):
+    """
+    Builds the incremental and the full watershed of every gage, upstream gages first.
+
+    Returns:
+        incremental, full: lists of polygons, in the same order as `gages`
+    """
+    upstream = [[] for _ in gages]
+    for k, d in enumerate(downstream):
+        if d >= 0:
+            upstream[d].append(k)
+
+    incremental = [None] * len(gages)
+    full = [None] * len(gages)
+    for k in upstream_first(gages, downstream):
+        incremental[k] = incremental_polygon(topo, catchments_gdf, gages[k], [gages[u] for u in upstream[k]],
+                                             method)
+        full[k] = _dissolve([incremental[k]] + [full[u] for u in upstream[k]], catchments_gdf.crs, method)
+    return incremental, full
+
+
+def write_network(conf: Config, rows: list, polygons: list):
+    """
+    Writes GAUGE_NETWORK.csv, with the next gage downstream and the gages just upstream of each gage,
+    and the incremental areas to the file INCREMENTAL (with the extension OUTPUT_EXT).
+    """
+    df = pd.DataFrame(rows, columns=['id', 'basin', 'terminal_comid', 'downstream_id', 'upstream_ids',
+                                     'upstream_inflow', 'area_calc', 'area_incr'])
+    df.to_csv(f"{conf.OUTPUT_DIR}/GAUGE_NETWORK.csv", index=False)
+
+    if conf.OUTPUT_EXT != "" and len(rows) > 0:
+        gdf = gpd.GeoDataFrame(df[['id', 'downstream_id', 'area_incr']], geometry=polygons, crs='EPSG:4326')
+        if for_output(conf):
+            gdf = quantize_gdf(gdf, conf.OUTPUT_DECIMALS)
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            gdf.to_file(f"{conf.OUTPUT_DIR}/INCREMENTAL.{conf.OUTPUT_EXT}")
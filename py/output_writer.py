@@ -0,0 +1,208 @@
+"""
+Writes all of the watersheds into one file, in batches, from a background thread.
+
+By default (OUTPUT_MODE = "files" in config.py), the script writes each watershed to its own file,
+OUTPUT_DIR/{id}.{OUTPUT_EXT}. For a few hundred outlets that is handy, but for tens of thousands of gages,
+it means tens of thousands of little files, and opening, writing and closing each one of them takes
+longer than delineating some of the small watersheds.
+
+With OUTPUT_MODE = "single", all of the watersheds go into one file instead:
+    OUTPUT_DIR/WATERSHEDS.gpkg      one layer called "watersheds", or
+    OUTPUT_DIR/WATERSHEDS.parquet   GeoParquet, one row group per batch
+
+We collect OUTPUT_BATCH_SIZE watersheds at a time and hand them to a background thread, which writes each batch
+in one go (one transaction in the GeoPackage), while the main thread goes on with the next outlets.
+
+Only one process can write to the file, so the writer lives in the main process. The worker processes (WORKERS and
+BASIN_WORKERS) send the watersheds back with their results, under 'feature', and we pass them on to the writer
+as soon as they get to the main process, see `put_records()`.
+"""
+import json
+import os
+import queue
+import threading
+import warnings
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from config import Config
+
+# The output formats we can append to
+FORMATS = {'gpkg': 'GPKG', 'parquet': 'Parquet'}
+
+LAYER = "watersheds"
+
+# How many batches can wait for the background thread before the main thread has to wait too.
+# This keeps the memory use in check if the disk is slower than the delineation.
+MAX_PENDING = 4
+
+# The columns with text. We give them a fixed type, so that every batch has the same columns,
+# even when a batch happens to have no names.
+TEXT_COLUMNS = ['id', 'name', 'result']
+
+_writer = None
+
+
+def get_filename(conf: Config) -> str:
+    return f"{conf.OUTPUT_DIR}/WATERSHEDS.{conf.OUTPUT_EXT.lower()}"
+
+
+class BatchWriter:
+    """
+    Appends the watersheds to one GeoPackage or GeoParquet file, `batch_size` at a time, in a background thread.
+    Call put() with each watershed, and close() at the end, which writes what is left and waits for the thread.
+    """
+
+    def __init__(self, fname: str, batch_size: int):
+        self.fname = fname
+        self.batch_size = max(1, batch_size)
+        self.ext = os.path.splitext(fname)[1][1:].lower()
+        self.pid = os.getpid()
+        self.rows = []
+        self.count = 0
+        self.error = None
+        # For GeoParquet
+        self.parquet = None
+        self.geo = None
+        self.geometry_types = set()
+        self.bounds = None
+
+        # Start with a new file, like the per-watershed files get overwritten
+        if os.path.isfile(fname):
+            os.remove(fname)
+        self.queue = queue.Queue(maxsize=MAX_PENDING)
+        self.thread = threading.Thread(target=self._run, name="output_writer", daemon=True)
+        self.thread.start()
+
+    def put(self, feature: dict):
+        """Adds one watershed: a dict with the geometry and the fields of the output file."""
+        self.rows.append(feature)
+        if len(self.rows) >= self.batch_size:
+            self.queue.put(self.rows)
+            self.rows = []
+
+    def close(self) -> int:
+        """Writes the last batch, waits for the background thread to finish, and returns the number of watersheds."""
+        if self.rows:
+            self.queue.put(self.rows)
+            self.rows = []
+        self.queue.put(None)
+        self.thread.join()
+        if self.parquet is not None and self.error is None:
+            try:
+                self._close_parquet()
+            except Exception as e:
+                self.error = e
+        if self.error is not None:
+            raise Warning(f"Could not write the watersheds to: {self.fname}. Message: {str(self.error)}")
+        return self.count
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            # After an error, we keep taking the batches, so the main thread does not get stuck
+            if self.error is not None:
+                continue
+            try:
+                self._write(batch)
+                self.count += len(batch)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, batch: list):
+        gdf = gpd.GeoDataFrame(batch, geometry='geometry', crs="EPSG:4326")
+        for column in TEXT_COLUMNS:
+            if column in gdf:
+                gdf[column] = gdf[column].astype('string')
+
+        if self.ext == 'gpkg':
+            # Each call is one transaction
+            with warnings.catch_warnings():
+                warnings.simplefilter(action='ignore', category=UserWarning)
+                gdf.to_file(self.fname, layer=LAYER, driver='GPKG', mode='a' if self.count > 0 else 'w')
+            return
+
+        # The geometries as WKB, and the rest of the columns as they are
+        df = pd.DataFrame(gdf)
+        df['geometry'] = gdf.geometry.to_wkb()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.parquet is None:
+            # The GeoParquet metadata needs the geometry types and the bounds of all of the batches,
+            # so we write it at the end, see _close_parquet()
+            self.geo = {'version': '1.0.0', 'primary_column': 'geometry',
+                        'columns': {'geometry': {'encoding': 'WKB', 'crs': gdf.crs.to_json_dict()}}}
+            self.parquet = pq.ParquetWriter(self.fname, table.schema.remove_metadata())
+        self.parquet.write_table(table.replace_schema_metadata(None))
+        self.geometry_types.update(shapely.get_type_id(gdf.geometry.values).tolist())
+        bounds = gdf.total_bounds.tolist()
+        if self.bounds is None:
+            self.bounds = bounds
+        else:
+            self.bounds = [min(self.bounds[0], bounds[0]), min(self.bounds[1], bounds[1]),
+                           max(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3])]
+
+    def _close_parquet(self):
+        column = self.geo['primary_column']
+        names = {3: "Polygon", 6: "MultiPolygon", 7: "GeometryCollection"}
+        self.geo['columns'][column]['geometry_types'] = sorted(names.get(t, "Unknown") for t in self.geometry_types)
+        self.geo['columns'][column]['bbox'] = self.bounds
+        self.parquet.add_key_value_metadata({'geo': json.dumps(self.geo)})
+        self.parquet.close()
+
+
+def start(conf: Config) -> BatchWriter:
+    """Starts the writer for this run, in this process."""
+    global _writer
+    fname = get_filename(conf)
+    if conf.VERBOSE:
+        print(f"Writing the watersheds to {fname}, {conf.OUTPUT_BATCH_SIZE} at a time")
+    _writer = BatchWriter(fname, conf.OUTPUT_BATCH_SIZE)
+    return _writer
+
+
+def finish(conf: Config) -> int:
+    """Writes the rest of the watersheds, and closes the file. Returns the number of watersheds in it."""
+    global _writer
+    if _writer is None:
+        return 0
+    writer, _writer = _writer, None
+    count = writer.close()
+    if conf.VERBOSE:
+        print(f"Wrote {count} watersheds to {writer.fname}")
+    return count
+
+
+def active() -> bool:
+    """True if the writer is running in this process (the worker processes get a copy of the module, but no thread)."""
+    return _writer is not None and _writer.pid == os.getpid()
+
+
+def put(feature: dict) -> bool:
+    """
+    Hands one watershed to the writer. Returns False if there is no writer in this process,
+    in which case the caller has to send the watershed back to the main process.
+    """
+    if not active():
+        return False
+    _writer.put(feature)
+    return True
+
+
+def put_records(records: list):
+    """Hands the watersheds that came back from a worker process (under 'feature') to the writer, if it is here."""
+    if not active():
+        return
+    for record in records:
+        if 'feature' in record:
+            _writer.put(record.pop('feature'))
+
+
+def feature(gdf: pd.DataFrame) -> dict:
+    """The first row of a GeoDataFrame, as a dict for put()."""
+    return gdf.iloc[0].to_dict()
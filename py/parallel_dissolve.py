@@ -0,0 +1,123 @@
+"""
+Dissolving continental-scale watersheds in parallel.
+
+For the Amazon or the Mississippi, the watershed has hundreds of thousands of unit catchments, and dissolving them
+all at once takes a long time on one CPU, and a lot of memory. When a watershed has more than
+DISSOLVE_PARALLEL_THRESHOLD unit catchments (see config.py), we instead:
+
+  1. Split the unit catchments into groups. The rows of `subbasins_gdf` are in the depth-first (Euler tour) order
+     of the river network (see py/topology.py), so every sub-network (a reach and everything upstream of it) is a
+     block of consecutive rows. Starting at the outlet, we take the sub-networks that are small enough whole,
+     and split the bigger ones into their reach and the sub-networks just upstream of it, and so on. Then we put
+     the pieces that are next to each other together into groups of about the same size. So each group is a few
+     complete sub-networks of the river, plus some of the reaches that connect them.
+  2. Dissolve each group in its own worker process (DISSOLVE_WORKERS of them).
+  3. Merge the pieces two at a time, like a tournament: 8 pieces become 4, then 2, then 1. The pieces next to each
+     other in the river network usually share a long edge, so every merge gets rid of it and the pieces stay small.
+
+The worker processes are started with fork where possible, so they can read the polygons straight from
+the memory of this process. Otherwise (on Windows), each group of polygons is sent to its worker.
+"""
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from py import instrument
+from py.fast_dissolve import buffer, coverage_union
+
+# The polygons we are dissolving, for the forked worker processes
+_geoms = None
+
+
+def groups(sizes: np.ndarray, n_groups: int) -> list:
+    """
+    Splits the rows of a watershed into about `n_groups` blocks of consecutive rows, as a list of (start, end),
+    at the edges of the sub-networks.
+
+    Args:
+        sizes: for each row (in Euler tour order, the outlet first), the number of rows in its sub-network,
+            i.e. the reach itself and everything upstream of it
+    """
+    n = len(sizes)
+    target = math.ceil(n / max(1, min(n, n_groups))) if n > 0 else 1
+
+    # The pieces: whole sub-networks of up to `target` rows, or else a single reach. Its sub-networks come next.
+    pieces = []
+    i = 0
+    while i < n:
+        size = min(int(sizes[i]), n - i) if sizes[i] <= target else 1
+        pieces.append(i + size)
+        i += size
+
+    # Consecutive pieces together, until each group has about `target` rows
+    blocks = []
+    start = 0
+    for end in pieces:
+        if end - start >= target:
+            blocks.append((start, end))
+            start = end
+    if start < n:
+        blocks.append((start, n))
+    return blocks
+
+
+def _dissolve_group(start: int, end: int, coverage: bool, geoms: np.ndarray = None):
+    # Runs in the worker process. Without the buffer, which we do once at the end.
+    if geoms is None:
+        geoms = _geoms[start:end]
+    polygon = coverage_union(geoms) if coverage else None
+    if polygon is None:
+        polygon = shapely.union_all(geoms)
+    return polygon
+
+
+def _merge(polygons: list):
+    # Runs in the worker process. (A coverage union is slower here: it has to add a vertex at every pixel
+    # along the long edges of the pieces, and there are only two of them.)
+    return shapely.union_all(polygons)
+
+
+def dissolve(df: gpd.GeoDataFrame, method: str, workers: int, sizes: np.ndarray) -> gpd.GeoSeries:
+    """
+    Same as `dissolve()` in py/fast_dissolve.py, in `workers` processes.
+    With method = "coverage", each group is dissolved with a coverage union, otherwise
+    (for "clip" and "unary") with shapely's union_all().
+
+    Args:
+        df: the unit catchments of the watershed, in Euler tour order
+        sizes: the number of rows in the sub-network of each row, see groups()
+
+    Returns:
+        a GeoSeries with a single polygon
+    """
+    global _geoms
+    geoms = np.asarray(df.geometry.values)
+    # A few groups per worker, so that they all keep busy even if some of the groups are slower
+    blocks = groups(sizes, workers * 4)
+    coverage = method == 'coverage'
+
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('fork' if fork else 'spawn')
+    _geoms = geoms if fork else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            with instrument.stage('dissolve/groups'):
+                if fork:
+                    parts = [None] * len(blocks)
+                else:
+                    parts = [geoms[a:b] for a, b in blocks]
+                pieces = list(executor.map(_dissolve_group, [a for a, _ in blocks], [b for _, b in blocks],
+                                           [coverage] * len(blocks), parts))
+
+            with instrument.stage('dissolve/merge'):
+                while len(pieces) > 1:
+                    pairs = [pieces[i:i + 2] for i in range(0, len(pieces), 2)]
+                    pieces = list(executor.map(_merge, pairs))
+    finally:
+        _geoms = None
+
+    return gpd.GeoSeries([buffer(pieces[0])], crs=df.crs)
@@ -0,0 +1,291 @@
+"""
+A pyramid of dissolved polygons for the big sub-networks of each basin, for large low-resolution watersheds.
+
+Watersheds bigger than LOW_RES_THRESHOLD are delineated with the simplified unit catchments, but we still dissolve
+every one of them: tens of thousands for a big river. With PYRAMID = True in config.py, we do most of that work
+ahead of time, once per basin. For every confluence (a river reach with more than one reach flowing into it)
+whose upstream area is more than PYRAMID_THRESHOLD (in km²), we save the dissolved polygon of everything upstream
+of it.
+
+We build the polygons from the top of the river network down, so that each one is made of the polygons of the
+confluences just upstream of it, plus the few unit catchments in between (this is the same as the upstream polygon
+cache, see py/upstream_cache.py). Then, a big watershed is put together from the biggest polygons that fit inside
+of it, plus the unit catchments that are not in any of them: usually a handful of polygons instead of thousands.
+There is only one threshold: the polygons are nested, so a big watershed already gets the few biggest polygons,
+and never looks at the smaller ones inside of them.
+
+The polygons of a big basin can take many GB, so we don't keep all of them in memory. While building them, we keep
+the ones we made last in a cache of PYRAMID_CACHE_MB, and write the rest to the file as we go. When we use them,
+we only keep the Euler tour interval of each polygon in memory, read the polygons a watershed needs from the
+file, and keep the ones we used last in a cache of PYRAMID_CACHE_MB. (Without PICKLE_DIR, they all stay in memory.)
+
+The polygons are saved in PICKLE_DIR:
+   PICKLE_DIR/pyramid_##_lores.parquet
+They are built the first time they are needed, or ahead of time with this command (from the main folder of the repo):
+
+    >> python -m py.pyramid --basins 11 12
+
+If you change PYRAMID_THRESHOLD or DISSOLVE_METHOD, delete the files so they are built again.
+"""
+import argparse
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from config import Config
+from py.fast_dissolve import dissolve
+from py.topology import UpstreamIndex
+from py.upstream_cache import PolygonCache, upstream_polygon
+
+# Number of polygons that we build before we write them to the file
+BATCH_SIZE = 1000
+
+# Number of polygons in each row group of the file, the smallest part of it we can read
+ROW_GROUP_SIZE = 64
+
+
+def get_filename(conf: Config, basin: int) -> str:
+    return f'{conf.PICKLE_DIR}/pyramid_{basin}_lores.parquet'
+
+
+def nodes(topo: UpstreamIndex, rivers_gdf: gpd.GeoDataFrame, threshold: float) -> np.ndarray:
+    """
+    The rows (in the topology index) of the confluences that get a polygon.
+    """
+    n_upstream = np.diff(topo.indptr)
+    up_area = rivers_gdf['uparea'].reindex(topo.comids).to_numpy()
+    return np.flatnonzero((n_upstream > 1) & (up_area > threshold))
+
+
+def build(topo: UpstreamIndex, rivers_gdf: gpd.GeoDataFrame, catchments_gdf: gpd.GeoDataFrame, threshold: float,
+          method: str = 'clip', verbose: bool = False, max_bytes: float = np.inf):
+    """
+    Dissolves the polygons for the pyramid.
+
+    Args:
+        catchments_gdf: the low-resolution unit catchments
+        threshold: the smallest upstream area (km²) of a confluence that gets a polygon, see PYRAMID_THRESHOLD
+        max_bytes: the memory for the polygons we reuse for the ones downstream, see PYRAMID_CACHE_MB
+
+    Yields:
+        GeoDataFrames with the COMID of each confluence, and its upstream polygon, BATCH_SIZE at a time
+        (at least one, which may be empty)
+    """
+    topo.euler()
+    rows = nodes(topo, rivers_gdf, threshold)
+    # The ones furthest upstream first, so that the ones downstream of them can be made out of their polygons
+    rows = rows[np.argsort(-topo.start[rows], kind='stable')]
+
+    cache = PolygonCache(max_bytes)
+    for k in range(0, max(len(rows), 1), BATCH_SIZE):
+        if verbose:
+            print(f"  {k} of {len(rows)} polygons")
+        batch = rows[k:k + BATCH_SIZE]
+        polygons = [upstream_polygon(cache, topo, catchments_gdf, False, row, method) for row in batch.tolist()]
+        yield gpd.GeoDataFrame({'COMID': topo.comids[batch]}, geometry=polygons, crs=catchments_gdf.crs)
+
+
+def to_arrow(gdf: gpd.GeoDataFrame) -> pa.Table:
+    """A batch of polygons as a GeoParquet table: the COMIDs, and the polygons as WKB."""
+    table = pa.table({'COMID': pa.array(gdf['COMID'].to_numpy(), type=pa.int64()),
+                      'geometry': pa.array(shapely.to_wkb(np.asarray(gdf.geometry.values)), type=pa.binary())})
+    geo = {'version': '1.0.0', 'primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': [], 'crs': gdf.crs.to_json_dict()}}}
+    return table.replace_schema_metadata({'geo': json.dumps(geo)})
+
+
+def save(conf: Config, basin: int, batches):
+    """Writes the batches of polygons from `build()` to PICKLE_DIR, one batch at a time."""
+    fname = get_filename(conf, basin)
+    tmp_fname = f"{fname}.{os.getpid()}.tmp"
+    writer = None
+    n = 0
+    try:
+        for gdf in batches:
+            table = to_arrow(gdf)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_fname, table.schema)
+            writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            n += len(gdf)
+        writer.close()
+        os.replace(tmp_fname, fname)
+    except Exception as e:
+        if writer is not None:
+            writer.close()
+        if os.path.isfile(tmp_fname):
+            os.remove(tmp_fname)
+        raise Warning(f"Could not save the pyramid to: {fname}. Message: {str(e)}")
+    if conf.VERBOSE:
+        print(f"Saved {n} pyramid polygons to {fname}")
+
+
+class Pyramid:
+    """
+    The pyramid polygons for a basin. We keep the Euler tour interval [start, end) of every polygon, sorted
+    by start, and read the polygons from the file (or take them from `geometries`) when we need them.
+    """
+
+    def __init__(self, basin: int, topo: UpstreamIndex, comids: np.ndarray, max_bytes: float,
+                 fname: str = None, geometries: np.ndarray = None):
+        topo.euler()
+        rows = topo._lookup(comids)
+        # COMIDs that are no longer in the river network are skipped
+        keep = np.flatnonzero(rows >= 0)
+        keep = keep[np.argsort(topo.start[rows[keep]], kind='stable')]
+        self.basin = basin
+        self.comids = np.asarray(comids, dtype=np.int64)[keep]
+        self.starts = topo.start[rows[keep]]
+        self.ends = topo.end[rows[keep]]
+        # Where each polygon is in the file, or in `geometries`
+        self.positions = keep
+        self.cache = PolygonCache(max_bytes)
+        self._geometries = geometries
+        self._file = None
+        if fname is not None:
+            self._file = pq.ParquetFile(fname, memory_map=True)
+            sizes = [self._file.metadata.row_group(g).num_rows for g in range(self._file.num_row_groups)]
+            self._group_starts = np.concatenate([[0], np.cumsum(sizes)])
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _read(self, positions: np.ndarray) -> list:
+        """Reads the polygons at `positions` in the file, one row group at a time."""
+        if self._file is None:
+            return list(self._geometries[positions])
+        groups = np.searchsorted(self._group_starts, positions, side='right') - 1
+        polygons = np.empty(len(positions), dtype=object)
+        for group in np.unique(groups).tolist():
+            sel = groups == group
+            column = self._file.read_row_group(group, columns=['geometry']).column('geometry')
+            wkb = column.take(pa.array(positions[sel] - self._group_starts[group])).to_pylist()
+            polygons[sel] = shapely.from_wkb(wkb)
+        return list(polygons)
+
+    def polygons(self, idx: list) -> list:
+        """The polygons number `idx` (in the order of `starts`), from the cache or from the file."""
+        found = {}
+        missing = []
+        for i in idx:
+            polygon = self.cache.get(False, int(self.starts[i]))
+            if polygon is None:
+                missing.append(i)
+            else:
+                found[i] = polygon
+        if len(missing) > 0:
+            for i, polygon in zip(missing, self._read(self.positions[missing])):
+                self.cache.put(False, int(self.starts[i]), int(self.ends[i]), int(self.comids[i]), polygon, new=False)
+                found[i] = polygon
+        return [found[i] for i in idx]
+
+    def pieces(self, start: int, end: int) -> (list, list):
+        """
+        Finds the biggest polygons inside of the interval [start, end), like `PolygonCache.pieces()`.
+
+        Returns:
+            polygons: the polygons
+            gaps: the intervals (a, b) that none of them cover
+        """
+        idx = []
+        gaps = []
+        pos = start
+        i = int(np.searchsorted(self.starts, start))
+        while i < len(self.starts) and self.starts[i] < end:
+            idx.append(i)
+            if self.starts[i] > pos:
+                gaps.append((pos, int(self.starts[i])))
+            pos = int(self.ends[i])
+            # Skip the polygons inside of this one. (Intervals in the Euler tour are nested or apart, never overlapping.)
+            i = int(np.searchsorted(self.starts, pos))
+        if pos < end:
+            gaps.append((pos, end))
+        return self.polygons(idx), gaps
+
+
+def load(conf: Config, basin: int, topo: UpstreamIndex, rivers_gdf: gpd.GeoDataFrame,
+         catchments_gdf: gpd.GeoDataFrame) -> Pyramid:
+    """
+    Returns the pyramid for a basin, from PICKLE_DIR if it is there, or else builds it (and saves it).
+    """
+    fname = get_filename(conf, basin)
+    max_bytes = int(conf.PYRAMID_CACHE_MB * 1e6)
+    batches = None
+    if conf.PICKLE_DIR == '' or not os.path.isfile(fname):
+        if conf.VERBOSE:
+            print(f"Building the pyramid polygons for basin {basin}")
+        batches = build(topo, rivers_gdf, catchments_gdf, conf.PYRAMID_THRESHOLD, conf.DISSOLVE_METHOD,
+                        conf.VERBOSE, max_bytes)
+
+    if conf.PICKLE_DIR == '':
+        gdf = pd.concat(list(batches), ignore_index=True)
+        return Pyramid(basin, topo, gdf['COMID'].to_numpy(), max_bytes, geometries=np.asarray(gdf.geometry.values))
+
+    if batches is not None:
+        save(conf, basin, batches)
+    elif conf.VERBOSE:
+        print(f"Reading the pyramid from {fname}")
+    comids = pq.read_table(fname, columns=['COMID']).column('COMID').to_numpy()
+    return Pyramid(basin, topo, comids, max_bytes, fname=fname)
+
+
+def dissolve_watershed(pyramid: Pyramid, topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame,
+                       terminal_row: int, method: str = 'clip') -> gpd.GeoSeries:
+    """
+    Same as `dissolve()` in py/fast_dissolve.py on all of the low-resolution unit catchments in the watershed,
+    but with the biggest polygons from the pyramid.
+
+    Returns:
+        a GeoSeries with the watershed polygon
+    """
+    topo.euler()
+    start, end = int(topo.start[terminal_row]), int(topo.end[terminal_row])
+    polygons, gaps = pyramid.pieces(start, end)
+    if len(polygons) == 1 and len(gaps) == 0:
+        pyramid.hits += 1
+        return gpd.GeoSeries(polygons, crs=catchments_gdf.crs)
+
+    pyramid.misses += 1
+    pyramid.reused += len(polygons)
+    for a, b in gaps:
+        polygons.extend(topo.select(catchments_gdf, topo.order[a:b]).geometry.values)
+    return dissolve(gpd.GeoDataFrame(geometry=polygons, crs=catchments_gdf.crs), method)
+
+
+def main():
+    from delineate import load_gdf
+
+    conf = Config()
+    parser = argparse.ArgumentParser(description="Builds the pyramid of dissolved polygons for the big sub-networks "
+                                                 "of each basin, for PYRAMID = True (see config.py)")
+    parser.add_argument('--basins', type=int, nargs='+', required=True,
+                        help="Level 2 basin codes, e.g. 11 12")
+    parser.add_argument('--overwrite', action='store_true', help="Build the pyramid again, even if it is already there")
+    args = parser.parse_args()
+
+    if conf.PICKLE_DIR == '':
+        raise Exception("Please set PICKLE_DIR in config.py, or as an environment variable")
+    os.makedirs(conf.PICKLE_DIR, exist_ok=True)
+
+    for basin in args.basins:
+        if os.path.isfile(get_filename(conf, basin)) and not args.overwrite:
+            print(f"The pyramid for basin {basin} is already there, skipping (use --overwrite to build it again)")
+            continue
+        print(f"Building the pyramid for basin {basin}")
+        rivers_gdf = load_gdf(conf, "rivers", basin, True)
+        catchments_gdf = load_gdf(conf, "catchments", basin, False, rivers_gdf=rivers_gdf, columns=['geometry'])
+        topo = UpstreamIndex.from_rivers(rivers_gdf)
+        save(conf, basin, build(topo, rivers_gdf, catchments_gdf, conf.PYRAMID_THRESHOLD, conf.DISSOLVE_METHOD,
+                                conf.VERBOSE, int(conf.PYRAMID_CACHE_MB * 1e6)))
+
+
+if __name__ == "__main__":
+    main()
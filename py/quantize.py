@@ -0,0 +1,59 @@
+"""
+Rounds the coordinates of the watersheds and rivers, to make the text-like output files and the map files smaller.
+
+For GeoJSON and KML output, and for the map viewer, we don't need 15 digits after the decimal point. The script used
+to round the coordinates by writing each geometry out as WKT, rounding every number in the text with a regular
+expression, and reading it back in. For a detailed watershed with hundreds of thousands of vertices, that is
+slow, and makes a few copies of a very long string.
+
+Now we round the arrays of coordinates directly, for a whole GeoSeries at once, with shapely.transform().
+Rounding can make a polygon invalid, e.g. when two vertices that are close together end up on the same spot
+and the outline touches itself. We check all of the results at once, and only for the few invalid ones, we use
+GEOS to reduce the precision (shapely.set_precision), which snaps the polygon to the grid and keeps it valid.
+That is much slower, so we don't do it for all of them.
+"""
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from config import Config
+
+# The output formats where rounding makes the files smaller. For binary formats (gpkg, shp, parquet)
+# the coordinates take the same space either way, so we keep all of the digits.
+TEXT_FORMATS = ['geojson', 'kml']
+
+
+def quantize(geoms, decimals: int) -> np.ndarray:
+    """
+    Rounds the coordinates of the geometries to `decimals` digits after the decimal point,
+    and repairs the ones that rounding made invalid.
+
+    Args:
+        geoms: a list or array of shapely geometries (or a GeoSeries)
+        decimals: e.g. 5 for about 1 m
+
+    Returns:
+        an array of the rounded geometries. Lines that are shorter than the precision can become empty.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    rounded = shapely.transform(geoms, lambda c: np.round(c, decimals))
+
+    invalid = ~shapely.is_valid(rounded) & ~shapely.is_missing(rounded)
+    if np.any(invalid):
+        fixed = shapely.set_precision(rounded[invalid], 10.0 ** -decimals)
+        # set_precision() puts the vertices on the grid, but not always at the closest floating point number
+        # to it (e.g. 64.12345000000001), so we round again, which does not move them enough to matter
+        rounded[invalid] = shapely.transform(fixed, lambda c: np.round(c, decimals))
+    return rounded
+
+
+def quantize_gdf(gdf: gpd.GeoDataFrame, decimals: int) -> gpd.GeoDataFrame:
+    """A copy of a GeoDataFrame with the coordinates rounded, see quantize()."""
+    gdf = gdf.copy()
+    gdf.geometry = gpd.GeoSeries(quantize(gdf.geometry.values, decimals), index=gdf.index, crs=gdf.crs)
+    return gdf
+
+
+def for_output(conf: Config) -> bool:
+    """True if we round the coordinates in the output files, i.e. for text-like formats."""
+    return conf.OUTPUT_EXT.lower() in TEXT_FORMATS
@@ -0,0 +1,188 @@
+"""
+A cache of decoded blocks of the MERIT-Hydro flow direction and accumulation rasters.
+
+For every outlet, `split_catchment` reads a small window of the rasters around the terminal unit catchment.
+With pysheds, that means opening the GeoTIFF files and decompressing the window every time,
+even if the next outlet is in the neighboring unit catchment, and we just read the same pixels.
+
+The GeoTIFF files are stored in tiles (blocks) of e.g. 256 x 256 pixels, which GDAL has to decompress
+in one piece anyway. So here, we keep the raster files open, and keep the decoded blocks in memory,
+up to a budget of RASTER_CACHE_MB. When the cache is full, the block that was used the longest time ago
+is thrown out (LRU). Windows are assembled from the blocks, giving exactly the same pixels, affine
+transform and nodata value as pysheds `read_raster()` does for the same bounding box.
+
+Each process has its own cache. It is cleared when we move on to another Level 2 basin.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.windows import Window
+from pysheds import projection
+from pysheds.sview import Raster, ViewFinder
+
+from config import Config
+
+# For rasters that are stored in strips instead of tiles, we cache blocks of this many rows and columns
+STRIP_BLOCK_SIZE = 256
+
+
+class BlockCache:
+    """LRU cache of decoded raster blocks, with a limit on the total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.basin = None
+        self._blocks = OrderedDict()  # (path, block row, block col) -> np.ndarray
+        self._datasets = {}           # path -> (open rasterio dataset, block shape, pysheds crs)
+        self._pid = os.getpid()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        """Throws out all the blocks and closes the files. Keeps the statistics."""
+        self._blocks.clear()
+        self.nbytes = 0
+        for dataset, _, _ in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'blocks': len(self._blocks), 'bytes': self.nbytes}
+
+    def _open(self, path: str) -> tuple:
+        # Open file handles can't be shared with a forked worker process, so each process opens its own.
+        # (The decoded blocks we got from the parent process are fine, though.)
+        if self._pid != os.getpid():
+            self._datasets = {}
+            self._pid = os.getpid()
+
+        if path not in self._datasets:
+            dataset = rasterio.open(path)
+            block_rows, block_cols = dataset.block_shapes[0]
+            if block_rows < 16:
+                # A striped, rather than tiled, GeoTIFF
+                block_rows = int(np.ceil(STRIP_BLOCK_SIZE / block_rows)) * block_rows
+                block_cols = min(dataset.width, STRIP_BLOCK_SIZE)
+            self._datasets[path] = (dataset, (block_rows, block_cols), projection.to_proj(dataset.crs))
+
+        return self._datasets[path]
+
+    def _block(self, path: str, dataset, block_shape: tuple, i: int, j: int) -> np.ndarray:
+        key = (path, i, j)
+        block = self._blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return block
+
+        self.misses += 1
+        block_rows, block_cols = block_shape
+        window = Window(j * block_cols, i * block_rows,
+                        min(block_cols, dataset.width - j * block_cols),
+                        min(block_rows, dataset.height - i * block_rows))
+        block = dataset.read(1, window=window)
+
+        self._blocks[key] = block
+        self.nbytes += block.nbytes
+        # Make room, but always keep the block we just read
+        while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+            _, old = self._blocks.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+        return block
+
+    def read_window(self, path: str, bounding_box: tuple, nodata) -> Raster:
+        """
+        Same as pysheds `grid.read_raster(path, window=bounding_box, nodata=nodata)`,
+        but using the cached blocks.
+        """
+        dataset, block_shape, crs = self._open(path)
+        rows, cols, affine = pixel_window(dataset.transform, bounding_box)
+
+        if not inside(rows, cols, dataset.shape):
+            # At the edge of the raster, let pysheds deal with it
+            from pysheds.io import read_raster
+            return read_raster(path, window=bounding_box, nodata=nodata)
+
+        # Copy the blocks that overlap the window into one array, then pick out the pixels we need
+        block_rows, block_cols = block_shape
+        r0, c0 = rows[0], cols[0]
+        area = np.empty((rows[-1] - r0 + 1, cols[-1] - c0 + 1), dtype=dataset.dtypes[0])
+        for i in range(r0 // block_rows, rows[-1] // block_rows + 1):
+            for j in range(c0 // block_cols, cols[-1] // block_cols + 1):
+                block = self._block(path, dataset, block_shape, i, j)
+                top, left = i * block_rows, j * block_cols
+                r_start, r_end = max(top, r0), min(top + block.shape[0], rows[-1] + 1)
+                c_start, c_end = max(left, c0), min(left + block.shape[1], cols[-1] + 1)
+                area[r_start - r0:r_end - r0, c_start - c0:c_end - c0] = \
+                    block[r_start - top:r_end - top, c_start - left:c_end - left]
+
+        data = area[np.ix_(rows - r0, cols - c0)]
+        viewfinder = ViewFinder(affine=affine, shape=data.shape, nodata=nodata, crs=crs)
+        return Raster(data, viewfinder)
+
+
+def pixel_window(transform, bounding_box: tuple) -> (np.ndarray, np.ndarray, object):
+    """
+    Finds the pixels that pysheds `read_raster(window=bounding_box)` returns for a raster with this affine transform.
+
+    The bounding box does not line up exactly with the pixels, and GDAL samples the nearest pixel
+    for each pixel in the output. This is how it picks them (see GDALRasterBand::IRasterIO).
+    GDAL adds a tiny number to avoid rounding problems, and so do we, to get the same pixels.
+
+    Returns:
+        rows, cols: the row and column numbers in the raster for each row and column of the window
+        affine: the transform of the window, as pysheds has it
+    """
+    ix_window = windows.from_bounds(*bounding_box, transform=transform)
+
+    def nearest(offset: float, size: float) -> np.ndarray:
+        n = int(np.floor(size + 0.5))
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.floor((np.arange(n) + 0.5) * (size / n) + offset + 1e-10).astype(np.int64)
+
+    rows = nearest(ix_window.row_off, ix_window.height)
+    cols = nearest(ix_window.col_off, ix_window.width)
+    return rows, cols, windows.transform(ix_window, transform)
+
+
+def inside(rows: np.ndarray, cols: np.ndarray, shape: tuple) -> bool:
+    """True if the window from `pixel_window` is not empty, and entirely inside a raster with this shape."""
+    return len(rows) > 0 and len(cols) > 0 and rows[0] >= 0 and cols[0] >= 0 \
+        and rows[-1] < shape[0] and cols[-1] < shape[1]
+
+
+# The cache for this process
+_cache = None
+
+
+def get_cache(conf: Config, basin: int) -> BlockCache:
+    """Returns the block cache for this process, emptied if we have moved on to a different basin."""
+    global _cache
+    if _cache is None:
+        _cache = BlockCache(int(conf.RASTER_CACHE_MB * 1e6))
+    if _cache.basin != basin:
+        _cache.clear()
+        _cache.basin = basin
+    return _cache
+
+
+def stats() -> dict:
+    """Hit and miss counts etc. for the cache in this process (all zeros if it was never used)."""
+    if _cache is None:
+        return BlockCache(0).stats()
+    return _cache.stats()
+
+
+def counts_since(before: dict) -> dict:
+    """The number of cache hits, misses and evictions in this process since `before` = stats()."""
+    now = stats()
+    return {key: now[key] - before[key] for key in ('hits', 'misses', 'evictions')}
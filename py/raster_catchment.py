@@ -0,0 +1,90 @@
+"""
+A small raster-based catchment engine, as an alternative to pysheds `grid.catchment()`.
+
+Given a D8 flow direction grid and a pour point, we want every pixel that drains to the pour point.
+pysheds does this with numba, or, if numba is not available, with a recursive function that
+needs a huge recursion limit and can still fail when the chain of upstream pixels is very long.
+
+Here, we work on the whole window at once, with NumPy array operations on flat pixel indices.
+Every pixel points to its downstream pixel, and we follow all of the flow paths at the same time,
+doubling the distance with each step (pointer jumping). So there is no recursion, no Python loop
+over individual pixels, and the number of steps only grows with the logarithm of the length of the
+longest flow path. The result is the same mask that pysheds returns.
+"""
+import numpy as np
+from pysheds.sview import Raster, ViewFinder
+
+# MERIT-Hydro flow direction uses the old ESRI standard for flow direction.
+# The order is: N, NE, E, SE, S, SW, W, NW
+MERIT_DIRMAP = (64, 128, 1, 2, 4, 8, 16, 32)
+
+# Row and column offsets of the 8 neighbors, in the same order as the dirmap
+_DROW = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+_DCOL = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+
+def upstream_mask(fdir: np.ndarray, row: int, col: int, dirmap: tuple = MERIT_DIRMAP) -> np.ndarray:
+    """
+    Finds all of the pixels that drain to the pixel at (row, col), including itself.
+
+    Args:
+        fdir: 2-D array of D8 flow directions
+        row, col: the pour point
+        dirmap: the flow direction values for N, NE, E, SE, S, SW, W, NW
+
+    Returns:
+        a boolean array with the same shape as `fdir`, True for the pixels in the catchment
+    """
+    fdir = np.asarray(fdir)
+    h, w = fdir.shape
+    if not (0 <= row < h and 0 <= col < w):
+        raise ValueError(f"Pour point (row {row}, col {col}) is out of bounds for a grid with shape {fdir.shape}")
+
+    n = h * w
+    pour = row * w + col
+    flat_fdir = fdir.ravel()
+
+    # The downstream pixel of every pixel, as a flat index. Pixels that do not drain anywhere
+    # (no data, or an unknown direction) point to an extra "sink" pixel at index n.
+    # Like pysheds, we ignore the pixels on the rim of the grid (apart from the pour point itself),
+    # which also keeps us from wrapping around to the other side of the grid.
+    sink = n
+    down = np.full(n + 1, sink, dtype=np.int64)
+    interior = np.zeros((h, w), dtype=bool)
+    interior[1:-1, 1:-1] = True
+    interior = interior.ravel()
+    pixels = np.arange(n, dtype=np.int64)
+    for k in range(8):
+        flows = interior & (flat_fdir == dirmap[k])
+        down[:n][flows] = pixels[flows] + _DROW[k] * w + _DCOL[k]
+
+    # The pour point is where we stop, so it points to itself, as does the sink.
+    down[pour] = pour
+
+    # Now follow the flow downstream from every pixel at once. With each step, we jump twice as far
+    # (pointer jumping), so even a flow path that is millions of pixels long only takes ~20 steps.
+    # Each pixel ends up at the pour point, at the sink, or going around a loop (if the flow directions
+    # have any), and the pixels that end up at the pour point are the catchment.
+    for _ in range(int(np.ceil(np.log2(n + 1))) + 1):
+        jumped = down[down]
+        if np.array_equal(jumped, down):
+            break
+        down = jumped
+
+    return (down[:n] == pour).reshape(h, w)
+
+
+def catchment(grid, fdir, x: float, y: float, dirmap: tuple = MERIT_DIRMAP):
+    """
+    Drop-in replacement for pysheds `grid.catchment(fdir=fdir, x=x, y=y, dirmap=dirmap, xytype='coordinate')`.
+
+    Uses the current view of the grid (e.g. after `grid.clip_to()`), just like pysheds does.
+    Returns a pysheds Raster with the catchment as a boolean mask.
+    """
+    fdir_view = grid.view(fdir, nodata=fdir.nodata)
+    col, row = grid.nearest_cell(x, y, fdir_view.affine, snap='corner')
+    catch = upstream_mask(fdir_view, row, col, dirmap)
+
+    viewfinder = ViewFinder(**fdir_view.viewfinder.properties)
+    viewfinder.nodata = False
+    return Raster(catch, viewfinder, metadata=fdir_view.metadata)
@@ -0,0 +1,161 @@
+"""
+An uncompressed, memory-mapped copy of the MERIT-Hydro flow direction and accumulation rasters.
+
+The GeoTIFF files are compressed, so every time we read a window around an outlet, GDAL has to
+decompress it again. If you have enough disk space (roughly 1 byte per pixel for flow directions,
+and 4 for accumulation), you can convert the rasters once into plain NumPy array files (.npy)
+with this command, run from the main folder of the repository:
+
+    >> python -m py.raster_store
+
+It converts all the rasters in MERIT_FDIR_DIR and MERIT_ACCUM_DIR, and saves them in RASTER_STORE_DIR.
+You can also convert just a few basins, e.g. `python -m py.raster_store --basins 11 12`.
+Next to each .npy file, a small .json file holds the georeferencing (affine transform, crs and nodata).
+
+When RASTER_STORE_DIR is set in config.py, `split_catchment` memory-maps these files and takes its windows
+straight from them, without reading or decompressing anything. The operating system keeps the pages
+that we've used in memory, and all of the worker processes share them.
+"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+from numpy.lib.format import open_memmap
+from pysheds import projection
+from pysheds.sview import Raster, ViewFinder
+
+from config import Config
+from py.raster_cache import pixel_window, inside
+
+
+def store_filenames(conf: Config, tif_fname: str) -> (str, str):
+    """The names of the .npy array file and the .json sidecar file for a GeoTIFF file, e.g. flowdir11.tif"""
+    stem = os.path.splitext(os.path.basename(tif_fname))[0]
+    return f"{conf.RASTER_STORE_DIR}/{stem}.npy", f"{conf.RASTER_STORE_DIR}/{stem}.json"
+
+
+def convert(conf: Config, tif_fname: str, overwrite: bool = False) -> bool:
+    """
+    Converts one GeoTIFF file to a .npy file plus a .json sidecar file in RASTER_STORE_DIR.
+    We copy the raster one strip of blocks at a time, so it does not need to fit in memory.
+    Returns False if the file had already been converted.
+    """
+    npy_fname, json_fname = store_filenames(conf, tif_fname)
+    if os.path.isfile(npy_fname) and os.path.isfile(json_fname) and not overwrite:
+        return False
+
+    with rasterio.open(tif_fname) as src:
+        if src.count != 1:
+            raise Exception(f"Expected a raster with a single band in {tif_fname}, but it has {src.count}")
+
+        # Write to a temporary file first, so we never leave a half-finished file behind
+        tmp_fname = npy_fname + ".tmp"
+        out = open_memmap(tmp_fname, mode='w+', dtype=src.dtypes[0], shape=src.shape)
+        strip_height = src.block_shapes[0][0]
+        for row in range(0, src.height, strip_height):
+            height = min(strip_height, src.height - row)
+            out[row:row + height, :] = src.read(1, window=((row, row + height), (0, src.width)))
+        out.flush()
+        del out
+
+        meta = {
+            'source': os.path.basename(tif_fname),
+            'shape': list(src.shape),
+            'dtype': src.dtypes[0],
+            'transform': list(src.transform)[:6],
+            'crs': src.crs.to_wkt() if src.crs is not None else None,
+            'nodata': src.nodata,
+        }
+
+    os.replace(tmp_fname, npy_fname)
+    with open(json_fname, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    return True
+
+
+# The memory-mapped arrays we have open in this process: path of the .tif file -> (array, metadata, pysheds crs)
+_open_rasters = {}
+
+
+def _open(conf: Config, tif_fname: str):
+    if tif_fname not in _open_rasters:
+        npy_fname, json_fname = store_filenames(conf, tif_fname)
+        if not os.path.isfile(npy_fname) or not os.path.isfile(json_fname):
+            _open_rasters[tif_fname] = None
+        else:
+            with open(json_fname) as f:
+                meta = json.load(f)
+            # Read-only, so the pages can be shared by all the processes, and nobody can change the file by accident
+            array = np.load(npy_fname, mmap_mode='r')
+            crs = projection.to_proj(rasterio.crs.CRS.from_wkt(meta['crs'])) if meta['crs'] else None
+            _open_rasters[tif_fname] = (array, meta, crs)
+
+    return _open_rasters[tif_fname]
+
+
+def has_raster(conf: Config, tif_fname: str) -> bool:
+    """True if this GeoTIFF file has been converted to the raster store."""
+    return conf.RASTER_STORE_DIR != "" and _open(conf, tif_fname) is not None
+
+
+def read_window(conf: Config, tif_fname: str, bounding_box: tuple, nodata) -> Raster or None:
+    """
+    Same as pysheds `grid.read_raster(tif_fname, window=bounding_box, nodata=nodata)`, but sliced from
+    the memory-mapped copy of the raster. Returns None if the window is not inside the raster.
+
+    If the window lines up with the pixels, it is a slice of the memory-mapped array, without copying anything.
+    This means it is read-only: make a copy if you need to change it.
+    """
+    array, meta, crs = _open(conf, tif_fname)
+    rows, cols, affine = pixel_window(Affine(*meta['transform']), bounding_box)
+    if not inside(rows, cols, array.shape):
+        return None
+
+    if rows[-1] - rows[0] == len(rows) - 1 and cols[-1] - cols[0] == len(cols) - 1:
+        data = array[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    else:
+        # The bounding boxes in split_catchment are a tiny bit bigger than a whole number of pixels,
+        # and with GDAL's nearest-pixel sampling, windows taller or wider than about 60 pixels skip
+        # a row or a column. We do the same, to get exactly the same results as with the GeoTIFF.
+        # That takes one copy of the window (which split_catchment would have to make anyway).
+        data = array[np.ix_(rows, cols)]
+
+    viewfinder = ViewFinder(affine=affine, shape=data.shape, nodata=nodata, crs=crs)
+    return Raster(data, viewfinder)
+
+
+def main():
+    conf = Config()
+    parser = argparse.ArgumentParser(description="Converts the MERIT-Hydro flow direction and accumulation rasters "
+                                                 "to memory-mappable files in RASTER_STORE_DIR (see config.py)")
+    parser.add_argument('--basins', type=int, nargs='*', default=None,
+                        help="Level 2 basin codes to convert, e.g. 11 12 (default: all of the rasters)")
+    parser.add_argument('--overwrite', action='store_true', help="Convert files again, even if they are already there")
+    args = parser.parse_args()
+
+    if conf.RASTER_STORE_DIR == "":
+        raise Exception("Please set RASTER_STORE_DIR in config.py, or as an environment variable")
+    os.makedirs(conf.RASTER_STORE_DIR, exist_ok=True)
+
+    if args.basins:
+        tif_fnames = [f"{conf.MERIT_FDIR_DIR}/flowdir{basin}.tif" for basin in args.basins]
+        tif_fnames += [f"{conf.MERIT_ACCUM_DIR}/accum{basin}.tif" for basin in args.basins]
+    else:
+        tif_fnames = sorted(glob.glob(f"{conf.MERIT_FDIR_DIR}/flowdir*.tif"))
+        tif_fnames += sorted(glob.glob(f"{conf.MERIT_ACCUM_DIR}/accum*.tif"))
+
+    for tif_fname in tif_fnames:
+        if not os.path.isfile(tif_fname):
+            raise Exception(f"Could not find raster: {tif_fname}")
+        print(f"Converting {tif_fname}")
+        if not convert(conf, tif_fname, overwrite=args.overwrite):
+            print(" already done, skipping (use --overwrite to convert it again)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Runs several Level 2 basins at the same time, without running out of memory.
+
+For global runs, the outlets can be spread over dozens of Level 2 basins, and each one needs its own
+multi-GB tables of unit catchments and rivers. On a big computer, we can work on several basins
+at once, but if two of the giants (e.g. the Amazon and the Congo) happen to run at the same time,
+the job can get killed by the operating system for using too much memory.
+
+So before starting a basin, we estimate how much memory it will need, based on the size of its
+files on disk, and we only start it if the total for all of the running basins stays within
+a memory budget. The estimates are rough, but they don't have to be perfect to avoid the worst case.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from config import Config
+
+# How much memory a table takes once it is loaded in Python, relative to the size of the file on disk.
+# Shapefiles are compact binary files, but as shapely objects in a GeoDataFrame they grow quite a bit.
+SHAPEFILE_FACTOR = 2.5
+PICKLE_FACTOR = 1.5
+PARQUET_FACTOR = 3.0
+
+# Rasters are read in small windows around each terminal unit catchment, so we only count
+# a small fraction of the size of the flow direction and accumulation files.
+RASTER_FRACTION = 0.05
+
+# Each additional worker process (WORKERS > 1) ends up with a partial copy of the basin data.
+# With fork, the memory is shared at first, but pages get copied as the workers touch them.
+WORKER_SHARE = 0.5
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def _table_size(conf: Config, geotype: str, basin: int, high_resolution: bool) -> int:
+    """Estimated size in memory of the catchments or rivers table for one basin, in bytes."""
+    # The cached copy of the table is the best guide, if we have one
+    if conf.PICKLE_DIR != '':
+        res = 'hires' if high_resolution else 'lores'
+        size = _file_size(f"{conf.PICKLE_DIR}/{geotype}_{basin}_{res}.parquet")
+        if size > 0:
+            return int(size * PARQUET_FACTOR)
+        size = _file_size(f"{conf.PICKLE_DIR}/{geotype}_{basin}_{res}.pkl")
+        if size > 0:
+            return int(size * PICKLE_FACTOR)
+
+    if geotype == "catchments":
+        directory = conf.HIGHRES_CATCHMENTS_DIR if high_resolution else conf.LOWRES_CATCHMENTS_DIR
+        stem = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01"
+    else:
+        stem = f"{conf.RIVERS_DIR}/riv_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01"
+
+    size = _file_size(f"{stem}.shp") + _file_size(f"{stem}.dbf")
+    return int(size * SHAPEFILE_FACTOR)
+
+
+def estimate_basin_memory(conf: Config, basin: int) -> int:
+    """
+    Rough estimate of the peak memory needed to delineate the outlets in a basin, in bytes.
+    """
+    tables = _table_size(conf, "rivers", basin, True)
+    tables += _table_size(conf, "catchments", basin, conf.HIGH_RES)
+    if conf.HIGH_RES:
+        # Big watersheds switch to the low-res unit catchments
+        tables += _table_size(conf, "catchments", basin, False)
+
+    rasters = 0
+    if conf.HIGH_RES:
+        rasters += _file_size(f"{conf.MERIT_FDIR_DIR}/flowdir{basin}.tif")
+        rasters += _file_size(f"{conf.MERIT_ACCUM_DIR}/accum{basin}.tif")
+
+    workers = max(1, conf.WORKERS)
+    per_process = tables + rasters * RASTER_FRACTION
+    return int(per_process * (1 + WORKER_SHARE * (workers - 1)))
+
+
+def memory_budget(conf: Config) -> int:
+    """
+    The memory budget in bytes: MEMORY_BUDGET_GB from the config, or else
+    80% of the physical memory of this computer.
+    """
+    if conf.MEMORY_BUDGET_GB > 0:
+        return int(conf.MEMORY_BUDGET_GB * 1e9)
+
+    try:
+        total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        raise Exception("Could not determine the amount of memory on this computer. "
+                        "Please set MEMORY_BUDGET_GB in config.py")
+    return int(total * 0.8)
+
+
+def run_basins(conf: Config, jobs: list, func) -> list:
+    """
+    Runs func(*args) for each job in its own process, with up to BASIN_WORKERS at the same time,
+    as long as the estimated memory of the running jobs fits in the budget.
+
+    Args:
+        jobs: list of tuples (basin, args), where args is the tuple of arguments for func
+        func: the function to call, e.g. delineate_basin. It has to be a module-level function,
+            so that it can be sent to the worker processes.
+
+    Returns:
+        the list of results, in the same order as `jobs`
+    """
+    budget = memory_budget(conf)
+    estimates = [estimate_basin_memory(conf, basin) for basin, _ in jobs]
+
+    if conf.VERBOSE:
+        print(f"Running up to {conf.BASIN_WORKERS} basins at a time, with a memory budget of {budget / 1e9:,.1f} GB")
+
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running = {}  # future -> job number
+    in_use = 0
+
+    with ProcessPoolExecutor(max_workers=conf.BASIN_WORKERS, mp_context=ctx) as executor:
+        while pending or running:
+            # Start as many of the waiting basins as we can. If a basin does not fit right now,
+            # try the next one: a smaller basin might still fit in the remaining budget.
+            for k in list(pending):
+                if len(running) >= conf.BASIN_WORKERS:
+                    break
+                # A basin that is bigger than the whole budget can only run on its own
+                if running and in_use + estimates[k] > budget:
+                    continue
+                basin, args = jobs[k]
+                if conf.VERBOSE:
+                    print(f"Starting basin {basin}, estimated memory {estimates[k] / 1e9:,.1f} GB")
+                running[executor.submit(func, *args)] = k
+                in_use += estimates[k]
+                pending.remove(k)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                in_use -= estimates[k]
+                results[k] = future.result()
+
+    return results
@@ -0,0 +1,332 @@
+"""
+A delineation server on your own computer, which keeps the basin data in memory between requests.
+
+Every run of delineate.py starts from scratch: it imports the libraries, reads the Level 2 basins shapefile, and
+loads the unit catchments and rivers for each basin, which takes much longer than delineating one watershed.
+For an interactive tool that asks for one watershed at a time, that is tens of seconds for every click.
+
+This server does all of that once. It reads the Level 2 basins when it starts, and keeps the data for the most
+recently used basins in memory (SERVER_CACHE_BASINS in each worker process), so after the first request in a basin,
+the next ones only take as long as the delineation itself. The delineation runs in SERVER_WORKERS worker processes.
+Each basin always goes to the same worker process, so its data is only loaded once, and the outlets in different
+basins can be delineated at the same time.
+
+Start it from the main folder of the repo (it uses the settings in config.py, e.g. HIGH_RES and the data folders):
+
+    >> python -m py.server --port 8080 --workers 2 --basins 11
+
+Then, ask for one outlet (id, name and area are optional):
+
+    >> curl "http://localhost:8080/delineate?lat=64.025&lng=-19.975&id=my_gage&area=1900"
+
+or several at once, as JSON, either a list of outlets or a GeoJSON FeatureCollection of points:
+
+    >> curl -X POST http://localhost:8080/delineate -d '{"outlets": [{"id": "a", "lat": 64.025, "lng": -19.975}]}'
+
+The answer is a GeoJSON FeatureCollection with a watershed for each outlet, with the same fields as OUTPUT.csv,
+plus "failed" with the outlets we could not delineate and the reason. GET /health tells you which basins are loaded.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse, parse_qs
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from config import Config
+from delineate import prepare_outlets, read_megabasins, match_basins, delineate_basin, \
+    load_basin, in_memory_config, PROJ_WGS84
+from py import instrument
+from py.metrics import add_metrics
+
+# The biggest request we accept, in bytes
+MAX_BODY = 50 * 1024 * 1024
+
+REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+# The basin data in this worker process, the most recently used last
+_cache = OrderedDict()
+
+
+def server_config(conf: Config) -> Config:
+    """
+    The settings for the server: the same as config.py, except that we don't write any files (see
+    in_memory_config() in delineate.py), and each worker process delineates its outlets by itself
+    (the server has its own worker processes).
+    """
+    return in_memory_config(conf).model_copy(update={
+        'WORKERS': 1,
+        'BASIN_WORKERS': 1,
+        'LAZY_LOAD': False,
+    })
+
+
+def get_basin_data(conf: Config, basin: int) -> dict:
+    """The data for a basin from the cache, or loaded now (and the least recently used basin dropped)."""
+    if basin in _cache:
+        _cache.move_to_end(basin)
+        return _cache[basin]
+    data = load_basin(conf, basin)
+    _cache[basin] = data
+    while len(_cache) > max(1, conf.SERVER_CACHE_BASINS):
+        _cache.popitem(last=False)
+    return data
+
+
+def _init_worker():
+    instrument.enable(False)
+
+
+def _warm_up(conf: Config, basins: list) -> list:
+    # Runs in a worker process. Loads the basins, and returns the ones in the cache.
+    for basin in basins:
+        get_basin_data(conf, basin)
+    return list(_cache)
+
+
+def delineate_in_basin(conf: Config, basin: int, gages_in_basin: gpd.GeoDataFrame,
+                       gages_df: pd.DataFrame) -> (gpd.GeoDataFrame, dict, list):
+    """
+    Runs in a worker process: delineates the outlets in one basin, with the basin data from the cache.
+    Returns the watersheds, with their rows of the output table, the outlets that failed,
+    and the basins in the cache.
+    """
+    data = get_basin_data(conf, basin)
+    records, failed = delineate_basin(conf, basin, gages_in_basin, gages_df, data=data)
+    geometry = [record.pop('feature')['geometry'] for record in records]
+    if records:
+        add_metrics(gages_df, pd.DataFrame(records).set_index('id'))
+    ids = [record['id'] for record in records]
+    watersheds = gpd.GeoDataFrame(gages_df.loc[ids], geometry=geometry, crs=PROJ_WGS84)
+    return watersheds, failed, list(_cache)
+
+
+def parse_outlets(method: str, query: dict, body: bytes) -> pd.DataFrame:
+    """The outlets in a request, as a table like the outlets CSV file: id, lat, lng, and maybe name and area."""
+    if method == "GET":
+        rows = [{k: v[0] for k, v in query.items() if k in ('id', 'lat', 'lng', 'name', 'area')}]
+        rows[0].setdefault('id', "1")
+    else:
+        request = json.loads(body)
+        if isinstance(request, dict) and request.get('type') == "FeatureCollection":
+            rows = []
+            for feature in request['features']:
+                row = dict(feature.get('properties') or {})
+                row['lng'], row['lat'] = feature['geometry']['coordinates'][:2]
+                rows.append(row)
+        elif isinstance(request, dict):
+            rows = request.get('outlets', [])
+        else:
+            rows = request
+        for k, row in enumerate(rows):
+            row.setdefault('id', str(k + 1))
+
+    if len(rows) == 0:
+        raise Exception("No outlets in the request")
+    gages_df = pd.DataFrame(rows)
+    for field in ['lat', 'lng']:
+        if field not in gages_df:
+            raise Exception(f"Missing field in the request: {field}")
+        gages_df[field] = pd.to_numeric(gages_df[field]).astype(float)
+    gages_df['id'] = gages_df['id'].astype(str)
+    keep = [c for c in ['id', 'lat', 'lng', 'name', 'area'] if c in gages_df]
+    return gages_df[keep]
+
+
+def _to_json(value):
+    # For the NumPy numbers in the tables, which json can't write
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Can't write {type(value)} to JSON")
+
+
+class DelineationServer:
+    """The state of the server: the Level 2 basins, the worker processes, and which basin goes to which worker."""
+
+    def __init__(self, conf: Config):
+        self.conf = server_config(conf)
+        self.megabasins_gdf = read_megabasins(self.conf)
+        methods = multiprocessing.get_all_start_methods()
+        self.ctx = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+        self.workers = [self.new_worker() for _ in range(max(1, self.conf.SERVER_WORKERS))]
+        # Start the worker processes now, before the event loop, so they don't have to fork from it
+        for worker in self.workers:
+            worker.submit(_warm_up, self.conf, []).result()
+        self.assigned = {}
+        self.loaded = {}
+
+    def new_worker(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=1, mp_context=self.ctx, initializer=_init_worker)
+
+    async def run(self, k: int, func, *args):
+        """
+        Runs func(*args) in worker process k. If the process died (e.g. it ran out of memory on a big basin),
+        we start a new one, so the next requests for its basins work again, and raise the error for this one.
+        """
+        worker = self.workers[k]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(worker, func, *args)
+        except BrokenProcessPool:
+            # Several requests can find out at the same time; only the first one replaces the worker
+            if self.workers[k] is worker:
+                print(f"Worker process {k} stopped unexpectedly. Starting a new one")
+                worker.shutdown(wait=False, cancel_futures=True)
+                self.workers[k] = self.new_worker()
+                self.loaded[k] = []
+            raise
+
+    def worker_for(self, basin: int) -> int:
+        # Each basin always goes to the same worker process, so its data only gets loaded once
+        if basin not in self.assigned:
+            self.assigned[basin] = len(self.assigned) % len(self.workers)
+        return self.assigned[basin]
+
+    async def warm_up(self, basins: list):
+        """Loads the data for some basins ahead of time."""
+        for basin in basins:
+            k = self.worker_for(basin)
+            self.loaded[k] = await self.run(k, _warm_up, self.conf, [basin])
+
+    def prepare(self, gages_df: pd.DataFrame) -> (pd.DataFrame, gpd.GeoDataFrame, dict):
+        """Checks the outlets, and finds out which Level 2 basin each one is in."""
+        gages_df, points_gdf = prepare_outlets(self.conf, gages_df)
+        matched, failed = match_basins(self.conf, gages_df, points_gdf, self.megabasins_gdf)
+        return gages_df, matched, failed
+
+    async def delineate(self, gages_df: pd.DataFrame, matched: gpd.GeoDataFrame, failed: dict) -> dict:
+        """Delineates the outlets from prepare(), one job per basin, and returns the GeoJSON answer."""
+        jobs = []
+        basins = []
+        for basin, gages_in_basin in matched.groupby('BASIN'):
+            basin = int(basin)
+            k = self.worker_for(basin)
+            basins.append((k, basin))
+            jobs.append(self.run(k, delineate_in_basin, self.conf, basin, gages_in_basin,
+                                 gages_df.loc[gages_in_basin['id']].copy()))
+        results = await asyncio.gather(*jobs)
+
+        features = []
+        for (k, basin), (watersheds, basin_failed, cached) in zip(basins, results):
+            self.loaded[k] = cached
+            # The id is both the id of the feature and one of its properties
+            watersheds.insert(0, 'id', watersheds.index)
+            features.extend(watersheds.to_geo_dict(na='null')['features'])
+            failed.update(basin_failed)
+        return {'type': "FeatureCollection", 'features': features, 'failed': failed}
+
+    async def route(self, method: str, target: str, body: bytes) -> (int, dict):
+        url = urlparse(target)
+        if url.path == "/health":
+            return 200, {'status': "ok", 'workers': len(self.workers),
+                         'basins': sorted(b for basins in self.loaded.values() for b in basins)}
+        if url.path != "/delineate":
+            return 404, {'error': f"Unknown path {url.path}. Use /delineate or /health"}
+        if method not in ("GET", "POST"):
+            return 405, {'error': "Use GET or POST"}
+        try:
+            gages_df = parse_outlets(method, parse_qs(url.query), body)
+            # e.g. two outlets with the same id, or a latitude out of range
+            gages_df, matched, failed = await asyncio.get_running_loop().run_in_executor(None, self.prepare,
+                                                                                          gages_df)
+        except Exception as e:
+            return 400, {'error': f"Could not read the outlets: {str(e)}"}
+        try:
+            return 200, await self.delineate(gages_df, matched, failed)
+        except BrokenProcessPool:
+            return 500, {'error': "The worker process stopped unexpectedly (maybe out of memory). Please try again"}
+        except Exception as e:
+            # Problems on our side, e.g. missing data files
+            return 500, {'error': str(e)}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # One HTTP request per connection
+        t0 = time.perf_counter()
+        method, target = "", ""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            method, target, _ = request_line.split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if method == "OPTIONS":
+                status, payload = 204, None
+            elif length > MAX_BODY:
+                status, payload = 413, {'error': f"The request is bigger than {MAX_BODY} bytes"}
+            else:
+                body = await reader.readexactly(length) if length > 0 else b''
+                status, payload = await self.route(method, target, body)
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        content = b'' if payload is None else json.dumps(payload, default=_to_json).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\n"
+                f"Access-Control-Allow-Origin: *\r\n"
+                f"Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+                f"Access-Control-Allow-Headers: Content-Type\r\n"
+                f"Connection: close\r\n\r\n")
+        writer.write(head.encode('latin-1') + content)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        if self.conf.VERBOSE:
+            print(f"{method} {target[:80]} -> {status} in {time.perf_counter() - t0:.3f} s")
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown(cancel_futures=True)
+
+
+async def serve(conf: Config, basins: list = None):
+    """Starts the server, and runs it until it is stopped (Ctrl+C)."""
+    server = DelineationServer(conf)
+    try:
+        if basins:
+            await server.warm_up(basins)
+        listener = await asyncio.start_server(server.handle, conf.SERVER_HOST, conf.SERVER_PORT)
+        print(f"Delineation server at http://{conf.SERVER_HOST}:{conf.SERVER_PORT}/delineate "
+              f"with {len(server.workers)} worker process(es)")
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main():
+    conf = Config()
+    parser = argparse.ArgumentParser(description="Runs a delineation server on this computer (see py/server.py)")
+    parser.add_argument('--host', default=None, help="Overrides SERVER_HOST in config.py")
+    parser.add_argument('--port', type=int, default=None, help="Overrides SERVER_PORT in config.py")
+    parser.add_argument('--workers', type=int, default=None, help="Overrides SERVER_WORKERS in config.py")
+    parser.add_argument('--basins', type=int, nargs='*', default=[],
+                        help="Level 2 basins to load when the server starts, e.g. 11 12")
+    args = parser.parse_args()
+    if args.host is not None:
+        conf.SERVER_HOST = args.host
+    if args.port is not None:
+        conf.SERVER_PORT = args.port
+    if args.workers is not None:
+        conf.SERVER_WORKERS = args.workers
+    try:
+        asyncio.run(serve(conf, args.basins))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Upstream topology index for the MERIT-Basins river network.
+
+The rivers shapefiles tell us, for every river reach (or unit catchment), the COMIDs
+of up to four reaches that flow into it, in the fields up1, up2, up3 and up4.
+The original script walked this network recursively, with four pandas lookups per reach.
+That was fine for small watersheds, but very slow (and a RecursionError waiting to happen)
+for continental-scale rivers with hundreds of thousands of unit catchments.
+
+Here, we build an index once per Level 2 basin: COMIDs are mapped to integer row numbers,
+and the upstream neighbors of every row are stored in compact CSR-style arrays
+(`indptr` and `children`), like a sparse matrix. Finding the upstream unit catchments
+is then an iterative walk over plain NumPy integer arrays.
+
+We also number the reaches in depth-first (pre-)order, which is the same order the old recursive
+`addnode` produced. In that order, everything upstream of a reach sits in one contiguous
+block of rows, [start, end). This is the "nested set" or Euler tour trick. When the catchments
+and rivers tables are stored sorted in this order (see `euler_sort`), the entire upstream
+watershed of any COMID is a slice of the table, and "is A upstream of B" is just
+a comparison of two intervals.
+"""
+import numpy as np
+import pandas as pd
+
+# The fields in the MERIT-Basins rivers table that hold the upstream COMIDs
+UP_FIELDS = ['up1', 'up2', 'up3', 'up4']
+
+# The fields where we store the Euler tour intervals in the catchments and rivers tables
+EULER_FIELDS = ['euler_start', 'euler_end']
+
+
+class UpstreamIndex:
+    """
+    Array-backed index of the river network in a single Level 2 basin.
+
+    Rows are numbered in the same order as the rivers table the index was built from,
+    so a row number can be used directly with `rivers_gdf.iloc[]`.
+    """
+
+    def __init__(self, comids: np.ndarray, up: np.ndarray, start: np.ndarray = None, end: np.ndarray = None):
+        """
+        Args:
+            comids: 1-D array with the COMID of every row in the rivers table
+            up: 2-D array of shape (n, 4) with the upstream COMIDs (fields up1..up4), 0 = none
+            start, end: optional, the Euler tour intervals if they were already computed and
+              stored with the table. Otherwise, they are computed when first needed.
+        """
+        self.comids = np.asarray(comids, dtype=np.int64)
+        n = len(self.comids)
+
+        # Lookup table COMID -> row, via a sorted copy of the COMIDs and np.searchsorted
+        self._sorter = np.argsort(self.comids, kind='stable')
+        self._sorted_comids = self.comids[self._sorter]
+
+        # Translate the upstream COMIDs into row numbers. Zeros and COMIDs that
+        # are not in the table (this happens at the edges of the basin) are dropped.
+        up = np.asarray(up, dtype=np.int64).reshape(n, -1)
+        up_rows = self._lookup(up.ravel()).reshape(up.shape)
+        valid = up_rows >= 0
+
+        # CSR layout: the upstream rows of row r are children[indptr[r]:indptr[r + 1]],
+        # in the same order as the fields up1, up2, up3, up4.
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=self.indptr[1:])
+        self.children = up_rows[valid].astype(np.int64)
+
+        # For each table we select from, remember where its rows are relative to ours
+        self._positions = {}
+
+        # The Euler tour: order[i] is the row visited i-th in the depth-first walk,
+        # and the rows upstream of row r are order[start[r]:end[r]]
+        self.order = None
+        self.start = None
+        self.end = None
+        if start is not None and end is not None:
+            self.start = np.asarray(start, dtype=np.int64)
+            self.end = np.asarray(end, dtype=np.int64)
+            self.order = np.empty(n, dtype=np.int64)
+            self.order[self.start] = np.arange(n, dtype=np.int64)
+
+    @classmethod
+    def from_rivers(cls, rivers_gdf: pd.DataFrame) -> 'UpstreamIndex':
+        """
+        Builds the index from a MERIT-Basins rivers table indexed by COMID.
+        """
+        comids = rivers_gdf.index.to_numpy()
+        up = rivers_gdf[UP_FIELDS].to_numpy()
+        if all(field in rivers_gdf.columns for field in EULER_FIELDS):
+            return cls(comids, up, rivers_gdf['euler_start'].to_numpy(), rivers_gdf['euler_end'].to_numpy())
+        return cls(comids, up)
+
+    def __len__(self) -> int:
+        return len(self.comids)
+
+    def _lookup(self, comids: np.ndarray) -> np.ndarray:
+        """Returns the row for each COMID, or -1 where the COMID is not in the index."""
+        comids = np.asarray(comids, dtype=np.int64)
+        if len(self._sorted_comids) == 0:
+            return np.full(comids.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_comids, comids)
+        pos = np.clip(pos, 0, len(self._sorted_comids) - 1)
+        found = self._sorted_comids[pos] == comids
+        return np.where(found, self._sorter[pos], -1)
+
+    def row(self, comid: int) -> int:
+        """Returns the row number of a COMID. Raises a KeyError if it is not in the basin."""
+        r = int(self._lookup(np.array([comid]))[0])
+        if r < 0:
+            raise KeyError(f"COMID {comid} is not in the river network")
+        return r
+
+    def _walk(self, roots: list, visited: np.ndarray = None) -> list:
+        """
+        Depth-first walk of the network starting from `roots`, visiting up1, up2, up3 and up4 in turn.
+        We use an explicit stack instead of recursion, so there is no limit to the size of the watershed.
+        """
+        indptr = self.indptr
+        children = self.children
+        out = []
+        stack = list(reversed(roots))
+        while stack:
+            r = stack.pop()
+            if visited is not None:
+                if visited[r]:
+                    continue
+                visited[r] = True
+            out.append(r)
+            # Push the upstream rows in reverse, so that up1 is visited first
+            stack.extend(children[indptr[r]:indptr[r + 1]][::-1].tolist())
+
+        return out
+
+    def euler(self):
+        """
+        Computes the Euler tour (depth-first pre-order) of the whole network, and the
+        [start, end) interval of every row. Starts at the outlets of the basin (rows that have no
+        downstream reach in the table), in table order.
+        """
+        if self.order is not None:
+            return
+
+        n = len(self.comids)
+        has_parent = np.zeros(n, dtype=bool)
+        has_parent[self.children] = True
+        roots = np.flatnonzero(~has_parent).tolist()
+
+        visited = np.zeros(n, dtype=bool)
+        order = self._walk(roots, visited)
+        if len(order) < n:
+            # Should not happen with MERIT-Basins, but a loop in the network would leave rows unvisited
+            order += self._walk(np.flatnonzero(~visited).tolist(), visited)
+        order = np.array(order, dtype=np.int64)
+
+        start = np.empty(n, dtype=np.int64)
+        start[order] = np.arange(n, dtype=np.int64)
+
+        # Size of each subtree, accumulated from the leaves down to the outlets (reverse pre-order)
+        parent = np.full(n, -1, dtype=np.int64)
+        parent[self.children] = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+        size = np.ones(n, dtype=np.int64)
+        for r in order[::-1].tolist():
+            p = parent[r]
+            if p >= 0:
+                size[p] += size[r]
+
+        self.order = order
+        self.start = start
+        self.end = start + size
+
+    @property
+    def is_sorted(self) -> bool:
+        """True if the table the index was built from is sorted in Euler tour order."""
+        self.euler()
+        return bool(np.array_equal(self.start, np.arange(len(self.start))))
+
+    def upstream_rows(self, comid: int) -> np.ndarray:
+        """
+        Returns the rows of all the unit catchments upstream of `comid`, including itself,
+        as a NumPy array. The terminal unit catchment is always the first element.
+
+        The order is the same as the old recursive function `addnode`.
+        If the Euler tour is known, this is simply a slice of it; otherwise we walk the network.
+        """
+        r = self.row(comid)
+        if self.order is not None:
+            return self.order[self.start[r]:self.end[r]]
+
+        return np.array(self._walk([r]), dtype=np.int64)
+
+    def upstream_of_any(self, rows) -> np.ndarray:
+        """
+        Returns the rows of all the unit catchments upstream of any of `rows` (including themselves),
+        each one once, in Euler tour order.
+        """
+        self.euler()
+        rows = np.asarray(rows, dtype=np.int64)
+        # +1 where each interval starts and -1 where it ends: the positions inside of any of them add up to > 0
+        count = np.zeros(len(self.comids) + 1, dtype=np.int64)
+        np.add.at(count, self.start[rows], 1)
+        np.add.at(count, self.end[rows], -1)
+        return self.order[np.cumsum(count[:-1]) > 0]
+
+    def upstream_comids(self, comid: int) -> np.ndarray:
+        """Returns the COMIDs of all the unit catchments upstream of `comid`, including itself."""
+        return self.comids[self.upstream_rows(comid)]
+
+    def is_upstream(self, a: int, b: int) -> bool:
+        """True if the unit catchment with COMID `a` is upstream of (or the same as) COMID `b`."""
+        self.euler()
+        ra, rb = self.row(a), self.row(b)
+        return bool(self.start[rb] <= self.start[ra] < self.end[rb])
+
+    def positions(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Returns, for every row in the index, the position of the same COMID in `df`
+        (-1 if it is missing). Computed once per table and kept for later calls.
+        """
+        key = id(df.index)
+        cached = self._positions.get(key)
+        # Hold on to the index object, so its id() cannot be reused by another table
+        if cached is None or cached[0] is not df.index:
+            if df.index.equals(pd.Index(self.comids)):
+                pos = np.arange(len(self.comids), dtype=np.int64)
+            else:
+                pos = df.index.get_indexer(self.comids).astype(np.int64)
+            cached = (df.index, pos)
+            self._positions[key] = cached
+
+        return cached[1]
+
+    def select(self, df: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+        """
+        Selects the rows of `df` (a catchments or rivers table indexed by COMID)
+        that correspond to `rows` in this index, preserving their order.
+        """
+        pos = self.positions(df)[rows]
+
+        # Check this first, or a -1 could pass as the start of a run of consecutive rows
+        if (pos < 0).any():
+            missing = self.comids[rows][pos < 0]
+            raise KeyError(f"{len(missing)} COMIDs are missing from the table, e.g. {missing[0]}")
+
+        # If the rows are consecutive in the table, this is a slice (no copy of the data)
+        n = len(pos)
+        if n > 0 and pos[-1] - pos[0] == n - 1 and (n == 1 or (np.diff(pos) == 1).all()):
+            return df.iloc[pos[0]:pos[-1] + 1]
+
+        return df.iloc[pos]
+
+
+def euler_sort(gdf: pd.DataFrame, rivers_gdf: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Returns a copy of a catchments or rivers table (indexed by COMID) sorted in Euler tour order,
+    with the fields euler_start and euler_end added.
+
+    For the rivers table, leave `rivers_gdf` as None; the order is computed from its own up1..up4 fields.
+    For the catchments table, pass the (sorted) rivers table, and the catchments are put in the same order.
+    Any unit catchments that are not in the rivers table go at the end.
+    """
+    if rivers_gdf is None:
+        index = UpstreamIndex.from_rivers(gdf.drop(columns=EULER_FIELDS, errors='ignore'))
+        index.euler()
+        sorted_gdf = gdf.iloc[index.order].copy()
+        sorted_gdf['euler_start'] = np.arange(len(gdf), dtype=np.int64)
+        sorted_gdf['euler_end'] = index.end[index.order]
+        return sorted_gdf
+
+    order = gdf.index.get_indexer(rivers_gdf.index)
+    order = order[order >= 0]
+    extra = np.setdiff1d(np.arange(len(gdf)), order)
+    sorted_gdf = gdf.iloc[np.concatenate([order, extra])].copy()
+    euler = rivers_gdf[EULER_FIELDS].reindex(sorted_gdf.index)
+    sorted_gdf['euler_start'] = euler['euler_start'].fillna(-1).astype(np.int64)
+    sorted_gdf['euler_end'] = euler['euler_end'].fillna(-1).astype(np.int64)
+    return sorted_gdf
+
+
+def is_euler_sorted(gdf: pd.DataFrame, rivers_gdf: pd.DataFrame = None) -> bool:
+    """Checks whether a table was already sorted with `euler_sort` (e.g. when it was loaded from a cache)."""
+    if not all(field in gdf.columns for field in EULER_FIELDS):
+        return False
+    if rivers_gdf is None:
+        return bool(np.array_equal(gdf['euler_start'].to_numpy(), np.arange(len(gdf))))
+    n = len(rivers_gdf)
+    return bool(gdf.index[:n].equals(rivers_gdf.index))
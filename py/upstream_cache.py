@@ -0,0 +1,271 @@
+"""
+A cache of dissolved upstream polygons, for outlets that share the same upstream river network.
+
+When we delineate a dense network of gages, the outlets on the same river dissolve the same
+upstream unit catchments over and over again. With UPSTREAM_CACHE_MB > 0 in config.py, we keep the
+dissolved polygon of everything upstream of a river reach, keyed by its COMID, and build each
+watershed out of the biggest pieces we already have.
+
+A watershed is the (split) terminal unit catchment, plus everything upstream of each of the
+river reaches that flow into it (its "branches"). For each branch, we look up its polygon in the cache.
+If it's not there, we build it from the cached polygons that lie inside of it, plus the unit catchments
+that are not covered by any of them. Thanks to the Euler tour order (see py/topology.py), the part of the
+network upstream of a reach is one interval [start, end) of rows, so the cached polygons inside of a branch
+are the intervals inside of its interval, and the rest of the unit catchments are a few slices of the table.
+
+The delineation does the upstream outlets first, so that the downstream ones can reuse their branches.
+For a nested network of gages, each unit catchment ends up being dissolved about once, instead of once
+for every gage downstream of it.
+
+When the cache is full, the polygon that was used the longest time ago is thrown out (LRU).
+We measure the size of a polygon by its number of vertices (16 bytes each).
+
+With UPSTREAM_CACHE_PERSIST = True, the polygons are also saved in PICKLE_DIR, to use again in the next run:
+   PICKLE_DIR/upstream_##_hires.parquet
+"""
+import os
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from config import Config
+from py.fast_dissolve import dissolve
+from py.topology import UpstreamIndex
+
+
+class PolygonCache:
+    """
+    LRU cache of dissolved upstream polygons, for one basin.
+    The keys are (high_res, start), where start is the Euler tour position of the river reach.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.basin = None
+        self._polygons = OrderedDict()        # (high_res, start) -> (end, comid, polygon, size)
+        self._starts = {True: [], False: []}  # high_res -> sorted list of the starts in the cache
+        self._new = set()                     # keys added since the last call to take_new()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self.evictions = 0
+
+    def clear(self):
+        self._polygons.clear()
+        self._starts = {True: [], False: []}
+        self._new.clear()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._polygons)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'reused': self.reused, 'evictions': self.evictions,
+                'polygons': len(self._polygons), 'bytes': self.nbytes}
+
+    def get(self, high_res: bool, start: int):
+        key = (high_res, start)
+        item = self._polygons.get(key)
+        if item is None:
+            return None
+        self._polygons.move_to_end(key)
+        return item[2]
+
+    def put(self, high_res: bool, start: int, end: int, comid: int, polygon, new: bool = True):
+        key = (high_res, start)
+        if key in self._polygons:
+            return
+        size = shapely.get_num_coordinates(polygon) * 16 + 100
+        self._polygons[key] = (end, comid, polygon, size)
+        insort(self._starts[high_res], start)
+        self.nbytes += size
+        if new:
+            self._new.add(key)
+
+        # Make room, but always keep the polygon we just added
+        while self.nbytes > self.max_bytes and len(self._polygons) > 1:
+            old_key, (_, _, _, old_size) = self._polygons.popitem(last=False)
+            starts = self._starts[old_key[0]]
+            del starts[bisect_left(starts, old_key[1])]
+            self._new.discard(old_key)
+            self.nbytes -= old_size
+            self.evictions += 1
+
+    def pieces(self, high_res: bool, start: int, end: int) -> (list, list):
+        """
+        Finds the biggest cached polygons inside of the interval [start, end).
+
+        Returns:
+            polygons: the cached polygons
+            gaps: the intervals (a, b) that none of them cover
+        """
+        starts = self._starts[high_res]
+        polygons = []
+        gaps = []
+        pos = start
+        i = bisect_left(starts, start)
+        while i < len(starts) and starts[i] < end:
+            s = starts[i]
+            e, _, polygon, _ = self._polygons[(high_res, s)]
+            self._polygons.move_to_end((high_res, s))
+            polygons.append(polygon)
+            if s > pos:
+                gaps.append((pos, s))
+            pos = e
+            # Skip the polygons inside of this one. (Intervals in the Euler tour are nested or apart, never overlapping.)
+            i = bisect_left(starts, e)
+        if pos < end:
+            gaps.append((pos, end))
+        return polygons, gaps
+
+    def take_new(self) -> list:
+        """Returns the polygons we added since last time, as (high_res, comid, polygon)."""
+        new = [(key[0], self._polygons[key][1], self._polygons[key][2]) for key in self._polygons if key in self._new]
+        self._new.clear()
+        return new
+
+
+def get_persist_filename(conf: Config, basin: int, high_resolution: bool) -> str:
+    resolution_str = 'hires' if high_resolution else 'lores'
+    return f'{conf.PICKLE_DIR}/upstream_{basin}_{resolution_str}.parquet'
+
+
+# The cache for this process
+_cache = None
+
+
+def get_cache(conf: Config, basin: int, topo: UpstreamIndex) -> PolygonCache:
+    """
+    Returns the polygon cache for this process, emptied if we have moved on to a different basin.
+    With UPSTREAM_CACHE_PERSIST, a new basin starts with the polygons we saved last time.
+    """
+    global _cache
+    if _cache is None:
+        _cache = PolygonCache(int(conf.UPSTREAM_CACHE_MB * 1e6))
+    if _cache.basin != basin:
+        _cache.clear()
+        _cache.basin = basin
+        if conf.UPSTREAM_CACHE_PERSIST and conf.PICKLE_DIR != '':
+            for high_res in (True, False):
+                load(conf, _cache, basin, high_res, topo)
+    return _cache
+
+
+def load(conf: Config, cache: PolygonCache, basin: int, high_res: bool, topo: UpstreamIndex):
+    fname = get_persist_filename(conf, basin, high_res)
+    if not os.path.isfile(fname):
+        return
+    if conf.VERBOSE:
+        print(f"Reading saved upstream polygons from {fname}")
+    gdf = gpd.read_parquet(fname)
+    topo.euler()
+    # COMIDs that are no longer in the river network are skipped
+    rows = topo._lookup(gdf['COMID'].to_numpy())
+    for row, comid, polygon in zip(rows, gdf['COMID'], gdf.geometry):
+        if row >= 0:
+            cache.put(high_res, int(topo.start[row]), int(topo.end[row]), int(comid), polygon, new=False)
+
+
+def save(conf: Config, basin: int, polygons: list):
+    """
+    Adds new polygons, a list of (high_res, comid, polygon) from `take_new()`, to the saved files for this basin.
+    """
+    for high_res in (True, False):
+        new = [(comid, polygon) for res, comid, polygon in polygons if res == high_res]
+        if len(new) == 0:
+            continue
+
+        fname = get_persist_filename(conf, basin, high_res)
+        gdf = gpd.GeoDataFrame({'COMID': [comid for comid, _ in new]},
+                               geometry=[polygon for _, polygon in new], crs='EPSG:4326')
+        if os.path.isfile(fname):
+            old = gpd.read_parquet(fname)
+            gdf = gpd.GeoDataFrame(pd.concat([old, gdf], ignore_index=True), crs='EPSG:4326')
+            gdf = gdf.drop_duplicates(subset='COMID', keep='first')
+
+        if conf.VERBOSE:
+            print(f"Saving {len(new)} upstream polygons to {fname}")
+        tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        try:
+            gdf.to_parquet(tmp_fname, index=False)
+            os.replace(tmp_fname, fname)
+        except Exception as e:
+            if os.path.isfile(tmp_fname):
+                os.remove(tmp_fname)
+            raise Warning(f"Could not save upstream polygons to: {fname}. Message: {str(e)}")
+
+
+def _dissolve(polygons: list, crs, method: str):
+    """Dissolves a list of polygons into one, the same way as for the whole watershed."""
+    if len(polygons) == 1:
+        return polygons[0]
+    gdf = gpd.GeoDataFrame(geometry=polygons, crs=crs)
+    return dissolve(gdf, method).iloc[0]
+
+
+def upstream_polygon(cache: PolygonCache, topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame,
+                     high_res: bool, row: int, method: str = 'clip'):
+    """The dissolved polygon of all the unit catchments upstream of `row` (including itself)."""
+    start, end = int(topo.start[row]), int(topo.end[row])
+    polygon = cache.get(high_res, start)
+    if polygon is not None:
+        cache.hits += 1
+        return polygon
+
+    # Not there, but maybe some of the polygons inside of it are
+    cache.misses += 1
+    polygons, gaps = cache.pieces(high_res, start, end)
+    cache.reused += len(polygons)
+    for a, b in gaps:
+        polygons.extend(topo.select(catchments_gdf, topo.order[a:b]).geometry.values)
+    polygon = _dissolve(polygons, catchments_gdf.crs, method)
+    cache.put(high_res, start, end, int(topo.comids[row]), polygon)
+    return polygon
+
+
+def dissolve_watershed(cache: PolygonCache, topo: UpstreamIndex, catchments_gdf: gpd.GeoDataFrame,
+                       high_res: bool, terminal_row: int, terminal_poly, split: bool,
+                       method: str = 'clip') -> gpd.GeoSeries:
+    """
+    Same as `dissolve()` on all of the unit catchments in the watershed, but using the cache.
+
+    Args:
+        catchments_gdf: the unit catchments table (high- or low-resolution, see `high_res`)
+        terminal_row: the row of the terminal unit catchment in the topology index
+        terminal_poly: the polygon of the terminal unit catchment (in high-res mode, after split_catchment)
+        split: True if terminal_poly is only part of the unit catchment. Otherwise,
+            we also save the whole watershed in the cache.
+        method: one of the DISSOLVE_METHODS, see py/fast_dissolve.py
+
+    Returns:
+        a GeoSeries with the watershed polygon, like `dissolve()`
+    """
+    topo.euler()
+    branches = topo.children[topo.indptr[terminal_row]:topo.indptr[terminal_row + 1]]
+    polygons = [terminal_poly]
+    for row in branches.tolist():
+        polygons.append(upstream_polygon(cache, topo, catchments_gdf, high_res, row, method))
+
+    gdf = gpd.GeoDataFrame(geometry=polygons, crs=catchments_gdf.crs)
+    watershed = dissolve(gdf, method)
+
+    if not split:
+        cache.put(high_res, int(topo.start[terminal_row]), int(topo.end[terminal_row]),
+                  int(topo.comids[terminal_row]), watershed.iloc[0])
+    return watershed
+
+
+def outlet_order(topo: UpstreamIndex, outlets: list) -> np.ndarray:
+    """
+    The order to delineate the outlets in, so that the upstream ones come first:
+    by their position in the Euler tour, last to first.
+    """
+    topo.euler()
+    rows = topo._lookup(np.array([o['terminal_comid'] for o in outlets], dtype=np.int64))
+    starts = np.where(rows >= 0, topo.start[np.maximum(rows, 0)], -1)
+    return np.argsort(-starts, kind='stable')
@@ -29,11 +29,9 @@ if toolname == 'delineate':
     outlet_path = data_paths['outlets']
     logger.debug(f"Outlets: {outlet_path}")
 
-    # create the CSV as delineate.py expects it
+    # read the outlets, delineate.py takes them as they are (no need for an outlets CSV)
     gdf = utils.get_outlets(outlet_path=outlet_path)
-    outles_target_path = '/out/outlets.csv'
-    utils.save_temporary_outlets(gdf=gdf, target_path=outles_target_path)
-    logger.debug(f"Generated input outlets CSV for delineate.py: {outles_target_path}")
+    logger.debug(f"Read {len(gdf)} outlets from {outlet_path}")
 
     # actual tool 
     conf = Config(
@@ -42,7 +40,6 @@ if toolname == 'delineate':
 
         # settings to overwrite the internals of delineate.py
         # these are needed to run the tool inside the container
-        OUTLETS_CSV=outles_target_path,
         MERIT_FDIR_DIR='/data/raster/flowdir_basins',
         MERIT_ACCUM_DIR='/data/raster/accum_basins',
         HIGHRES_CATCHMENTS_DIR='/data/shp/merit_catchments',
@@ -61,7 +58,7 @@ if toolname == 'delineate':
         PICKLE_DIR = '',
     )
     logger.debug(f"Starting delineate.py with config: {conf}")
-    delineate(conf=conf)
+    delineate(conf=conf, outlets=gdf)
 
     # finish the tool
     logger.info(f"Total runtime: {time() - start:.2f} seconds.")
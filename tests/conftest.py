@@ -0,0 +1,14 @@
+"""
+The helper modules are in the folder py/, which has no __init__.py. pytest comes with a module called py.py, which
+hides that folder, so we register the folder as the package `py` before the tests import from it.
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+package = types.ModuleType('py')
+package.__path__ = [os.path.join(ROOT, 'py')]
+sys.modules['py'] = package
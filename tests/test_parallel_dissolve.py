@@ -0,0 +1,45 @@
+"""
+Tests for the groups of unit catchments that py/parallel_dissolve.py dissolves in parallel.
+"""
+import numpy as np
+import pytest
+
+from py.parallel_dissolve import groups
+from py.topology import UpstreamIndex
+from test_topology import make_rivers
+
+
+def watershed_sizes(seed: int) -> np.ndarray:
+    """The sizes of the sub-networks of the biggest watershed in a made-up river network, in Euler tour order."""
+    topo = UpstreamIndex.from_rivers(make_rivers(n=500, n_outlets=1, seed=seed))
+    topo.euler()
+    rows = topo.order[topo.start[topo.order[0]]:topo.end[topo.order[0]]]
+    return topo.end[rows] - topo.start[rows]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('n_groups', [1, 4, 16])
+def test_groups(seed, n_groups):
+    sizes = watershed_sizes(seed)
+    n = len(sizes)
+    blocks = groups(sizes, n_groups)
+
+    # The blocks cover all of the rows, in order, and none of them is more than twice the average size
+    assert blocks[0][0] == 0 and blocks[-1][1] == n
+    assert all(a < b for a, b in blocks)
+    assert all(blocks[k][1] == blocks[k + 1][0] for k in range(len(blocks) - 1))
+    assert len(blocks) <= n_groups
+    target = int(np.ceil(n / n_groups))
+    assert all(b - a < 2 * target for a, b in blocks)
+
+    # A sub-network that starts in a block is either all in it, or has to be too big for one block
+    for a, b in blocks:
+        for i in range(a, b):
+            assert i + sizes[i] <= b or sizes[i] > target
+
+
+def test_groups_one_outlet():
+    # Everything flows straight into the outlet, like the made-up watersheds in benchmarks/dissolve.py
+    sizes = np.ones(100, dtype=np.int64)
+    sizes[0] = 100
+    assert groups(sizes, 4) == [(0, 25), (25, 50), (50, 75), (75, 100)]
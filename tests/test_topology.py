@@ -0,0 +1,159 @@
+"""
+Tests for the upstream topology index in py/topology.py, on a small made-up river network.
+Run them from the main folder of the repo with:
+
+    >> python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from py.topology import UpstreamIndex, UP_FIELDS, EULER_FIELDS, euler_sort, is_euler_sorted
+
+
+def make_rivers(n: int = 300, n_outlets: int = 3, seed: int = 0) -> pd.DataFrame:
+    """
+    A rivers table like MERIT-Basins: random COMIDs in random order, up to four upstream reaches each,
+    and a few upstream COMIDs that are not in the table (like at the edge of a basin).
+    """
+    rng = np.random.default_rng(seed)
+    comids = rng.choice(np.arange(11000001, 11000001 + 10 * n), size=n, replace=False)
+    up = np.zeros((n, 4), dtype=np.int64)
+    n_up = np.zeros(n, dtype=int)
+    # Every reach after the first few flows into one of the reaches before it that has room for one more
+    for k in range(n_outlets, n):
+        while True:
+            down = rng.integers(0, k)
+            if n_up[down] < 4:
+                break
+        up[down, n_up[down]] = comids[k]
+        n_up[down] += 1
+    leaves = np.flatnonzero(n_up == 0)[:5]
+    up[leaves, 0] = 99000001 + np.arange(len(leaves))
+
+    rivers = pd.DataFrame(up, columns=UP_FIELDS, index=pd.Index(comids, name='COMID'))
+    rivers['uparea'] = rng.uniform(1, 100, size=n)
+    return rivers.iloc[rng.permutation(n)]
+
+
+def addnode(rivers: pd.DataFrame, B: list, node: int):
+    """
+    The recursive function that the script used before the topology index. (It would fail on the upstream COMIDs
+    that are not in the table, which the index skips, so we skip them here too.)
+    """
+    B.append(node)
+    for field in UP_FIELDS:
+        up = rivers[field].loc[node]
+        if up != 0 and up in rivers.index:
+            addnode(rivers, B, up)
+
+
+@pytest.fixture
+def rivers():
+    return make_rivers()
+
+
+@pytest.mark.parametrize('with_euler', [False, True])
+def test_upstream_rows_same_as_addnode(rivers, with_euler):
+    topo = UpstreamIndex.from_rivers(rivers)
+    if with_euler:
+        topo.euler()
+    for comid in rivers.index:
+        B = []
+        addnode(rivers, B, comid)
+        assert topo.upstream_comids(comid).tolist() == B
+
+
+def test_is_upstream(rivers):
+    topo = UpstreamIndex.from_rivers(rivers)
+    comid = rivers.index[0]
+    upstream = set(topo.upstream_comids(comid).tolist())
+    for other in rivers.index:
+        assert topo.is_upstream(other, comid) == (other in upstream)
+
+
+def test_upstream_of_any(rivers):
+    topo = UpstreamIndex.from_rivers(rivers)
+    comids = rivers.index[:10]
+    expected = set()
+    for comid in comids:
+        expected.update(topo.upstream_comids(comid).tolist())
+    rows = topo.upstream_of_any(topo._lookup(comids.to_numpy()))
+    assert len(rows) == len(expected)
+    assert set(topo.comids[rows].tolist()) == expected
+
+
+def test_row_missing(rivers):
+    topo = UpstreamIndex.from_rivers(rivers)
+    with pytest.raises(KeyError):
+        topo.row(12345)
+
+
+def test_select_missing(rivers):
+    topo = UpstreamIndex.from_rivers(rivers)
+    catchments = pd.DataFrame({'area': np.arange(len(rivers), dtype=float)}, index=rivers.index)
+    rows = topo.upstream_rows(rivers.index[0])
+    with pytest.raises(KeyError):
+        topo.select(catchments.drop(index=topo.comids[rows[-1]]), rows)
+
+
+def test_select_missing_first_row():
+    # The positions are [-1, 0, 1]: these look like a run of consecutive rows, but the first one is missing
+    rivers = pd.DataFrame({'up1': [2, 3, 0], 'up2': 0, 'up3': 0, 'up4': 0}, index=[1, 2, 3])
+    topo = UpstreamIndex.from_rivers(rivers)
+    catchments = pd.DataFrame({'area': [2.0, 3.0]}, index=[2, 3])
+    with pytest.raises(KeyError):
+        topo.select(catchments, topo.upstream_rows(1))
+
+
+def test_select_slice(rivers):
+    rivers = euler_sort(rivers)
+    topo = UpstreamIndex.from_rivers(rivers)
+    catchments = pd.DataFrame({'area': np.arange(len(rivers), dtype=float)}, index=rivers.index)
+    for comid in rivers.index[:20]:
+        rows = topo.upstream_rows(comid)
+        selected = topo.select(catchments, rows)
+        assert selected.index.tolist() == topo.comids[rows].tolist()
+        # In Euler tour order, the watershed is a slice of the table, not a copy
+        assert np.shares_memory(selected['area'].to_numpy(), catchments['area'].to_numpy())
+
+
+def test_select_not_sorted(rivers):
+    topo = UpstreamIndex.from_rivers(rivers)
+    catchments = pd.DataFrame({'area': np.arange(len(rivers), dtype=float)}, index=rivers.index[::-1])
+    rows = topo.upstream_rows(rivers.index[0])
+    assert topo.select(catchments, rows).index.tolist() == topo.comids[rows].tolist()
+
+
+def test_euler_sort(rivers):
+    assert not is_euler_sorted(rivers)
+    sorted_rivers = euler_sort(rivers)
+    assert is_euler_sorted(sorted_rivers)
+    assert sorted(sorted_rivers.index) == sorted(rivers.index)
+
+    # Sorting again changes nothing
+    again = euler_sort(sorted_rivers)
+    assert again.index.equals(sorted_rivers.index)
+    assert again[EULER_FIELDS].equals(sorted_rivers[EULER_FIELDS])
+
+    # The index built from the sorted table uses the stored intervals, and gives the same answers
+    topo = UpstreamIndex.from_rivers(sorted_rivers)
+    assert topo.is_sorted
+    original = UpstreamIndex.from_rivers(rivers)
+    for comid in rivers.index:
+        r = topo.row(comid)
+        assert topo.upstream_rows(comid).tolist() == list(range(topo.start[r], topo.end[r]))
+        assert topo.upstream_comids(comid).tolist() == original.upstream_comids(comid).tolist()
+
+
+def test_euler_sort_catchments(rivers):
+    sorted_rivers = euler_sort(rivers)
+    # A unit catchment that is not in the rivers table goes at the end
+    catchments = pd.DataFrame({'area': 1.0}, index=pd.Index(list(rivers.index[::-1]) + [12345], name='COMID'))
+    assert not is_euler_sorted(catchments, sorted_rivers)
+
+    sorted_catchments = euler_sort(catchments, sorted_rivers)
+    assert is_euler_sorted(sorted_catchments, sorted_rivers)
+    assert sorted_catchments.index[:len(rivers)].equals(sorted_rivers.index)
+    assert sorted_catchments.index[-1] == 12345
+    assert sorted_catchments['euler_start'].iloc[-1] == -1